@@ -0,0 +1,2 @@
+# AE helpers module
+
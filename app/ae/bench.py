@@ -0,0 +1,279 @@
+"""Signal storm benchmark of mhe_ae → mhe_fortiapi → FortiGate (or the mhe_fgemu emulator).
+
+Sends create signals for --users synthetic users spread over --profiles port
+profiles, then delete signals for the same users, through AE /signal, and
+reports events/sec and p50/p90/p99/max provisioning latency per phase. With
+AE_DEBOUNCE_SECONDS=0 latency is the /signal call; otherwise the driver polls
+/state/{login} until AE has applied (or dropped) the user. With --rate the
+signals are sent open-loop at that rate and latency counts from the scheduled
+send time, so queueing inside AE is not hidden.
+
+--db-stub PORT serves the mhe_db endpoints AE calls (policy_id by hash, refcount
+checks, update_policy_id) from memory, so no StarRocks is needed: run AE with
+MHE_DB_HOST=127.0.0.1 MHE_DB_PORT=PORT and AE_RECONCILE_INTERVAL=0. A full
+offline run:
+
+    python -m app.core.mhe_fgemu                       # FORTI_GATE_*_FGS=127.0.0.1:18080, FG_SCHEME=http
+    python -m app.core.mhe_fortiapi
+    python -m app.core.mhe_ae
+    python -m app.ae.bench --db-stub 18081 --users 2000 --emulator http://127.0.0.1:18080 --save base.json
+    python -m app.ae.bench --db-stub 18081 --users 2000 --baseline base.json --max-regression 0.15
+
+Exits 1 when a phase lost more than --max-regression of the baseline's
+events/sec or its p99 grew by more than that.
+"""
+import argparse
+import asyncio
+import ipaddress
+import json
+import logging
+import sys
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+import httpx
+from app.config.env import st
+from app.utils.ports import profile_hash
+
+logger = logging.getLogger("mhe_ae.bench")
+
+PHASES = ("create", "delete")
+
+
+class DBStub:
+    """In-memory stand-in for the mhe_db endpoints AE calls during provisioning"""
+
+    def __init__(self):
+        self.profiles: Dict[str, tuple] = {}  # login → (hash, policy_id)
+        self.calls = Counter()
+
+    def policy_by_hash(self, hash_val: str) -> Optional[str]:
+        return next((p for h, p in self.profiles.values() if h == hash_val and p), None)
+
+    def refcount(self, policy_id: str) -> int:
+        return sum(1 for _, p in self.profiles.values() if p and p == str(policy_id))
+
+    def forget(self, login: str):
+        """The user's session ended: its profile no longer holds the policy"""
+        self.profiles.pop(login, None)
+
+    def app(self):
+        from fastapi import Body, FastAPI
+
+        app = FastAPI()
+
+        @app.post("/query/policy_id/by_hash")
+        def by_hash(payload: dict = Body(...)):
+            self.calls["by_hash"] += 1
+            policy_id = self.policy_by_hash(payload.get("hash"))
+            return {"success": True, "data": {"policy_id": policy_id}} if policy_id else {"success": True}
+
+        @app.put("/query/policy_id/check")
+        def check(payload: dict = Body(...)):
+            self.calls["check"] += 1
+            return {"success": True, "data": {"policy_id_exists": self.refcount(payload.get("policy_id")) > 0,
+                                              "policy_id_by_hash": self.policy_by_hash(payload.get("hash"))}}
+
+        @app.delete("/query/policy_id/check")
+        def check_exists(payload: dict = Body(...)):
+            self.calls["check_exists"] += 1
+            return {"success": True, "data": {"policy_id_exists": self.refcount(payload.get("policy_id")) > 0}}
+
+        @app.post("/firewall/firewall_profiles/update_policy_id")
+        def update_policy_id(payload: dict = Body(...)):
+            self.calls["update_policy_id"] += 1
+            login = payload.get("login")
+            hash_val = payload.get("hash") or (self.profiles.get(login) or (None,))[0]
+            self.profiles[login] = (hash_val, str(payload.get("policy_id") or ""))
+            return {"success": True}
+
+        return app
+
+    async def serve(self, port: int):
+        import uvicorn
+        server = uvicorn.Server(uvicorn.Config(self.app(), host="127.0.0.1", port=port, log_level="warning"))
+        task = asyncio.create_task(server.serve())
+        while not server.started:
+            if task.done():
+                task.result()
+            await asyncio.sleep(0.05)
+        return server, task
+
+
+def make_users(count: int, profiles: int, nas_ip: str) -> List[dict]:
+    """Synthetic RADIUS sessions: unique IPv4 / IPv6 prefix each, profiles assigned round-robin"""
+    base4, base6 = ipaddress.ip_address("100.64.0.1"), ipaddress.ip_network("2001:db8::/32")
+    users = []
+    for i in range(count):
+        tcp, udp = f"{1000 + i % profiles}", "53"
+        users.append({
+            "user_name": f"bench{i:06d}", "Framed-IP-Address": str(base4 + i),
+            "Delegated-IPv6-Prefix": str(ipaddress.ip_network((int(base6.network_address) + (i << 64), 64))),
+            "NAS-IP-Address": nas_ip, "tcp_rules": tcp, "udp_rules": udp, "hash": profile_hash(tcp, udp),
+        })
+    return users
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+class Bench:
+    def __init__(self, args, stub: Optional[DBStub]):
+        self.args = args
+        self.stub = stub
+        self.client = httpx.AsyncClient(timeout=args.timeout,
+                                        limits=httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency))
+
+    async def _settled(self, action: str, login: str, deadline: float) -> bool:
+        """Debounced AE: wait until the user's flush has run; False if it failed"""
+        while time.perf_counter() < deadline:
+            await asyncio.sleep(self.args.poll)
+            state = (await self.client.get(f"{self.args.ae}/state/{login}")).json()
+            if state.get("pending_signals"):
+                continue
+            if state.get("uncertain"):
+                return False
+            if action == "create" and state.get("applied") is not None:
+                return True
+            if action == "delete" and state.get("applied") is None:
+                return True
+        return False
+
+    async def _one(self, action: str, user: dict, scheduled: float, limiter: asyncio.Semaphore, latencies: List[float],
+                   outcome: Counter):
+        data = dict(user)
+        if action == "delete" and self.stub is not None:
+            data["policy_id"] = (self.stub.profiles.get(user["user_name"]) or (None, None))[1]
+            self.stub.forget(user["user_name"])
+        async with limiter:
+            start = scheduled or time.perf_counter()
+            try:
+                resp = await self.client.post(f"{self.args.ae}/signal", json={"action": action, "data": data})
+                result = resp.json().get("result") or {}
+                if "queued" in result:
+                    ok = await self._settled(action, user["user_name"], start + self.args.timeout)
+                else:
+                    ok = resp.is_success and not result.get("error")
+            except (httpx.HTTPError, ValueError) as e:
+                logger.warning(f"{action} {user['user_name']}: {e}")
+                ok = False
+        latencies.append((time.perf_counter() - start) * 1000)
+        outcome["ok" if ok else "failed"] += 1
+
+    async def phase(self, action: str, users: List[dict]) -> dict:
+        limiter = asyncio.Semaphore(self.args.concurrency)
+        latencies, outcome = [], Counter()
+        start = time.perf_counter()
+        tasks = []
+        for i, user in enumerate(users):
+            scheduled = 0.0
+            if self.args.rate > 0:
+                scheduled = start + i / self.args.rate
+                await asyncio.sleep(max(0.0, scheduled - time.perf_counter()))
+            tasks.append(asyncio.create_task(self._one(action, user, scheduled, limiter, latencies, outcome)))
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - start
+        return {"events": len(users), "ok": outcome["ok"], "failed": outcome["failed"], "seconds": round(elapsed, 3),
+                "events_per_sec": round(len(users) / elapsed, 2) if elapsed else 0.0,
+                **{f"p{p}_ms": round(percentile(latencies, p), 2) for p in (50, 90, 99)},
+                "max_ms": round(max(latencies, default=0.0), 2)}
+
+    async def _stats(self, url: Optional[str]) -> Optional[dict]:
+        if not url:
+            return None
+        try:
+            return (await self.client.get(url)).json()
+        except (httpx.HTTPError, ValueError) as e:
+            return {"error": str(e)}
+
+    async def run(self) -> dict:
+        users = make_users(self.args.users, self.args.profiles, self.args.nas)
+        report = {"users": len(users), "profiles": self.args.profiles, "concurrency": self.args.concurrency,
+                  "rate": self.args.rate, "phases": {}}
+        for action in self.args.phases:
+            logger.info(f"Phase {action}: {len(users)} signals")
+            report["phases"][action] = await self.phase(action, users)
+            logger.info(f"Phase {action}: {report['phases'][action]}")
+        report["fortiapi_sessions"] = await self._stats(f"{self.args.fortiapi}/sessions" if self.args.fortiapi else None)
+        report["emulator"] = await self._stats(f"{self.args.emulator}/emu/stats" if self.args.emulator else None)
+        if self.stub is not None:
+            report["db_stub_calls"] = dict(self.stub.calls)
+        await self.client.aclose()
+        return report
+
+
+def regressions(report: dict, baseline: dict, tolerance: float) -> List[str]:
+    found = []
+    for action, now in report["phases"].items():
+        then = baseline.get("phases", {}).get(action)
+        if not then:
+            continue
+        if now["events_per_sec"] < then["events_per_sec"] * (1 - tolerance):
+            found.append(f"{action}: {now['events_per_sec']} events/s vs baseline {then['events_per_sec']}")
+        if now["p99_ms"] > then["p99_ms"] * (1 + tolerance):
+            found.append(f"{action}: p99 {now['p99_ms']} ms vs baseline {then['p99_ms']}")
+    return found
+
+
+async def _main(args) -> dict:
+    stub, server = None, None
+    if args.db_stub:
+        stub = DBStub()
+        server, task = await stub.serve(args.db_stub)
+    try:
+        return await Bench(args, stub).run()
+    finally:
+        if server is not None:
+            server.should_exit = True
+            await task
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Send signal storms through AE and measure provisioning throughput/latency")
+    parser.add_argument("--ae", default=st.config.ae_url, help="AE base URL")
+    parser.add_argument("--fortiapi", default=st.config.fortiapi_url, help="fortiapi base URL for session stats ('' = skip)")
+    parser.add_argument("--emulator", default="", help="mhe_fgemu base URL for its stats")
+    parser.add_argument("--nas", default=next(iter(st.FORTI_GATE), ""), help="NAS-IP-Address of the signals")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--profiles", type=int, default=20, help="distinct port profiles (policies)")
+    parser.add_argument("--concurrency", type=int, default=64, help="signals in flight")
+    parser.add_argument("--rate", type=float, default=0.0, help="signals/s, open loop (0 = as fast as --concurrency allows)")
+    parser.add_argument("--phases", type=lambda s: [p for p in s.split(",") if p in PHASES], default=list(PHASES))
+    parser.add_argument("--timeout", type=float, default=60.0, help="seconds one signal may take to settle")
+    parser.add_argument("--poll", type=float, default=0.05, help="/state poll interval with debounced AE")
+    parser.add_argument("--db-stub", type=int, default=0, metavar="PORT", help="serve in-memory mhe_db endpoints on PORT")
+    parser.add_argument("--json", action="store_true", help="print the full report as JSON")
+    parser.add_argument("--save", help="write the report to this file (baseline for later runs)")
+    parser.add_argument("--baseline", help="report of an earlier run to compare against")
+    parser.add_argument("--max-regression", type=float, default=0.1, help="tolerated throughput drop / p99 growth")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+    if not args.nas:
+        parser.error("--nas is required when FORTI_GATE is not configured")
+
+    report = asyncio.run(_main(args))
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for action, r in report["phases"].items():
+            print(f"{action:7} {r['events']} events in {r['seconds']} s: {r['events_per_sec']} events/s, "
+                  f"p50 {r['p50_ms']} / p90 {r['p90_ms']} / p99 {r['p99_ms']} / max {r['max_ms']} ms, {r['failed']} failed")
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(report, json.load(f), args.max_regression)
+        for line in found:
+            logger.error(f"Regression: {line}")
+        if found:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
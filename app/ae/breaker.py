@@ -0,0 +1,148 @@
+import asyncio
+import logging
+import threading
+import time
+from collections import deque
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from app.config.env import st
+
+logger = logging.getLogger("mhe_ae.breaker")
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+
+class CircuitBreaker:
+    """Failure/latency breaker for one FortiGate.
+
+    Closed: calls go through; the outcome of the last AE_BREAKER_WINDOW calls
+    is kept (a call slower than AE_BREAKER_SLOW_MS counts as a failure).
+    Opens on AE_BREAKER_CONSECUTIVE failures in a row or once the failure
+    rate over at least AE_BREAKER_MIN_CALLS calls reaches
+    AE_BREAKER_FAILURE_RATE. Open: skipped; after AE_BREAKER_OPEN_SECONDS it
+    becomes half-open and a single trial (background probe or real call)
+    decides: success closes it, failure opens it again.
+    """
+
+    def __init__(self, fg: str):
+        self.fg = fg
+        self.state = CLOSED
+        self._window = deque(maxlen=st.AE_BREAKER_WINDOW)
+        self._consecutive = 0
+        self._opened_at = 0.0
+        self._trial = False
+        self._lock = threading.Lock()
+        self.stats = {"calls": 0, "failures": 0, "slow": 0, "opened": 0, "skipped": 0, "last_ms": None, "last_error": None}
+
+    def _open(self, reason: str):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self._trial = False
+        self.stats["opened"] += 1
+        logger.warning(f"Breaker for FG {self.fg} OPEN: {reason}")
+
+    def _maybe_half_open(self):
+        if self.state == OPEN and time.monotonic() - self._opened_at >= st.AE_BREAKER_OPEN_SECONDS:
+            self.state = HALF_OPEN
+            self._trial = False
+            logger.info(f"Breaker for FG {self.fg} half-open")
+
+    def acquire(self) -> bool:
+        """May a call go to this FG now? Half-open lets exactly one trial through."""
+        with self._lock:
+            self._maybe_half_open()
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._trial:
+                self._trial = True
+                return True
+            self.stats["skipped"] += 1
+            return False
+
+    def release(self):
+        """Give back a half-open trial that was acquired but not used"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trial = False
+
+    def record(self, ok: bool, ms: float, error: str = None):
+        with self._lock:
+            slow = ok and ms > st.AE_BREAKER_SLOW_MS
+            failed = not ok or slow
+            s = self.stats
+            s["calls"] += 1
+            s["failures"] += 0 if ok else 1
+            s["slow"] += 1 if slow else 0
+            s["last_ms"] = round(ms, 2)
+            if not ok:
+                s["last_error"] = error
+            if self.state == HALF_OPEN:
+                if failed:
+                    self._open(f"trial failed ({error or f'{ms:.0f} ms'})")
+                else:
+                    self.state = CLOSED
+                    self._trial = False
+                    self._window.clear()
+                    self._consecutive = 0
+                    logger.info(f"Breaker for FG {self.fg} closed")
+                return
+            if self.state == OPEN:
+                return
+            self._window.append(failed)
+            self._consecutive = self._consecutive + 1 if failed else 0
+            if self._consecutive >= st.AE_BREAKER_CONSECUTIVE:
+                self._open(f"{self._consecutive} consecutive failures ({error or 'slow'})")
+            elif len(self._window) >= st.AE_BREAKER_MIN_CALLS:
+                rate = sum(self._window) / len(self._window)
+                if rate >= st.AE_BREAKER_FAILURE_RATE:
+                    self._open(f"failure rate {rate:.0%} over {len(self._window)} calls")
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            self._maybe_half_open()
+            window = list(self._window)
+            return {
+                "state": self.state,
+                "failure_rate": round(sum(window) / len(window), 3) if window else 0.0,
+                "open_for_s": round(time.monotonic() - self._opened_at, 1) if self.state != CLOSED else 0.0,
+                **self.stats,
+            }
+
+
+class BreakerRegistry:
+    def __init__(self):
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._lock = threading.Lock()
+
+    def get(self, fg: str) -> CircuitBreaker:
+        breaker = self._breakers.get(fg)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(fg, CircuitBreaker(fg))
+        return breaker
+
+    def available(self, fg_addr: List[str]) -> List[str]:
+        """FGs to try, in config order, open ones left out"""
+        return [fg for fg in fg_addr if self.get(fg).acquire()]
+
+    async def probe_loop(self, fgs: List[str], probe: Callable[[str], Awaitable[Tuple[bool, float, str]]]):
+        """Background task: probe open FGs once their open period is over, so recovery needs no live traffic"""
+        for fg in fgs:
+            self.get(fg)
+        while True:
+            await asyncio.sleep(st.AE_BREAKER_PROBE_INTERVAL)
+            for breaker in list(self._breakers.values()):
+                if breaker.state == CLOSED or not breaker.acquire():
+                    continue
+                try:
+                    ok, ms, error = await probe(breaker.fg)
+                except Exception as e:
+                    ok, ms, error = False, 0.0, str(e)
+                breaker.record(ok, ms, error)
+
+    def snapshot(self) -> dict:
+        return {fg: b.snapshot() for fg, b in list(self._breakers.items())}
+
+
+# Process-wide breakers, one per FortiGate management address
+breakers = BreakerRegistry()
@@ -0,0 +1,191 @@
+import asyncio
+import logging
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from app.config.env import st
+
+logger = logging.getLogger("mhe_ae.coalesce")
+
+# RADIUS_Sessions column names (signals built from mhe_db rows) → RADIUS attribute names used by AE
+_ATTR_NAMES = {
+    "User_Name": "User-Name",
+    "Framed_IP_Address": "Framed-IP-Address",
+    "Delegated_IPv6_Prefix": "Delegated-IPv6-Prefix",
+    "NAS_IP_Address": "NAS-IP-Address",
+}
+
+
+def normalize(data: dict) -> dict:
+    """One key set for every signal source (RADIUS attrs, mhe_db session rows, manual calls)"""
+    data = dict(data)
+    for column, attr in _ATTR_NAMES.items():
+        if column in data and not data.get(attr):
+            data[attr] = data[column]
+    user = data.get("user_name") or data.get("login") or data.get("User-Name")
+    if user:
+        data["user_name"] = user
+    return data
+
+
+def _address(data: dict) -> Tuple:
+    return (data.get("Framed-IP-Address") or data.get("ip"), data.get("Delegated-IPv6-Prefix") or data.get("ipv6"),
+            data.get("NAS-IP-Address"))
+
+
+class UserState:
+    """What FortiGate has for one user (`applied`, None = nothing) and what it should have (`desired`).
+    `uncertain`: the last operation failed, FortiGate may hold `applied` only in part."""
+
+    __slots__ = ("applied", "known", "uncertain", "desired", "signals", "handle", "lock")
+
+    def __init__(self):
+        self.applied: Optional[dict] = None
+        self.known = False
+        self.uncertain = False
+        self.desired: Optional[dict] = None
+        self.signals = 0
+        self.handle = None
+        self.lock = asyncio.Lock()
+
+
+class Coalescer:
+    """Per-user debounce of AE signals with desired-state reconciliation.
+
+    Signals for a user only update its desired state; AE_DEBOUNCE_SECONDS
+    after the first pending signal the net change is planned against the
+    last state AE applied and only those operations run (start+stop within
+    the window runs nothing). A user's flushes never overlap. When AE has no
+    applied state for a user (restart) the first pending signal tells what
+    FortiGate had: create → nothing, edit/delete → the old profile. After a
+    failed operation the state it started from (or, for a create, the one it
+    aimed at) is kept as uncertain and the next flush replays from there.
+    """
+
+    def __init__(self, apply: Callable[[str, dict], Awaitable[dict]]):
+        self._apply = apply
+        self._users: Dict[str, UserState] = {}
+        self._tasks = set()
+        self.stats = {"signals": 0, "flushes": 0, "operations": 0, "noops": 0, "failed": 0}
+
+    def submit(self, action: str, data: dict) -> bool:
+        """Queue one signal; False if it has no user to key on"""
+        data = normalize(data)
+        login = data.get("user_name")
+        if not login or action not in ("create", "edit", "delete"):
+            return False
+        state = self._users.get(login)
+        if state is None:
+            state = self._users[login] = UserState()
+        if not state.known and state.signals == 0:
+            # Implied FortiGate state before this signal
+            if action == "create":
+                state.applied = None
+            else:
+                state.applied = dict(data, hash=data.get("old_hash") or data.get("hash")) if action == "edit" else dict(data)
+            state.known = True
+        state.desired = None if action == "delete" else data
+        state.signals += 1
+        self.stats["signals"] += 1
+        if state.handle is None:
+            state.handle = asyncio.get_running_loop().call_later(st.AE_DEBOUNCE_SECONDS, self._spawn, login)
+        return True
+
+    def _spawn(self, login: str):
+        task = asyncio.create_task(self._flush(login))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    @staticmethod
+    def plan(applied: Optional[dict], desired: Optional[dict], uncertain: bool = False) -> List[Tuple[str, dict]]:
+        """Minimal operations that take FortiGate from `applied` to `desired`.
+        `uncertain`: `applied` may be there only in part, so reaching it is not a no-op (every
+        operation tolerates objects that already exist / are already gone)."""
+        if applied is None and desired is None:
+            return []
+        if applied is None:
+            return [("create", desired)]
+        if desired is None:
+            # What AE applied, not the stop signal: a RADIUS stop carries no policy_id/hash
+            return [("delete", applied)]
+        if _address(applied) != _address(desired):
+            # New session address: addresses are per user, re-provision from scratch
+            return [("delete", applied), ("create", desired)]
+        if applied.get("hash") != desired.get("hash"):
+            if uncertain and not applied.get("policy_id"):
+                # Failed create: no policy to migrate from, start over
+                return [("delete", applied), ("create", desired)]
+            return [("edit", dict(desired, old_hash=applied.get("hash"), policy_id=applied.get("policy_id")))]
+        # Already there, unless the last attempt failed: replay it
+        return [("create", desired)] if uncertain else []
+
+    async def _flush(self, login: str):
+        state = self._users.get(login)
+        if state is None:
+            return
+        async with state.lock:
+            state.handle = None
+            desired, signals = state.desired, state.signals
+            state.signals = 0
+            ops = self.plan(state.applied, desired, state.uncertain)
+            self.stats["flushes"] += 1
+            if not ops:
+                self.stats["noops"] += 1
+                logger.info(f"{login}: {signals} signal(s) coalesced, FortiGate already in desired state")
+            else:
+                logger.info(f"{login}: {signals} signal(s) coalesced into {[op for op, _ in ops]}")
+            for action, data in ops:
+                self.stats["operations"] += 1
+                start = time.perf_counter()
+                try:
+                    result = await self._apply(action, data) or {}
+                except Exception as e:
+                    result = {"error": str(e)}
+                if result.get("error"):
+                    # Possibly applied in part: keep what FortiGate may hold (for a create, what it aimed at;
+                    # otherwise the state it started from) and replay from there on the next flush
+                    self.stats["failed"] += 1
+                    state.uncertain = True
+                    if action == "create":
+                        state.applied = dict(data)
+                    logger.error(f"{login}: {action} failed after {(time.perf_counter() - start) * 1000:.0f} ms: {result['error']}")
+                    break
+                state.uncertain = False
+                if action == "delete":
+                    state.applied = None
+                else:
+                    policy_id = result.get("new_policy_id") or result.get("policy_id") or data.get("policy_id")
+                    state.applied = dict(data, policy_id=policy_id)
+            # Forget users with nothing on FortiGate and nothing pending
+            if state.known and state.applied is None and state.signals == 0 and state.handle is None:
+                self._users.pop(login, None)
+
+    def busy(self, login: str) -> bool:
+        """Signals pending or an operation running for this user"""
+        state = self._users.get(login)
+        return state is not None and (state.handle is not None or state.lock.locked())
+
+    def reset(self, login: str):
+        """Forget what AE believes FortiGate has for an idle user (reconciler found it absent)"""
+        state = self._users.get(login)
+        if state is not None and not self.busy(login):
+            self._users.pop(login, None)
+
+    def pending(self) -> int:
+        return sum(1 for s in self._users.values() if s.handle is not None)
+
+    def snapshot(self, login: str) -> Optional[dict]:
+        state = self._users.get(login)
+        if state is None:
+            return None
+        return {"applied": state.applied, "known": state.known, "uncertain": state.uncertain, "desired": state.desired,
+                "pending_signals": state.signals}
+
+    async def drain(self):
+        """Shutdown: run every pending flush now"""
+        for login, state in list(self._users.items()):
+            if state.handle is not None:
+                state.handle.cancel()
+                self._spawn(login)
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
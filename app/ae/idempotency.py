@@ -0,0 +1,111 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple
+
+from app.config.env import st
+
+logger = logging.getLogger("mhe_ae.idempotency")
+
+Key = Tuple[str, str, Optional[str], Tuple]
+
+
+def operation_key(action: str, data: dict) -> Optional[Key]:
+    """(action, login, hash, session) of a normalized signal; None if it has no user"""
+    login = data.get("user_name") or data.get("login")
+    if not login:
+        return None
+    session = (data.get("Framed-IP-Address") or data.get("ip"), data.get("Delegated-IPv6-Prefix") or data.get("ipv6"),
+               data.get("NAS-IP-Address"))
+    return action, login, data.get("hash"), session
+
+
+class IdempotencyStore:
+    """Completed and in-flight AE operations by operation key, bounded (LRU) with a TTL.
+
+    A duplicate of a completed operation gets its stored result; a duplicate
+    arriving while the first one runs awaits the same future. Only successful
+    results are kept, so a failed operation is retried by the next signal.
+    Completing an operation for a user, successfully or not, drops that user's
+    other stored results: create → delete → create with the same key runs all
+    three, even when the delete failed half way.
+    """
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._done: "OrderedDict[Key, Tuple[float, dict]]" = OrderedDict()
+        self._by_login: Dict[str, set] = {}
+        self._inflight: Dict[Key, asyncio.Future] = {}
+        self.stats = {"executed": 0, "replayed": 0, "joined": 0, "evicted": 0}
+
+    def _drop(self, key: Key):
+        self._done.pop(key, None)
+        keys = self._by_login.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_login[key[1]]
+
+    def _store(self, key: Key, result: dict):
+        self._done[key] = (time.monotonic() + self.ttl, result)
+        self._by_login.setdefault(key[1], set()).add(key)
+        while len(self._done) > self.max_entries:
+            self._drop(next(iter(self._done)))
+            self.stats["evicted"] += 1
+
+    def forget(self, login: str):
+        """Drop a user's stored results (its FortiGate objects are known to be gone)"""
+        for key in list(self._by_login.get(login, ())):
+            self._drop(key)
+
+    def lookup(self, key: Key) -> Optional[dict]:
+        entry = self._done.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            self._drop(key)
+            return None
+        self._done.move_to_end(key)
+        return entry[1]
+
+    async def run(self, key: Optional[Key], operation: Callable[[], Awaitable[dict]]) -> dict:
+        if key is None or self.ttl <= 0:
+            return await operation()
+        stored = self.lookup(key)
+        if stored is not None:
+            self.stats["replayed"] += 1
+            logger.info(f"Duplicate {key[0]} for {key[1]}: returning stored result")
+            return dict(stored, duplicate=True)
+        inflight = self._inflight.get(key)
+        if inflight is not None:
+            self.stats["joined"] += 1
+            logger.info(f"Duplicate {key[0]} for {key[1]}: joining the in-flight operation")
+            return dict(await asyncio.shield(inflight), duplicate=True)
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        self.stats["executed"] += 1
+        try:
+            result = await operation() or {}
+        except Exception as e:
+            result = {"error": str(e)}
+        except BaseException:
+            # Cancelled: joined duplicates are cancelled with it
+            future.cancel()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+            # The user's FortiGate objects may have changed either way: earlier results no longer hold
+            self.forget(key[1])
+        if not result.get("error"):
+            self._store(key, result)
+        future.set_result(result)
+        return result
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "stored": len(self._done), "in_flight": len(self._inflight)}
+
+
+# Process-wide store for AE signal handlers
+operations = IdempotencyStore(st.AE_IDEMPOTENCY_TTL, st.AE_IDEMPOTENCY_MAX)
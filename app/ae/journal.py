@@ -0,0 +1,248 @@
+import asyncio
+import itertools
+import json
+import logging
+import os
+import uuid
+from contextvars import ContextVar
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import httpx
+
+from app.config.env import st
+from app.ae.shard import sharding
+
+logger = logging.getLogger("mhe_ae.journal")
+
+# PolicyLogs columns (k8s-manifests/starrocks/create_database.sql); journal records use the same keys
+COLUMNS = ("event_time", "op_id", "seq", "replica", "kind", "action", "login", "fg", "workflow", "step",
+           "ok", "ms", "policy_id", "hash", "detail")
+
+# Journal operation of the current signal (set per operation by the AE handlers)
+current_op: ContextVar[Optional[str]] = ContextVar("current_op", default=None)
+
+
+def _row(record: dict) -> dict:
+    row = {c: record.get(c) for c in COLUMNS}
+    if "data" in record:
+        row["detail"] = json.dumps(record["data"], ensure_ascii=False, default=str)
+    if isinstance(row["ok"], bool):
+        row["ok"] = int(row["ok"])
+    return row
+
+
+class Journal:
+    """Append-only local log of AE operations: begin, every FortiGate attempt and step, end.
+
+    Records are appended to AE_JOURNAL_DIR/ae.jsonl on the hot path (one buffered
+    write each) and shipped to the PolicyLogs table by a background task in Stream
+    Loads of up to AE_JOURNAL_BATCH records; the shipped offset is kept next to the
+    file, and the load label is derived from it, so a load retried after a crash is
+    not applied twice. An operation with a begin and no end was cut off by a
+    restart: `open()` returns those for the caller to resume.
+    """
+
+    def __init__(self, directory: str):
+        self.enabled = bool(directory)
+        self._dir = Path(directory) if directory else None
+        self._file = None
+        self._generation = ""
+        self._shipped = 0
+        self._seq = itertools.count()
+        # op_id → begin record of operations not finished yet
+        self._open: Dict[str, dict] = {}
+        self._client: Optional[httpx.AsyncClient] = None
+        self._lock = asyncio.Lock()
+        self.stats = {"records": 0, "loads": 0, "rows_loaded": 0, "load_failures": 0, "rotations": 0,
+                      "write_errors": 0, "last_error": None}
+
+    @property
+    def _path(self) -> Path:
+        return self._dir / "ae.jsonl"
+
+    @property
+    def _offset_path(self) -> Path:
+        return self._dir / "ae.offset"
+
+    def _save_offset(self):
+        tmp = self._offset_path.with_name("ae.offset.tmp")
+        tmp.write_text(json.dumps({"generation": self._generation, "offset": self._shipped}))
+        os.replace(tmp, self._offset_path)
+
+    def open(self) -> List[dict]:
+        """Startup: reopen the journal; begin records of operations left unfinished, oldest first"""
+        if not self.enabled:
+            return []
+        self._dir.mkdir(parents=True, exist_ok=True)
+        data = self._path.read_bytes() if self._path.exists() else b""
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            # Torn last write: the record never made it
+            with open(self._path, "r+b") as f:
+                f.truncate(end)
+            data = data[:end]
+        for line in data.splitlines():
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("kind") == "begin":
+                self._open[record["op_id"]] = record
+            elif record.get("kind") == "end":
+                self._open.pop(record.get("op_id"), None)
+        try:
+            saved = json.loads(self._offset_path.read_text())
+            self._generation, self._shipped = saved["generation"], min(int(saved["offset"]), end)
+        except (OSError, ValueError, KeyError):
+            self._generation, self._shipped = uuid.uuid4().hex[:12], 0
+            self._save_offset()
+        self._file = open(self._path, "ab")
+        if self._open:
+            logger.warning(f"Journal: {len(self._open)} operation(s) interrupted by the last shutdown")
+        return list(self._open.values())
+
+    def append(self, kind: str, op_id: Optional[str], **fields) -> Optional[dict]:
+        if self._file is None:
+            return None
+        record = {"event_time": datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f"), "op_id": op_id,
+                  "seq": next(self._seq), "replica": sharding.self_addr, "kind": kind, **fields}
+        try:
+            self._file.write(json.dumps(record, ensure_ascii=False, default=str).encode() + b"\n")
+            self._file.flush()
+        except OSError as e:
+            self.stats["write_errors"] += 1
+            logger.error(f"Journal write failed: {e}")
+            return None
+        self.stats["records"] += 1
+        return record
+
+    def begin(self, action: str, data: dict) -> str:
+        op_id = uuid.uuid4().hex
+        record = self.append("begin", op_id, action=action, login=data.get("user_name") or data.get("login"),
+                             hash=data.get("hash"), policy_id=data.get("policy_id"), data=data)
+        if record is not None:
+            self._open[op_id] = record
+        current_op.set(op_id)
+        return op_id
+
+    def attempt(self, fg: str, workflow: str, result: Optional[dict], ok: bool, failed: Optional[str], hooks=()):
+        """One FortiGate attempt of the current operation: its fortiapi steps, membership hooks, outcome"""
+        op_id = current_op.get()
+        for s in (result or {}).get("steps") or []:
+            self.append("step", op_id, fg=fg, workflow=workflow, step=s.get("step"), ok=s.get("ok"), ms=s.get("ms"))
+        for name, hook in hooks:
+            if hook is not None:
+                self.append("step", op_id, fg=fg, workflow=workflow, step=name, ok=bool(hook.get("ok")),
+                            ms=hook.get("ms"), detail=hook.get("error"))
+        self.append("attempt", op_id, fg=fg, workflow=workflow, ok=ok, ms=(result or {}).get("ms"),
+                    policy_id=(result or {}).get("policy_id"), detail=failed)
+
+    def end(self, op_id: str, result: dict, ms: float, detail: Optional[str] = None):
+        begin = self._open.pop(op_id, None) or {}
+        self.append("end", op_id, action=begin.get("action"), login=begin.get("login"), hash=begin.get("hash"),
+                    ok=not result.get("error"), ms=round(ms, 2), fg=result.get("fg_used"),
+                    policy_id=result.get("new_policy_id") or result.get("policy_id") or begin.get("policy_id"),
+                    detail=detail or result.get("error"))
+
+    def _read(self, start: int, limit: int):
+        """Up to `limit` complete records from byte `start` on; (rows, end offset)"""
+        rows, pos = [], start
+        with open(self._path, "rb") as f:
+            f.seek(start)
+            for line in f:
+                if not line.endswith(b"\n") or len(rows) >= limit:
+                    break
+                pos += len(line)
+                try:
+                    rows.append(_row(json.loads(line)))
+                except ValueError:
+                    continue
+        return rows, pos
+
+    async def _load(self, rows: List[dict], label: str) -> bool:
+        cfg = st.starrocks_config
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=10.0)
+        url = f"http://{cfg.get('host', '127.0.0.1')}:{cfg.get('port', 9030)}/api/{cfg.get('database', 'RADIUS')}/PolicyLogs/_stream_load"
+        try:
+            resp = await self._client.put(url, auth=(cfg.get("user", "root"), cfg.get("password", "")), headers={
+                "label": label, "format": "json", "strip_outer_array": "true", "Expect": "100-continue",
+            }, content=json.dumps(rows, ensure_ascii=False).encode(), follow_redirects=True)
+            result = resp.json() if resp.status_code == 200 else {}
+        except Exception as e:
+            result = {"Message": str(e)}
+        # Same label again (load retried after a crash before the offset was saved): already in the table
+        if result.get("Status") in ("Success", "Publish Timeout") or result.get("ExistingJobStatus") == "FINISHED":
+            return True
+        self.stats["last_error"] = result.get("Message") or result.get("Status") or "stream load failed"
+        return False
+
+    async def flush(self) -> int:
+        """Ship everything appended so far; rows loaded"""
+        if self._file is None:
+            return 0
+        loaded = 0
+        async with self._lock:
+            while True:
+                rows, end = await asyncio.to_thread(self._read, self._shipped, st.AE_JOURNAL_BATCH)
+                if not rows:
+                    self._shipped = max(self._shipped, end)
+                    break
+                if not await self._load(rows, f"policylogs_{self._generation}_{self._shipped}"):
+                    self.stats["load_failures"] += 1
+                    logger.error(f"Journal: Stream Load of {len(rows)} records failed: {self.stats['last_error']}")
+                    break
+                self._shipped = end
+                self._save_offset()
+                loaded += len(rows)
+                self.stats["loads"] += 1
+                self.stats["rows_loaded"] += len(rows)
+            if self._shipped >= self._file.tell() and self._shipped > st.AE_JOURNAL_MAX_BYTES:
+                self._rotate()
+        return loaded
+
+    def _rotate(self):
+        """Start a new file once everything is shipped; open operations' begin records move over (not shipped again)"""
+        carried = b"".join(json.dumps(r, ensure_ascii=False, default=str).encode() + b"\n" for r in self._open.values())
+        tmp = self._path.with_name("ae.jsonl.tmp")
+        tmp.write_bytes(carried)
+        self._generation, self._shipped = uuid.uuid4().hex[:12], len(carried)
+        self._save_offset()
+        self._file.close()
+        os.replace(tmp, self._path)
+        self._file = open(self._path, "ab")
+        self.stats["rotations"] += 1
+        logger.info(f"Journal rotated ({len(self._open)} open operation(s) carried over)")
+
+    async def flush_loop(self):
+        """Background task: ship new records every AE_JOURNAL_FLUSH_INTERVAL seconds"""
+        while True:
+            await asyncio.sleep(st.AE_JOURNAL_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Journal flush failed: {e}")
+
+    async def close(self):
+        if self._file is None:
+            return
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.error(f"Journal flush on shutdown failed: {e}")
+        self._file.close()
+        self._file = None
+        if self._client is not None:
+            await self._client.aclose()
+
+    def snapshot(self) -> dict:
+        if self._file is None:
+            return {"enabled": self.enabled}
+        return {"enabled": True, **self.stats, "open_operations": len(self._open),
+                "unshipped_bytes": self._file.tell() - self._shipped}
+
+
+# Process-wide journal of this AE replica
+journal = Journal(st.AE_JOURNAL_DIR)
@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from typing import Awaitable, Callable, Dict, List, Tuple
+
+from app.config.env import st
+from app.ae.scheduler import current_priority
+
+logger = logging.getLogger("mhe_ae.membership")
+
+
+class _Batch:
+    __slots__ = ("v4", "v6", "waiters", "priority", "handle")
+
+    def __init__(self):
+        # member name → wanted in the policy (the last change within the window wins)
+        self.v4: Dict[str, bool] = {}
+        self.v6: Dict[str, bool] = {}
+        self.waiters: List[asyncio.Future] = []
+        self.priority = None
+        self.handle = None
+
+
+class MembershipBatcher:
+    """Per (FortiGate, policy) batching window for srcaddr/srcaddr6 changes.
+
+    Users joining or leaving the same policy within AE_MEMBERSHIP_WINDOW
+    seconds (or until AE_MEMBERSHIP_MAX changes pile up) are applied as one
+    read + one write of the policy. Batches of one policy never overlap;
+    every caller gets the outcome of the write that carried its change.
+    """
+
+    def __init__(self, send: Callable[[str, str, dict, int], Awaitable[dict]]):
+        self._send = send
+        self._pending: Dict[Tuple[str, str], _Batch] = {}
+        self._locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        self._tasks = set()
+        self.stats = {"changes": 0, "writes": 0, "failed": 0, "largest": 0}
+
+    async def change(self, fg: str, policy_id: str, add=(), add6=(), remove=(), remove6=()) -> dict:
+        key = (fg, str(policy_id))
+        batch = self._pending.get(key)
+        if batch is None:
+            batch = self._pending[key] = _Batch()
+            batch.handle = asyncio.get_running_loop().call_later(st.AE_MEMBERSHIP_WINDOW, self._spawn, key, batch)
+        for names, members, wanted in ((add, batch.v4, True), (remove, batch.v4, False),
+                                       (add6, batch.v6, True), (remove6, batch.v6, False)):
+            for name in names:
+                members[name] = wanted
+        priority = current_priority.get()
+        batch.priority = priority if batch.priority is None else min(batch.priority, priority)
+        future = asyncio.get_running_loop().create_future()
+        batch.waiters.append(future)
+        self.stats["changes"] += 1
+        if len(batch.v4) + len(batch.v6) >= st.AE_MEMBERSHIP_MAX:
+            batch.handle.cancel()
+            self._spawn(key, batch)
+        return await asyncio.shield(future)
+
+    def _spawn(self, key, batch: _Batch):
+        if self._pending.get(key) is batch:
+            # Closed for new changes from here on
+            del self._pending[key]
+        task = asyncio.create_task(self._flush(key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _flush(self, key, batch: _Batch):
+        fg, policy_id = key
+        lock = self._locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            patch = {
+                "add": [n for n, w in batch.v4.items() if w], "remove": [n for n, w in batch.v4.items() if not w],
+                "add6": [n for n, w in batch.v6.items() if w], "remove6": [n for n, w in batch.v6.items() if not w],
+            }
+            self.stats["writes"] += 1
+            self.stats["largest"] = max(self.stats["largest"], len(batch.waiters))
+            try:
+                result = await self._send(fg, policy_id, patch, batch.priority) or {"ok": False}
+            except Exception as e:
+                result = {"ok": False, "error": str(e)}
+            if not result.get("ok"):
+                self.stats["failed"] += 1
+                logger.error(f"Membership update of policy {policy_id} on {fg} failed ({len(batch.waiters)} users): {result.get('error')}")
+            else:
+                logger.info(f"Policy {policy_id} on {fg}: {len(batch.waiters)} membership change(s) in one update")
+        for future in batch.waiters:
+            if not future.done():
+                future.set_result(result)
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "open_batches": len(self._pending)}
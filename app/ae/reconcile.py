@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import re
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set
+
+from app.config.env import st
+
+logger = logging.getLogger("mhe_ae.reconcile")
+
+# Services and policies AE creates are named after the profile hash (md5 hex)
+MANAGED_NAME = re.compile(r"^[0-9a-f]{32}$")
+# ... and, with FG_PROVISION_MODE=groups, the address groups of a hash: <hash>_g (addrgrp), <hash>_g6 (addrgrp6)
+MANAGED_GROUP = re.compile(r"^[0-9a-f]{32}_g6?$")
+# Built-in address standing in for an empty member list
+NONE_ADDRESS = "none"
+
+
+def _names(items) -> List[str]:
+    return [i.get("name") for i in items or [] if i.get("name")]
+
+
+def _ip(subnet) -> Optional[str]:
+    """"10.0.0.1 255.255.255.255" (string or list form) → "10.0.0.1" """
+    if isinstance(subnet, list):
+        return subnet[0] if subnet else None
+    return str(subnet).split()[0] if subnet else None
+
+
+def _login(member: str, table: str) -> str:
+    return member[:-2] if table == "addrgrp6" and member.endswith("v6") else member
+
+
+def plan_fg(tables: dict, expected: Dict[str, dict], known: Set[str], busy: Set[str],
+            referenced: Set[str] = frozenset()) -> List[dict]:
+    """Corrective operations for one FortiGate snapshot, in safe order.
+
+    `expected`: users whose objects belong here (online, profile, NAS mapped to this FG);
+    `known`: every profile login; `busy`: users AE is working on right now (left alone);
+    `referenced`: policy ids and hashes FW_Profiles still points at.
+    Only objects AE manages are touched: hash-named services/policies and addresses named
+    after a profile login or referenced by a managed policy or group. Addresses still
+    referenced by any other policy are never deleted; a policy a profile references is
+    emptied (srcaddr "none") instead of deleted, the next login reuses it.
+    """
+    policies = tables.get("policy") or []
+    managed = [p for p in policies if MANAGED_NAME.match(str(p.get("name") or ""))]
+    unmanaged_refs = set()
+    for p in policies:
+        if MANAGED_NAME.match(str(p.get("name") or "")):
+            continue
+        for field in ("srcaddr", "srcaddr6", "dstaddr", "dstaddr6", "service"):
+            unmanaged_refs.update(_names(p.get(field)))
+
+    groups = {}
+    for table in ("addrgrp", "addrgrp6"):
+        for g in tables.get(table) or []:
+            name = str(g.get("name") or "")
+            if MANAGED_GROUP.match(name):
+                groups[name] = (table, [m for m in _names(g.get("member")) if m != NONE_ADDRESS])
+
+    candidates = set(known)
+    for p in managed:
+        candidates.update(n for n in _names(p.get("srcaddr")) if n not in groups)
+        candidates.update(n[:-2] for n in _names(p.get("srcaddr6")) if n.endswith("v6"))
+    for table, members in groups.values():
+        candidates.update(_login(m, table) for m in members)
+    candidates.discard(NONE_ADDRESS)
+
+    def orphan(login: str) -> bool:
+        return login in candidates and login not in expected and login not in busy
+
+    def kept_members(group: str) -> List[str]:
+        table, members = groups[group]
+        return [m for m in members if not orphan(_login(m, table))]
+
+    ops, used_services, used_groups = [], set(unmanaged_refs), set(unmanaged_refs)
+    for p in managed:
+        policy_id = str(p.get("policyid"))
+        refs = [n for n in _names(p.get("srcaddr")) + _names(p.get("srcaddr6")) if n in groups]
+        src = [n for n in _names(p.get("srcaddr")) if n not in groups and n != NONE_ADDRESS]
+        src6 = [n for n in _names(p.get("srcaddr6")) if n not in groups]
+        keep = [n for n in src if not orphan(n)]
+        keep6 = [n for n in src6 if not (n.endswith("v6") and orphan(n[:-2]))]
+        pinned = policy_id in referenced or p.get("name") in referenced
+        if not pinned and not keep and not keep6 and not any(kept_members(g) for g in refs):
+            ops.append({"op": "delete_policy", "policy_id": policy_id, "name": p.get("name")})
+            ops.extend({"op": "delete_group", "table": groups[g][0], "name": g} for g in refs if g not in unmanaged_refs)
+            used_groups.update(refs)
+            continue
+        used_services.update(_names(p.get("service")))
+        used_groups.update(refs)
+        for g in refs:
+            kept = kept_members(g)
+            if kept != groups[g][1]:
+                ops.append({"op": "set_group_members", "table": groups[g][0], "name": g, "members": kept or [NONE_ADDRESS]})
+        if len(keep) != len(src) or len(keep6) != len(src6):
+            if not keep and not refs:
+                # srcaddr can't be empty
+                keep = [NONE_ADDRESS]
+            ops.append({"op": "set_policy_members", "policy_id": policy_id,
+                        "srcaddr": keep + [g for g in refs if groups[g][0] == "addrgrp"],
+                        "srcaddr6": keep6 + [g for g in refs if groups[g][0] == "addrgrp6"]})
+
+    # Groups no managed policy references any more (its policy was deleted elsewhere)
+    for g in groups:
+        if g not in used_groups:
+            kept = kept_members(g)
+            if not kept:
+                ops.append({"op": "delete_group", "table": groups[g][0], "name": g})
+            elif kept != groups[g][1]:
+                ops.append({"op": "set_group_members", "table": groups[g][0], "name": g, "members": kept})
+
+    expected_hashes = {row.get("hash") for row in expected.values()}
+    for name in _names(tables.get("service")):
+        if MANAGED_NAME.match(name) and name not in used_services and name not in expected_hashes:
+            ops.append({"op": "delete_service", "name": name})
+
+    addresses = {a.get("name"): a for a in tables.get("address") or []}
+    for name in addresses:
+        if orphan(name) and name not in unmanaged_refs:
+            ops.append({"op": "delete_ip", "name": name})
+    for a in tables.get("address6") or []:
+        name = a.get("name") or ""
+        if name.endswith("v6") and orphan(name[:-2]) and name not in unmanaged_refs:
+            ops.append({"op": "delete_ipv6", "name": name[:-2]})
+
+    # Address of an online user that still points at an old session IP
+    for login, row in expected.items():
+        a = addresses.get(login)
+        if a and row.get("ip") and login not in busy and _ip(a.get("subnet")) != row["ip"]:
+            ops.append({"op": "update_ip", "name": login, "ip": row["ip"]})
+    return ops
+
+
+class Reconciler:
+    """Periodic drift repair: bulk FortiGate snapshots diffed against FW_Profiles + RADIUS_Sessions.
+
+    Snapshots are taken before the desired state is read, so an object created for a
+    session that starts mid-run is already backed by its session row. Corrective
+    operations run at most AE_RECONCILE_OPS_PER_SEC and AE_RECONCILE_MAX_OPS per run;
+    online users with no objects on any FortiGate of their group are handed back to
+    the signal pipeline as a create.
+    """
+
+    def __init__(self, fetch_snapshot: Callable[[str], Awaitable[Optional[dict]]],
+                 fetch_desired: Callable[[], Awaitable[Optional[List[dict]]]],
+                 execute: Callable[[str, dict], Awaitable[bool]],
+                 busy: Callable[[str], bool], repair: Callable[[dict], None],
+                 available: Callable[[List[str]], List[str]]):
+        self._fetch_snapshot = fetch_snapshot
+        self._fetch_desired = fetch_desired
+        self._execute = execute
+        self._busy = busy
+        self._repair = repair
+        self._available = available
+        self._lock = asyncio.Lock()
+        self.last: dict = {}
+
+    async def run(self, apply: bool = True) -> dict:
+        async with self._lock:
+            started = time.perf_counter()
+            groups = st.FORTI_GATE
+            fgs = sorted({fg for group in groups.values() for fg in group})
+            snapshots = {}
+            for fg in self._available(fgs):
+                tables = await self._fetch_snapshot(fg)
+                if tables is not None:
+                    snapshots[fg] = tables
+            desired = await self._fetch_desired()
+            if desired is None:
+                self.last = {"ok": False, "error": "desired state unavailable"}
+                return self.last
+
+            known = {row["login"] for row in desired}
+            referenced = {str(v) for row in desired for v in (row.get("policy_id"), row.get("hash")) if v}
+            online = {row["login"]: row for row in desired if row.get("ip") or row.get("ipv6")}
+            busy = {login for login in known if self._busy(login)}
+            report, ops_total, done = {"fortigates": {}, "missing": []}, 0, 0
+            plans = {}
+            for fg, tables in snapshots.items():
+                expected = {login: row for login, row in online.items() if fg in groups.get(row.get("nas_ip") or "", [])}
+                plans[fg] = plan_fg(tables, expected, known, busy, referenced)
+                report["fortigates"][fg] = {
+                    "objects": {t: len(r) for t, r in tables.items()},
+                    "ops": len(plans[fg]),
+                }
+
+            # Online users with nothing on any FG of their group (all of it snapshotted): lost create
+            present = {fg: {a.get("name") for a in tables.get("address") or []} for fg, tables in snapshots.items()}
+            for login, row in online.items():
+                group = groups.get(row.get("nas_ip") or "", [])
+                if login in busy or not group or not all(fg in snapshots for fg in group):
+                    continue
+                if not any(login in present[fg] for fg in group):
+                    report["missing"].append(login)
+
+            if apply:
+                budget = st.AE_RECONCILE_MAX_OPS
+                delay = 1.0 / st.AE_RECONCILE_OPS_PER_SEC if st.AE_RECONCILE_OPS_PER_SEC > 0 else 0
+                for fg, ops in plans.items():
+                    for op in ops:
+                        if ops_total >= budget:
+                            break
+                        ops_total += 1
+                        if await self._execute(fg, op):
+                            done += 1
+                        else:
+                            logger.warning(f"Reconcile {op['op']} on {fg} failed: {op}")
+                        await asyncio.sleep(delay)
+                for login in report["missing"]:
+                    self._repair(online[login])
+
+            report.update({
+                "ok": True, "applied": apply, "ops_executed": ops_total, "ops_succeeded": done,
+                "ms": round((time.perf_counter() - started) * 1000, 2), "at": time.time(),
+                "plans": plans if not apply else None,
+            })
+            logger.info(f"Reconcile {'applied' if apply else 'dry run'}: "
+                        f"{ {fg: r['ops'] for fg, r in report['fortigates'].items()} } ops, "
+                        f"{len(report['missing'])} missing users, {done}/{ops_total} executed")
+            self.last = {k: v for k, v in report.items() if k != "plans"}
+            return report
+
+    async def loop(self, leader: Callable[[], bool] = lambda: True):
+        """Background task: reconcile every AE_RECONCILE_INTERVAL seconds (on one replica: `leader`)"""
+        while True:
+            await asyncio.sleep(st.AE_RECONCILE_INTERVAL)
+            if not leader():
+                continue
+            try:
+                await self.run(apply=True)
+            except Exception as e:
+                logger.error(f"Reconcile run failed: {e}")
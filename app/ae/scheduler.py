@@ -0,0 +1,145 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from bisect import bisect_left
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import Dict
+
+from app.config.env import st
+
+logger = logging.getLogger("mhe_ae.scheduler")
+
+# Lower runs first: removals free FortiGate objects, profile edits are someone waiting in the UI,
+# session starts come in storms, imports and drift repair can wait
+PRIORITIES = {"delete": 0, "interactive": 1, "edit": 1, "create": 2, "batch": 3, "reconcile": 4}
+
+# Priority of the FortiGate work of the current signal (set per operation by the AE handlers)
+current_priority: ContextVar[int] = ContextVar("current_priority", default=PRIORITIES["create"])
+
+# Queue wait histogram bucket upper bounds, ms (last bucket is +inf)
+WAIT_BUCKETS_MS = (1, 5, 10, 50, 100, 500, 1000, 5000, 10000, 30000)
+
+
+class QueueFull(Exception):
+    pass
+
+
+class FGQueue:
+    """Admission control for one FortiGate: at most AE_FG_CONCURRENCY calls in flight,
+    started no faster than a token bucket (AE_FG_RATE per second, AE_FG_BURST deep)
+    allows, waiting callers served by priority and then arrival order."""
+
+    def __init__(self, fg: str):
+        self.fg = fg
+        self.in_flight = 0
+        self._tokens = float(st.AE_FG_BURST)
+        self._refilled = time.monotonic()
+        self._waiters = []
+        # Callers still queued: the heap also holds the futures of callers that gave up until _dispatch reaches them
+        self.waiting = 0
+        self._seq = itertools.count()
+        self._timer = None
+        self.stats = {"admitted": 0, "rejected": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0,
+                      "by_priority": {}, "wait_histogram": [0] * (len(WAIT_BUCKETS_MS) + 1)}
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(float(st.AE_FG_BURST), self._tokens + (now - self._refilled) * st.AE_FG_RATE)
+        self._refilled = now
+
+    def _dispatch(self):
+        self._timer = None
+        while self._waiters and self.in_flight < st.AE_FG_CONCURRENCY:
+            if self._waiters[0][2].done():
+                # Caller gave up (cancelled / timed out) while queued
+                heapq.heappop(self._waiters)
+                continue
+            if st.AE_FG_RATE > 0:
+                self._refill()
+                if self._tokens < 1:
+                    delay = (1 - self._tokens) / st.AE_FG_RATE
+                    self._timer = asyncio.get_running_loop().call_later(delay, self._dispatch)
+                    return
+                self._tokens -= 1
+            _, _, future = heapq.heappop(self._waiters)
+            self.in_flight += 1
+            self.waiting -= 1
+            future.set_result(None)
+
+    async def acquire(self, priority: int):
+        if self.waiting >= st.AE_FG_QUEUE_MAX:
+            self.stats["rejected"] += 1
+            raise QueueFull(f"FG {self.fg} queue full ({self.waiting} waiting)")
+        if len(self._waiters) > 2 * self.waiting + 64:
+            # Mostly abandoned entries stuck behind a slow FortiGate: drop them
+            self._waiters = [w for w in self._waiters if not w[2].done()]
+            heapq.heapify(self._waiters)
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self.waiting += 1
+        if self._timer is None:
+            self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # Admitted right as we were cancelled: hand the slot on
+                self.release()
+            else:
+                self.waiting -= 1
+            raise
+        ms = (time.perf_counter() - start) * 1000
+        self.stats["admitted"] += 1
+        self.stats["wait_ms_total"] += ms
+        self.stats["wait_ms_max"] = max(self.stats["wait_ms_max"], ms)
+        self.stats["wait_histogram"][bisect_left(WAIT_BUCKETS_MS, ms)] += 1
+        self.stats["by_priority"][priority] = self.stats["by_priority"].get(priority, 0) + 1
+
+    def release(self):
+        self.in_flight -= 1
+        if self._timer is None:
+            self._dispatch()
+
+    def snapshot(self) -> dict:
+        admitted = self.stats["admitted"]
+        return {
+            "in_flight": self.in_flight, "depth": self.waiting,
+            "tokens": round(self._tokens, 2), "admitted": admitted, "rejected": self.stats["rejected"],
+            "wait_ms_avg": round(self.stats["wait_ms_total"] / admitted, 2) if admitted else 0.0,
+            "wait_ms_max": round(self.stats["wait_ms_max"], 2),
+            "wait_histogram": {(f"le_{b}" if i < len(WAIT_BUCKETS_MS) else "inf"): n
+                               for i, (b, n) in enumerate(zip(WAIT_BUCKETS_MS + (None,), self.stats["wait_histogram"])) if n},
+            "by_priority": dict(sorted(self.stats["by_priority"].items())),
+        }
+
+
+class Scheduler:
+    def __init__(self):
+        self._queues: Dict[str, FGQueue] = {}
+
+    def get(self, fg: str) -> FGQueue:
+        queue = self._queues.get(fg)
+        if queue is None:
+            queue = self._queues[fg] = FGQueue(fg)
+        return queue
+
+    @asynccontextmanager
+    async def slot(self, fg: str, priority: int = None):
+        """Hold one of the FG's concurrency slots for the duration of a fortiapi call"""
+        queue = self.get(fg)
+        await queue.acquire(current_priority.get() if priority is None else priority)
+        try:
+            yield
+        finally:
+            queue.release()
+
+    def snapshot(self) -> dict:
+        return {fg: q.snapshot() for fg, q in list(self._queues.items())}
+
+
+# Process-wide scheduler, one queue per FortiGate management address
+scheduler = Scheduler()
@@ -0,0 +1,131 @@
+import asyncio
+import hashlib
+import logging
+import socket
+import time
+from bisect import bisect
+from typing import Iterable, List, Optional, Tuple
+
+from app.config.env import st
+
+logger = logging.getLogger("mhe_ae.shard")
+
+# Header on forwarded requests: the receiver handles them itself, whatever its ring says
+FORWARDED_HEADER = "X-MHE-AE-Forwarded"
+
+
+def _point(key: str) -> int:
+    return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], "big")
+
+
+class HashRing:
+    """Consistent-hash ring with AE_SHARD_VNODES virtual nodes per member"""
+
+    def __init__(self, members: Iterable[str], vnodes: int):
+        self.members = tuple(sorted(set(members)))
+        points = sorted((_point(f"{m}#{i}"), m) for m in self.members for i in range(vnodes))
+        self._keys = [p for p, _ in points]
+        self._owners = [m for _, m in points]
+
+    def owner(self, key: str) -> Optional[str]:
+        if not self._keys:
+            return None
+        return self._owners[bisect(self._keys, _point(key)) % len(self._keys)]
+
+
+def _self_address() -> str:
+    if st.AE_SELF:
+        return st.AE_SELF
+    try:
+        host = socket.gethostbyname(socket.gethostname())
+    except OSError:
+        host = "127.0.0.1"
+    return f"{host}:{st.MHE_AE_PORT}"
+
+
+class Sharding:
+    """login → owning AE replica, so one replica sees all signals of a user (ordering, debounce, caches).
+
+    Members come from AE_PEERS (static "host:port,...") or the A records of a
+    headless service (AE_PEERS_DNS="name:port"), refreshed every
+    AE_PEERS_REFRESH seconds; with neither every login is local. After a
+    membership change logins keep their previous owner for AE_SHARD_GRACE
+    seconds (if it is still a member), so its pending debounced work drains
+    before a new replica takes over.
+    """
+
+    def __init__(self):
+        self.self_addr = _self_address()
+        self.ring = HashRing([self.self_addr], st.AE_SHARD_VNODES)
+        self._previous: Optional[HashRing] = None
+        self._grace_until = 0.0
+        self._seeded = False
+        self.stats = {"local": 0, "forwarded": 0, "forward_failed": 0, "rebalances": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(st.AE_PEERS or st.AE_PEERS_DNS)
+
+    def set_members(self, members: List[str]):
+        members = sorted(set(members) | {self.self_addr})
+        if tuple(members) == self.ring.members:
+            self._seeded = True
+            return
+        logger.info(f"AE ring membership: {list(self.ring.members)} -> {members}")
+        # The self-only startup ring owned nothing for real: no grace period after the first lookup
+        self._previous = self.ring if self._seeded else None
+        self._grace_until = time.monotonic() + st.AE_SHARD_GRACE
+        self._seeded = True
+        self.ring = HashRing(members, st.AE_SHARD_VNODES)
+        self.stats["rebalances"] += 1
+
+    def owner(self, login: str) -> str:
+        if not self.enabled or not login:
+            return self.self_addr
+        owner = self.ring.owner(login)
+        if self._previous is not None:
+            if time.monotonic() < self._grace_until:
+                previous = self._previous.owner(login)
+                if previous in self.ring.members:
+                    return previous
+            else:
+                self._previous = None
+        return owner
+
+    def owns(self, login: str) -> bool:
+        return self.owner(login) == self.self_addr
+
+    def split(self, items: List[Tuple[str, dict]]) -> dict:
+        """Group (login, item) pairs by owning replica"""
+        groups = {}
+        for login, item in items:
+            groups.setdefault(self.owner(login), []).append(item)
+        return groups
+
+    async def _resolve(self) -> Optional[List[str]]:
+        if st.AE_PEERS:
+            return [p.strip() for p in st.AE_PEERS.split(",") if p.strip()]
+        host, _, port = st.AE_PEERS_DNS.partition(":")
+        port = port or str(st.MHE_AE_PORT)
+        try:
+            infos = await asyncio.get_running_loop().getaddrinfo(host, port, type=socket.SOCK_STREAM)
+        except OSError as e:
+            logger.warning(f"AE peers lookup {st.AE_PEERS_DNS} failed: {e}")
+            return None
+        return sorted({f"{info[4][0]}:{port}" for info in infos})
+
+    async def refresh_loop(self):
+        """Background task: keep ring membership current"""
+        while True:
+            members = await self._resolve()
+            if members:
+                self.set_members(members)
+            await asyncio.sleep(st.AE_PEERS_REFRESH)
+
+    def snapshot(self) -> dict:
+        return {"enabled": self.enabled, "self": self.self_addr, "members": list(self.ring.members),
+                "rebalancing": self._previous is not None and time.monotonic() < self._grace_until, **self.stats}
+
+
+# Process-wide shard map of this AE replica
+sharding = Sharding()
@@ -1,10 +1,23 @@
+import ipaddress
+import json
+import logging
 import os
-from typing import Dict, Any
-from dotenv import load_dotenv
+import signal
+import threading
+import time
+from types import MappingProxyType
+from typing import Dict, Any, Mapping, Optional, Tuple
+from dotenv import dotenv_values, find_dotenv, load_dotenv
 
+from app.utils.ports import Interval, parse_ports, union
 
-# Load environment variables from .env if present
-load_dotenv()
+logger = logging.getLogger(__name__)
+
+# Load environment variables from .env if present (the process environment wins, also on reload)
+_process_keys = frozenset(os.environ)
+ENV_FILE = os.getenv("CONFIG_ENV_FILE") or find_dotenv()
+load_dotenv(ENV_FILE)
+PORTS_FILE = os.getenv("PORTS_FILE") or os.path.join(os.path.dirname(os.path.abspath(__file__)), "ports.json")
 
 
 def _get(name: str, default: Any = None, cast=None):
@@ -17,6 +30,204 @@ def _get(name: str, default: Any = None, cast=None):
     return val
 
 
+def _parse_sizes(raw: str) -> Dict[str, int]:
+    """Parse "firewall=8,query=4" into {"firewall": 8, "query": 4}"""
+    sizes: Dict[str, int] = {}
+    for pair in (raw or "").split(","):
+        name, _, size = pair.partition("=")
+        if name.strip() and size.strip().isdigit():
+            sizes[name.strip()] = int(size)
+    return sizes
+
+
+def _parse_forti_gate() -> Dict[str, list]:
+    """Build NAS_IP -> [FG_IPs...] mapping from .env.
+
+    Supports two formats (multi-line preferred):
+    1) Multi-line indexed (supports multiple NAS-IPs per group):
+       FORTI_GATE_1_NAS=172.26.202.244,172.26.202.245
+       FORTI_GATE_1_FGS=10.3.1.101,10.3.1.102
+       Each NAS-IP from the list will map to the same FG-IP list.
+
+    2) Legacy single-line:
+       FORTI_GATE="nas1=fg1;fg2|nas2=fg3"
+    """
+    mapping: Dict[str, list] = {}
+
+    # Prefer multi-line indexed variables
+    indices: set[str] = set()
+    for key in os.environ.keys():
+        if key.startswith("FORTI_GATE_") and key.endswith("_NAS"):
+            idx = key[len("FORTI_GATE_"):-len("_NAS")]
+            if idx:
+                indices.add(idx)
+
+    for idx in sorted(indices):
+        nas_raw = _get(f"FORTI_GATE_{idx}_NAS", "")
+        fgs_raw = _get(f"FORTI_GATE_{idx}_FGS", "")
+
+        # Parse multiple NAS-IPs and FG-IPs from comma-separated lists
+        nas_list = [nas.strip() for nas in nas_raw.split(',') if nas.strip()]
+        fg_list = [fg.strip() for fg in fgs_raw.split(',') if fg.strip()]
+
+        # Map each NAS-IP to the same list of FG-IPs
+        if nas_list and fg_list:
+            for nas_ip in nas_list:
+                mapping[nas_ip] = fg_list
+
+    if mapping:
+        return mapping
+
+    # Fallback to legacy single-line format
+    raw = _get("FORTI_GATE", "")
+    if not raw:
+        return mapping
+    for pair in raw.split("|"):
+        if not pair:
+            continue
+        nas, _, fgs = pair.partition("=")
+        nas_ip = nas.strip()
+        fg_list = [fg.strip() for fg in fgs.split(';') if fg.strip()]
+        if nas_ip and fg_list:
+            mapping[nas_ip] = fg_list
+    return mapping
+
+
+class ConfigSnapshot:
+    """Compiled, read-only topology config: NAS → FortiGates, port matrix, service URLs.
+
+    Built and validated once (compile_config); hot paths read `st.config`
+    attributes instead of re-parsing the environment. A reload builds a new
+    snapshot and swaps the module reference, so readers always see one
+    consistent version.
+    """
+
+    __slots__ = ("version", "loaded_at", "forti_gate", "fortigates", "profiles", "ports_tcp", "ports_udp", "urls",
+                 "db_url", "ae_url", "app_url", "fortiapi_url", "ldap_url", "email_url")
+
+    def __init__(self, version: int, forti_gate: Dict[str, list], profiles: list, urls: Dict[str, str]):
+        self.version = version
+        self.loaded_at = time.time()
+        self.forti_gate: Mapping[str, Tuple[str, ...]] = MappingProxyType({nas: tuple(fgs) for nas, fgs in forti_gate.items()})
+        self.fortigates: Tuple[str, ...] = tuple(sorted({fg for fgs in forti_gate.values() for fg in fgs}))
+        self.profiles: Tuple[Mapping[str, Any], ...] = tuple(MappingProxyType(dict(p)) for p in profiles)
+        self.ports_tcp: Tuple[Interval, ...] = tuple(union(*(parse_ports(p.get("tcp_rules")) for p in profiles)))
+        self.ports_udp: Tuple[Interval, ...] = tuple(union(*(parse_ports(p.get("udp_rules")) for p in profiles)))
+        self.urls: Mapping[str, str] = MappingProxyType(urls)
+        for name, url in urls.items():
+            setattr(self, f"{name}_url", url)
+
+    def summary(self) -> dict:
+        return {"version": self.version, "loaded_at": self.loaded_at, "nas": len(self.forti_gate),
+                "fortigates": list(self.fortigates), "profiles": len(self.profiles), "urls": dict(self.urls)}
+
+
+def _service_url(name: str) -> str:
+    return f"http://{_get(f'MHE_{name}_HOST', '127.0.0.1')}:{_get(f'MHE_{name}_PORT', 80, int)}"
+
+
+def compile_config(version: int = 1, strict: bool = True) -> ConfigSnapshot:
+    """Parse and validate the current environment + ports file (ValueError / OSError on bad config).
+
+    strict=False (import time): invalid NAS keys and an unreadable or malformed ports file are
+    logged and left out, so services that never use them still start."""
+    forti_gate = _parse_forti_gate()
+    for nas in list(forti_gate):
+        try:
+            ipaddress.ip_address(nas)
+        except ValueError:
+            if strict:
+                raise ValueError(f"FORTI_GATE: invalid NAS IP {nas!r}")
+            logger.error(f"FORTI_GATE: invalid NAS IP {nas!r}, ignored")
+            del forti_gate[nas]
+    urls = {name.lower(): _service_url(name) for name in ("DB", "AE", "APP", "FORTIAPI", "LDAP", "EMAIL")}
+    try:
+        with open(PORTS_FILE) as f:
+            profiles = json.load(f)
+        if not isinstance(profiles, list):
+            raise ValueError(f"{PORTS_FILE}: expected a list of profiles")
+        return ConfigSnapshot(version, forti_gate, profiles, urls)
+    except (OSError, ValueError, TypeError, AttributeError) as e:
+        if strict:
+            raise
+        logger.error(f"Port profiles not loaded ({e}), starting without them")
+        return ConfigSnapshot(version, forti_gate, [], urls)
+
+
+_current: ConfigSnapshot = compile_config(strict=False)
+_reload_lock = threading.Lock()
+# Keys loaded from ENV_FILE (not from the process environment): a reload may drop them
+_file_keys = (set(dotenv_values(ENV_FILE)) - _process_keys) if ENV_FILE else set()
+
+
+def reload_config() -> bool:
+    """Re-read ENV_FILE and the ports file and swap the snapshot; keeps the old one on invalid config"""
+    global _current, _file_keys
+    with _reload_lock:
+        values = {k: v for k, v in (dotenv_values(ENV_FILE) if ENV_FILE else {}).items() if v is not None}
+        saved = {k: os.environ.get(k) for k in _file_keys | set(values)}
+        for key in _file_keys - set(values) - _process_keys:
+            os.environ.pop(key, None)
+        for key, value in values.items():
+            if key not in _process_keys:
+                os.environ[key] = value
+        try:
+            snapshot = compile_config(_current.version + 1)
+        except Exception as e:
+            for key, value in saved.items():
+                if value is None:
+                    os.environ.pop(key, None)
+                else:
+                    os.environ[key] = value
+            logger.error(f"Config reload rejected, keeping version {_current.version}: {e}")
+            return False
+        _file_keys = set(values) - _process_keys
+        _current = snapshot
+    logger.info(f"Config reloaded: version {snapshot.version}, {len(snapshot.forti_gate)} NAS, "
+                f"{len(snapshot.fortigates)} FortiGates, {len(snapshot.profiles)} port profiles")
+    return True
+
+
+_watcher: Optional[threading.Thread] = None
+_hup = threading.Event()
+
+
+def _mtimes() -> tuple:
+    result = []
+    for path in (ENV_FILE, PORTS_FILE):
+        try:
+            result.append(os.stat(path).st_mtime_ns if path else None)
+        except OSError:
+            result.append(None)
+    return tuple(result)
+
+
+def watch_config():
+    """Start (once per process) reloading on ENV_FILE / ports file change and on SIGHUP"""
+    global _watcher
+    interval = _get("CONFIG_WATCH_INTERVAL", 5.0, float)
+    if _watcher is not None or interval <= 0:
+        return
+    try:
+        signal.signal(signal.SIGHUP, lambda signum, frame: _hup.set())
+    except (ValueError, AttributeError):
+        # Not the main thread / no SIGHUP on this platform: file watching only
+        pass
+
+    def run():
+        seen = _mtimes()
+        while True:
+            hup = _hup.wait(interval)
+            _hup.clear()
+            current = _mtimes()
+            if hup or current != seen:
+                seen = current
+                reload_config()
+
+    _watcher = threading.Thread(target=run, name="config-watch", daemon=True)
+    _watcher.start()
+
+
 class _Settings:
     # API token
     API_TOKEN: str = _get("API_TOKEN", "1234567890")
@@ -46,63 +257,39 @@ class _Settings:
     # RADIUS
     RADIUS_SERVER_IP = [s.strip() for s in _get("RADIUS_SERVER_IP", "").split(",") if s.strip()]
     RADIUS_SHARED_SECRET = _get("RADIUS_SHARED_SECRET", "testing123").encode()
+    # Accounting-Stop removals from RADIUS_Sessions are applied in batches
+    RADIUS_STOP_FLUSH_INTERVAL = _get("RADIUS_STOP_FLUSH_INTERVAL", 2.0, float)
+    RADIUS_STOP_FLUSH_BATCH = _get("RADIUS_STOP_FLUSH_BATCH", 1000, int)
+    # Seconds an in-memory session registry entry is trusted before re-reading RADIUS_Sessions
+    # (bounds staleness when a start/stop was handled by another mhe_db worker or replica)
+    RADIUS_REGISTRY_TTL = _get("RADIUS_REGISTRY_TTL", 10.0, float)
 
-    # Mapping NAS-IP -> list of FortiGate addresses (with fallback support)
-    def _parse_forti_gate(self) -> Dict[str, list]:
-        """Build NAS_IP -> [FG_IPs...] mapping from .env.
-
-        Supports two formats (multi-line preferred):
-        1) Multi-line indexed (supports multiple NAS-IPs per group):
-           FORTI_GATE_1_NAS=172.26.202.244,172.26.202.245
-           FORTI_GATE_1_FGS=10.3.1.101,10.3.1.102
-           Each NAS-IP from the list will map to the same FG-IP list.
-
-        2) Legacy single-line:
-           FORTI_GATE="nas1=fg1;fg2|nas2=fg3"
-        """
-        mapping: Dict[str, list] = {}
-
-        # Prefer multi-line indexed variables
-        indices: set[str] = set()
-        for key in os.environ.keys():
-            if key.startswith("FORTI_GATE_") and key.endswith("_NAS"):
-                idx = key[len("FORTI_GATE_"):-len("_NAS")]
-                if idx:
-                    indices.add(idx)
-
-        for idx in sorted(indices):
-            nas_raw = _get(f"FORTI_GATE_{idx}_NAS", "")
-            fgs_raw = _get(f"FORTI_GATE_{idx}_FGS", "")
-            
-            # Parse multiple NAS-IPs and FG-IPs from comma-separated lists
-            nas_list = [nas.strip() for nas in nas_raw.split(',') if nas.strip()]
-            fg_list = [fg.strip() for fg in fgs_raw.split(',') if fg.strip()]
-            
-            # Map each NAS-IP to the same list of FG-IPs
-            if nas_list and fg_list:
-                for nas_ip in nas_list:
-                    mapping[nas_ip] = fg_list
-
-        if mapping:
-            return mapping
-
-        # Fallback to legacy single-line format
-        raw = _get("FORTI_GATE", "")
-        if not raw:
-            return mapping
-        for pair in raw.split("|"):
-            if not pair:
-                continue
-            nas, _, fgs = pair.partition("=")
-            nas_ip = nas.strip()
-            fg_list = [fg.strip() for fg in fgs.split(';') if fg.strip()]
-            if nas_ip and fg_list:
-                mapping[nas_ip] = fg_list
-        return mapping
+    # Mapping NAS-IP -> list of FortiGate addresses (with fallback support), from the current config snapshot
+    FORTI_GATE: Mapping[str, Tuple[str, ...]] = property(lambda self: _current.forti_gate)
+    # Whole current snapshot (port matrix, service URLs); hold one reference per request for a consistent view
+    config: ConfigSnapshot = property(lambda self: _current)
+
+    # StarRocks connection budget per process: named pool classes and their sizes
+    DB_POOL_SIZES: Dict[str, int] = _parse_sizes(_get("DB_POOL_SIZES", "firewall=8,query=4,radius=12,email=16"))
+    DB_POOL_DEFAULT_SIZE = _get("DB_POOL_DEFAULT_SIZE", 4, int)
+    DB_POOL_TIMEOUT = _get("DB_POOL_TIMEOUT", 30.0, float)
+    # Session reset on checkin also drops server-side prepared statements (the cache then lives for one checkout)
+    DB_POOL_RESET_SESSION = _get("DB_POOL_RESET_SESSION", "False").lower() in ("true", "1", "yes")
+    # Cache server-side prepared statements per pooled connection for the hot statements (app/db/query.py)
+    DB_PREPARED_STATEMENTS = _get("DB_PREPARED_STATEMENTS", "True").lower() in ("true", "1", "yes")
+
+    # mhe_db executor for blocking DB/HTTP calls and default per-query timeout (seconds)
+    DB_EXECUTOR_WORKERS = _get("DB_EXECUTOR_WORKERS", 64, int)
+    DB_QUERY_TIMEOUT = _get("DB_QUERY_TIMEOUT", 10.0, float)
 
-    FORTI_GATE: Dict[str, list] = property(lambda self: self._parse_forti_gate())
+    # Seconds the cached FW_Profiles total is trusted (writes invalidate it immediately)
+    PROFILE_TOTAL_TTL = _get("PROFILE_TOTAL_TTL", 60, int)
+    # Rows per multi-row INSERT in NDJSON profile import
+    PROFILE_IMPORT_BATCH = _get("PROFILE_IMPORT_BATCH", 1000, int)
+    # Seconds between full reseeds of the in-memory policy index (0 = seed once at startup)
+    POLICY_INDEX_REFRESH = _get("POLICY_INDEX_REFRESH", 300, int)
 
-    # Service hosts/ports
+    # Service hosts/ports (read once here; st.config.<name>_url follows config reloads)
     MHE_DB_HOST = _get("MHE_DB_HOST", "127.0.0.1")
     MHE_DB_PORT = _get("MHE_DB_PORT", 80, int)
 
@@ -115,6 +302,86 @@ class _Settings:
 
     MHE_FORTIAPI_HOST = _get("MHE_FORTIAPI_HOST", "127.0.0.1")
     MHE_FORTIAPI_PORT = _get("MHE_FORTIAPI_PORT", 80, int)
+    # Rows per paged CMDB GET in fortiapi /snapshot
+    FG_SNAPSHOT_PAGE = _get("FG_SNAPSHOT_PAGE", 1000, int)
+    FG_SNAPSHOT_TIMEOUT = _get("FG_SNAPSHOT_TIMEOUT", 30.0, float)
+    # FortiGate sessions in fortiapi: scheme (http for a local emulator), request timeout (s), connections per
+    # FortiGate, seconds an idle pooled connection is kept, keep-alive ping of idle sessions (s, 0 = off),
+    # connections opened per FortiGate at startup, HTTP/2 (needs the h2 package), per-FortiGate API tokens
+    # ("fg_addr=token,..."; API_TOKEN for the rest)
+    FG_SCHEME = _get("FG_SCHEME", "https")
+    FG_TIMEOUT = _get("FG_TIMEOUT", 3.0, float)
+    FG_MAX_CONNECTIONS = _get("FG_MAX_CONNECTIONS", 8, int)
+    FG_KEEPALIVE_EXPIRY = _get("FG_KEEPALIVE_EXPIRY", 120.0, float)
+    FG_KEEPALIVE_INTERVAL = _get("FG_KEEPALIVE_INTERVAL", 30.0, float)
+    FG_WARM_CONNECTIONS = _get("FG_WARM_CONNECTIONS", 2, int)
+    FG_HTTP2 = _get("FG_HTTP2", "True").lower() in ("true", "1", "yes")
+    FG_API_TOKENS = _get("FG_API_TOKENS", "")
+    # How fortiapi attaches users to their hash's policy: "members" (user addresses in the policy's srcaddr/srcaddr6)
+    # or "groups" (one address group + address6 group per hash, the policy references only those)
+    FG_PROVISION_MODE = _get("FG_PROVISION_MODE", "members")
+    # Policy membership cache in fortiapi (seconds an entry is trusted, 0 = off) and max changed members
+    # sent as single sub-resource calls (more: one PUT of the whole srcaddr/srcaddr6 lists)
+    FG_POLICY_CACHE_TTL = _get("FG_POLICY_CACHE_TTL", 300.0, float)
+    FG_MEMBER_CALLS_MAX = _get("FG_MEMBER_CALLS_MAX", 8, int)
+    # Local FortiOS REST emulator (app/core/mhe_fgemu.py): port, base latency ± jitter (ms), extra per write (ms)
+    # and per member of the written object (µs), injected 503 / hang rates and hang length (s),
+    # concurrent API calls each emulated FortiGate serves (management-plane limit)
+    FGEMU_PORT = _get("FGEMU_PORT", 18080, int)
+    FGEMU_LATENCY_MS = _get("FGEMU_LATENCY_MS", 20.0, float)
+    FGEMU_JITTER_MS = _get("FGEMU_JITTER_MS", 5.0, float)
+    FGEMU_WRITE_MS = _get("FGEMU_WRITE_MS", 30.0, float)
+    FGEMU_MEMBER_US = _get("FGEMU_MEMBER_US", 50.0, float)
+    FGEMU_ERROR_RATE = _get("FGEMU_ERROR_RATE", 0.0, float)
+    FGEMU_TIMEOUT_RATE = _get("FGEMU_TIMEOUT_RATE", 0.0, float)
+    FGEMU_TIMEOUT_SECONDS = _get("FGEMU_TIMEOUT_SECONDS", 30.0, float)
+    FGEMU_CONCURRENCY = _get("FGEMU_CONCURRENCY", 4, int)
+    # AE → fortiapi composite workflow call timeout (seconds; covers every FortiGate step of one event)
+    AE_WORKFLOW_TIMEOUT = _get("AE_WORKFLOW_TIMEOUT", 20.0, float)
+    # Per-user signal debounce window in AE (seconds); 0 = run every signal immediately, in order (opt-in)
+    AE_DEBOUNCE_SECONDS = _get("AE_DEBOUNCE_SECONDS", 0.0, float)
+    # Completed AE operations kept to answer duplicate signals (seconds, entries; TTL 0 = off)
+    AE_IDEMPOTENCY_TTL = _get("AE_IDEMPOTENCY_TTL", 300.0, float)
+    AE_IDEMPOTENCY_MAX = _get("AE_IDEMPOTENCY_MAX", 100000, int)
+    # Inverted port rules memoized per profile (LRU entries)
+    AE_INVERT_CACHE = _get("AE_INVERT_CACHE", 4096, int)
+    # Per-FortiGate circuit breaker in AE (see app/ae/breaker.py)
+    AE_BREAKER_WINDOW = _get("AE_BREAKER_WINDOW", 20, int)
+    AE_BREAKER_MIN_CALLS = _get("AE_BREAKER_MIN_CALLS", 5, int)
+    AE_BREAKER_FAILURE_RATE = _get("AE_BREAKER_FAILURE_RATE", 0.5, float)
+    AE_BREAKER_CONSECUTIVE = _get("AE_BREAKER_CONSECUTIVE", 3, int)
+    AE_BREAKER_SLOW_MS = _get("AE_BREAKER_SLOW_MS", 1500.0, float)
+    AE_BREAKER_OPEN_SECONDS = _get("AE_BREAKER_OPEN_SECONDS", 15.0, float)
+    AE_BREAKER_PROBE_INTERVAL = _get("AE_BREAKER_PROBE_INTERVAL", 2.0, float)
+    # Per-FortiGate admission control in AE: concurrent fortiapi calls, calls/s (token bucket, 0 = no limit),
+    # bucket depth and max queued calls per FortiGate
+    AE_FG_CONCURRENCY = _get("AE_FG_CONCURRENCY", 4, int)
+    AE_FG_RATE = _get("AE_FG_RATE", 20.0, float)
+    AE_FG_BURST = _get("AE_FG_BURST", 20, int)
+    AE_FG_QUEUE_MAX = _get("AE_FG_QUEUE_MAX", 10000, int)
+    # Shared-policy membership batching in AE: window (seconds) and max changes per policy write
+    AE_MEMBERSHIP_WINDOW = _get("AE_MEMBERSHIP_WINDOW", 0.05, float)
+    AE_MEMBERSHIP_MAX = _get("AE_MEMBERSHIP_MAX", 500, int)
+    # AE sharding across replicas: static "host:port,..." peers or headless service "name:port" (DNS A records),
+    # this replica's own host:port as peers list it (default: pod IP + MHE_AE_PORT), membership refresh (s),
+    # ring virtual nodes per replica, seconds logins keep their old owner after a membership change
+    AE_PEERS = _get("AE_PEERS", "")
+    AE_PEERS_DNS = _get("AE_PEERS_DNS", "")
+    AE_SELF = _get("AE_SELF", "")
+    AE_PEERS_REFRESH = _get("AE_PEERS_REFRESH", 10.0, float)
+    AE_SHARD_VNODES = _get("AE_SHARD_VNODES", 64, int)
+    AE_SHARD_GRACE = _get("AE_SHARD_GRACE", 5.0, float)
+    # Drift reconciler in AE: seconds between runs (0 = only on POST /reconcile), corrective ops rate and cap per run
+    AE_RECONCILE_INTERVAL = _get("AE_RECONCILE_INTERVAL", 600.0, float)
+    AE_RECONCILE_OPS_PER_SEC = _get("AE_RECONCILE_OPS_PER_SEC", 5.0, float)
+    AE_RECONCILE_MAX_OPS = _get("AE_RECONCILE_MAX_OPS", 500, int)
+    # AE operation journal: directory ("" = off), seconds between Stream Loads to PolicyLogs, records per load,
+    # file size that starts a new journal once shipped, re-run operations cut off by a restart
+    AE_JOURNAL_DIR = _get("AE_JOURNAL_DIR", "journal")
+    AE_JOURNAL_FLUSH_INTERVAL = _get("AE_JOURNAL_FLUSH_INTERVAL", 5.0, float)
+    AE_JOURNAL_BATCH = _get("AE_JOURNAL_BATCH", 5000, int)
+    AE_JOURNAL_MAX_BYTES = _get("AE_JOURNAL_MAX_BYTES", 64 * 1024 * 1024, int)
+    AE_JOURNAL_RESUME = _get("AE_JOURNAL_RESUME", "True").lower() in ("true", "1", "yes")
 
     MHE_LDAP_HOST = _get("MHE_LDAP_HOST", "127.0.0.1")
     MHE_LDAP_PORT = _get("MHE_LDAP_PORT", 80, int)
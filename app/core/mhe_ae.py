@@ -1,12 +1,24 @@
 import json
 import logging
 import asyncio
+import time
 from fastapi import FastAPI, Request
-from app.config.env import st
+from fastapi.responses import RedirectResponse
+from app.config.env import st, watch_config
 import httpx
 from pathlib import Path
 from logging.handlers import RotatingFileHandler
 from contextlib import asynccontextmanager
+from app.ae.breaker import breakers
+from app.ae.coalesce import Coalescer, normalize
+from app.ae.reconcile import Reconciler
+from app.ae.idempotency import operation_key, operations
+from app.ae.scheduler import PRIORITIES, QueueFull, current_priority, scheduler
+from app.ae.membership import MembershipBatcher
+from app.ae.shard import FORWARDED_HEADER, sharding
+from app.ae.journal import journal
+from app.utils.ports import canonical_rules, difference, format_ports, parse_ports
+from functools import lru_cache
 
 logger = logging.getLogger("mhe_ae")
 # Ensure file-based rotating logs (no console spam)
@@ -23,35 +35,47 @@ logger.info("AE async HTTP client created (httpx)")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup: client already initialized
+    # Startup: client already initialized; background probes let open breakers recover without traffic.
+    # Topology/ports changes are picked up from the config files (or SIGHUP) without a restart
+    watch_config()
+    # Operations the last shutdown cut off are re-run; the journal ships to PolicyLogs in the background
+    _resume(journal.open())
+    shipper = asyncio.create_task(journal.flush_loop()) if journal.enabled else None
+    fgs = list(st.config.fortigates)
+    prober = asyncio.create_task(breakers.probe_loop(fgs, _probe))
+    # With several replicas the ring picks one to reconcile (and forwards its repairs to the owners)
+    drift = asyncio.create_task(reconciler.loop(lambda: sharding.owns(RECONCILE_KEY))) if st.AE_RECONCILE_INTERVAL > 0 else None
+    ring = asyncio.create_task(sharding.refresh_loop()) if sharding.enabled else None
     yield
-    # Shutdown: cleanup
+    # Shutdown: run what is still waiting in the debounce window, then cleanup
+    if drift:
+        drift.cancel()
+    if ring:
+        ring.cancel()
+    await coalescer.drain()
+    prober.cancel()
+    if shipper:
+        shipper.cancel()
+    await journal.close()
     logger.info("Shutting down: closing httpx client")
     await async_client.aclose()
     logger.info("AE httpx client closed")
 
 app = FastAPI(lifespan=lifespan)
 
-MHE_DB_URL = f"http://{st.MHE_DB_HOST}:{st.MHE_DB_PORT}"
-FG_URL = f"http://{st.MHE_FORTIAPI_HOST}:{st.MHE_FORTIAPI_PORT}"
 
-# Загружаем и кэшируем порты один раз
-def _load_ports_matrix():
-    with open('app/config/ports.json') as f:
-        data = json.load(f)
-    tcp = {tok.strip() for item in data for tok in str(item.get('tcp_rules', '')).split(',') if tok.strip()}
-    udp = {tok.strip() for item in data for tok in str(item.get('udp_rules', '')).split(',') if tok.strip()}
-    return sorted(tcp), sorted(udp)
-
-ALL_TCP, ALL_UDP = _load_ports_matrix()
+# Полная матрица портов (объединение интервалов всех профилей) берётся из снимка конфигурации;
+# версия снимка входит в ключ кэша, перезагрузка ports.json его обесценивает
+@lru_cache(maxsize=st.AE_INVERT_CACHE)
+def _invert_canonical(tcp, udp, version):
+    cfg = st.config
+    return (format_ports(difference(list(cfg.ports_tcp), parse_ports(tcp))),
+            format_ports(difference(list(cfg.ports_udp), parse_ports(udp))))
 
 def _invert_rules(selected_tcp, selected_udp):
-    """Вернуть строки правил, инвертированные относительно полной матрицы."""
-    def select(rules, ref): return set([t.strip() for t in str(rules or '').split(',') if t.strip()])
-    return (
-        ','.join([p for p in ALL_TCP if p not in select(selected_tcp, ALL_TCP)]),
-        ','.join([p for p in ALL_UDP if p not in select(selected_udp, ALL_UDP)]),
-    )
+    """Вернуть строки правил, инвертированные относительно полной матрицы (минимальные диапазоны).
+    Кэш по каноническим правилам, т.е. по hash профиля."""
+    return _invert_canonical(*canonical_rules(selected_tcp, selected_udp), st.config.version)
 
 async def _req(method, url, **kwargs):
     """Async HTTP request wrapper"""
@@ -66,6 +90,7 @@ async def _req(method, url, **kwargs):
         logger.error(f"{method.upper()} {url} failed: {e}")
         return None
 
+async def _get(url, **kwargs):     return await _req('get', url, **kwargs)
 async def _post(url, **kwargs):    return await _req('post', url, **kwargs)
 async def _delete(url, **kwargs):  return await _req('delete', url, **kwargs)
 async def _put(url, **kwargs):     return await _req('put', url, **kwargs)
@@ -81,6 +106,92 @@ def _get_common(data):
         st.FORTI_GATE.get(data.get("NAS-IP-Address", ""), [])
     )
 
+async def _probe(fg):
+    resp = await _post(f"{st.config.fortiapi_url}/probe", json={"fg_addr": fg})
+    result = resp.json() if resp else {}
+    return bool(result.get("ok")), result.get("ms", 0.0), None if result.get("ok") else "probe failed"
+
+async def _send_members(fg, policy_id, patch, priority):
+    try:
+        async with scheduler.slot(fg, priority):
+            resp = await _put(f"{st.config.fortiapi_url}/patch_policy_members", json={"fg_addr": fg, "policy_id": policy_id, **patch})
+    except QueueFull as e:
+        # Backlog, not a FortiGate fault
+        return {"ok": False, "error": str(e), "fault": "queue"}
+    return resp.json() if resp else {"ok": False, "error": "fortiapi unreachable"}
+
+# Users joining/leaving a shared policy within one window cost one policy write
+membership = MembershipBatcher(_send_members)
+
+def _groups_mode():
+    return st.FG_PROVISION_MODE == "groups"
+
+def _hook_fault(result):
+    """Failed membership update: FortiGate fault unless fortiapi says the request was refused"""
+    return result.get("fault", "device")
+
+def _joins(user, ip, ipv6):
+    return {"add": [user] if ip else [], "add6": [f"{user}v6"] if ipv6 else []}
+
+async def _post_workflow(name, fg, payload):
+    """One fortiapi workflow call; (result, fault). fault "device" (as fortiapi reports FortiGate faults):
+    fortiapi unreachable, timed out or failed itself; "refused": it rejected the request (422 etc.)"""
+    url = f"{st.config.fortiapi_url}/workflow/{name}"
+    try:
+        resp = await async_client.post(url, json={"fg_addr": fg, **payload}, timeout=st.AE_WORKFLOW_TIMEOUT)
+    except Exception as e:
+        logger.error(f"POST {url} failed: {e}")
+        return None, "device"
+    if not resp.is_success:
+        logger.error(f"POST {url} failed: {resp.status_code}")
+        return None, "device" if resp.status_code >= 500 else "refused"
+    result = resp.json()
+    return result, None if result.get("ok") else result.get("fault", "device")
+
+async def _workflow(name, fg_addr, payload, before=None, after=None):
+    """Run one composite fortiapi workflow on each FG in turn until one succeeds; (fg, result) or (None, None).
+    FGs with an open circuit breaker are skipped without a call. `before(fg)` / `after(fg)` are batched
+    membership updates done around the workflow on the same FG; their failure fails that FG. Only
+    FortiGate faults (transport errors, timeouts, 5xx) count against its breaker, not refused requests."""
+    available = breakers.available(fg_addr)
+    if len(available) < len(fg_addr):
+        logger.warning(f"Skipping FGs with open breaker: {[fg for fg in fg_addr if fg not in available]}")
+    for i, fg in enumerate(available):
+        logger.info(f"Attempting {name} on FG: {fg}")
+        removed = await before(fg) if before else None
+        hook_failed = removed is not None and not removed.get("ok") and "membership_remove"
+        fault = hook_failed and _hook_fault(removed)
+        try:
+            result = None
+            if not hook_failed:
+                async with scheduler.slot(fg):
+                    result, fault = await _post_workflow(name, fg, payload)
+        except QueueFull as e:
+            # Backlog, not a FortiGate fault: no breaker outcome
+            logger.warning(f"{e}, trying next...")
+            breakers.get(fg).release()
+            journal.attempt(fg, name, None, False, "queue full", [("membership_remove", removed)])
+            continue
+        added = await after(fg) if result and result.get("ok") and after else None
+        if added is not None and not added.get("ok"):
+            hook_failed, fault = "membership_add", _hook_fault(added)
+        ok = bool(result and result.get("ok")) and not hook_failed
+        failed = (hook_failed or (result.get("failed_step") if result else "fortiapi unreachable" if fault == "device" else "fortiapi refused")) if not ok else None
+        if ok or fault == "device":
+            # Breaker latency is per FortiGate step, not per workflow
+            step_ms = result["ms"] / max(len(result.get("steps") or []), 1) if result else st.AE_WORKFLOW_TIMEOUT * 1000
+            breakers.get(fg).record(ok, step_ms, failed and f"{name}: {failed}")
+        else:
+            # Refused request (validation, missing policy...): says nothing about the FortiGate's health
+            breakers.get(fg).release()
+        journal.attempt(fg, name, result, ok, failed, [("membership_remove", removed), ("membership_add", added)])
+        if ok:
+            for untried in available[i + 1:]:
+                breakers.get(untried).release()
+            return fg, result
+        logger.warning(f"FG {fg} unavailable ({name} failed at {failed}), trying next...")
+    return None, None
+
 async def handle_create(data):
     """Create firewall policy (failover: try first FG, if unavailable → second)"""
     hash_val, user, ip, ipv6, tcp, udp, fg_addr = _get_common(data)
@@ -89,56 +200,27 @@ async def handle_create(data):
     # Получаем policy_id, если уже есть
     policy_id = None
     if hash_val:
-        resp = await _post(f"{MHE_DB_URL}/query/policy_id/by_hash", json={"hash": hash_val})
+        resp = await _post(f"{st.config.db_url}/query/policy_id/by_hash", json={"hash": hash_val})
         if resp:
-            policy_id = resp.json().get("data", {}).get("policy_id")
-
-    # Failover: try first FG, if fail → second, etc.
-    for fg in fg_addr:
-        logger.info(f"Attempting create on FG: {fg}")
-        
-        # Sequential requests to maintain order (important!)
-        r1 = await _post(f"{FG_URL}/create_ip", json={"fg_addr": fg, "name": user, "ip": ip})
-        if r1 is None:
-            logger.warning(f"FG {fg} unavailable (create_ip failed), trying next...")
-            continue
-        await asyncio.sleep(0)  # Yield control for responsiveness
-        
-        r2 = await _post(f"{FG_URL}/create_ipv6", json={"fg_addr": fg, "name": user, "ipv6": ipv6})
-        if r2 is None:
-            logger.warning(f"FG {fg} unavailable (create_ipv6 failed), trying next...")
-            continue
-        await asyncio.sleep(0)
+            policy_id = (resp.json().get("data") or {}).get("policy_id")
 
-        if policy_id:
-            r3 = await _post(f"{FG_URL}/edit_policy", json={"fg_addr": fg, "action": "add", "policy_id": policy_id, "extra": {"user": user, "ip": ip, "ipv6": ipv6}})
-            if r3 is None:
-                logger.warning(f"FG {fg} unavailable (edit_policy failed), trying next...")
-                continue
-        else:
-            r3 = await _post(f"{FG_URL}/create_service", json={"fg_addr": fg, "name": hash_val, "tcp": inv_tcp, "udp": inv_udp})
-            if r3 is None:
-                logger.warning(f"FG {fg} unavailable (create_service failed), trying next...")
-                continue
-            await asyncio.sleep(0)
-            
-            resp = await _post(f"{FG_URL}/create_policy", json={"fg_addr": fg, "name": hash_val, "username": user})
-            if resp is None:
-                logger.warning(f"FG {fg} unavailable (create_policy failed), trying next...")
-                continue
-            new_policy_id = resp.json().get("mkey") if resp else None
-            await asyncio.sleep(0)
-            
-            r4 = await _post(f"{FG_URL}/move_policy_to_top", json={"fg_addr": fg, "policy_id": new_policy_id})
-            if new_policy_id:
-                await _post(f"{MHE_DB_URL}/policy_logs", json={"user": user, "fg": fg, "response": {"mkey": new_policy_id, "action": "create"}})
-                await _post(f"{MHE_DB_URL}/firewall_profiles/update_policy_id", json={"login": user, "hash": hash_val, "policy_id": new_policy_id})
-        
-        logger.info(f"Successfully created on FG: {fg}")
-        return {"policy_id": policy_id, "inverted_tcp": inv_tcp, "inverted_udp": inv_udp, "fg_used": fg}
-    
-    logger.error(f"All FortiGates unavailable for user {user}")
-    return {"error": "All FortiGates unavailable", "inverted_tcp": inv_tcp, "inverted_udp": inv_udp}
+    # Joining an existing policy goes through the membership batcher instead of a per-user policy edit
+    # (with address groups per hash fortiapi only changes the group, the policy is left alone)
+    batched = policy_id and not _groups_mode()
+    fg, result = await _workflow("provision", fg_addr, {
+        "user": user, "ip": ip, "ipv6": ipv6, "hash": hash_val, "tcp": inv_tcp, "udp": inv_udp, "policy_id": policy_id,
+        "membership": not batched,
+    }, after=batched and (lambda fg: membership.change(fg, policy_id, **_joins(user, ip, ipv6))))
+    if not fg:
+        logger.error(f"All FortiGates unavailable for user {user}")
+        return {"error": "All FortiGates unavailable", "inverted_tcp": inv_tcp, "inverted_udp": inv_udp}
+    if result.get("created_policy"):
+        new_policy_id = result["policy_id"]
+        await _post(f"{st.config.db_url}/firewall/firewall_profiles/update_policy_id", json={"login": user, "hash": hash_val, "policy_id": new_policy_id})
+    elif policy_id:
+        await _post(f"{st.config.db_url}/firewall/firewall_profiles/update_policy_id", json={"login": user, "hash": hash_val, "policy_id": policy_id})
+    logger.info(f"Successfully created on FG: {fg}")
+    return {"policy_id": result.get("policy_id") or policy_id, "inverted_tcp": inv_tcp, "inverted_udp": inv_udp, "fg_used": fg, "steps": result["steps"]}
 
 async def handle_edit(data):
     """Edit firewall policy (failover: try first FG, if unavailable → second)"""
@@ -149,85 +231,30 @@ async def handle_edit(data):
 
     policy_id_exists, policy_id_by_hash = False, None
     if policy_id and hash_val:
-        resp = await _put(f"{MHE_DB_URL}/query/policy_id/check", json={"policy_id": policy_id, "hash": hash_val})
+        resp = await _put(f"{st.config.db_url}/query/policy_id/check", json={"policy_id": policy_id, "hash": hash_val})
         if resp:
             chk = resp.json().get("data", {})
             policy_id_exists = chk.get("policy_id_exists", False)
             policy_id_by_hash = chk.get("policy_id_by_hash")
 
-    # Failover: try first FG, if fail → second, etc.
-    for fg in fg_addr:
-        logger.info(f"Attempting edit on FG: {fg}")
-        success = False
-        
-        # Вся логика по сути один if-elif блок
-        if not policy_id_exists and not policy_id_by_hash:
-            r1 = await _post(f"{FG_URL}/edit_policy", json={"fg_addr": fg, "action": "rename", "old_hash": old_hash, "new_hash": hash_val, "extra": {"user": user}})
-            if r1 is None:
-                continue
-            await asyncio.sleep(0)
-            r2 = await _post(f"{FG_URL}/delete_service", json={"fg_addr": fg, "name": old_hash})
-            if r2 is None:
-                continue
-            await asyncio.sleep(0)
-            r3 = await _post(f"{FG_URL}/create_service", json={"fg_addr": fg, "name": hash_val, "tcp": inv_tcp, "udp": inv_udp})
-            if r3 is not None:
-                success = True
-                result = {"renamed_policy_and_service": True, "fg_used": fg}
-        elif not policy_id_exists and policy_id_by_hash:
-            r1 = await _post(f"{FG_URL}/delete_policy", json={"fg_addr": fg, "policy_id": policy_id})
-            if r1 is None:
-                continue
-            await asyncio.sleep(0)
-            r2 = await _post(f"{FG_URL}/delete_service", json={"fg_addr": fg, "name": old_hash})
-            if r2 is None:
-                continue
-            await asyncio.sleep(0)
-            r3 = await _post(f"{FG_URL}/edit_policy", json={"fg_addr": fg, "action": "add", "policy_id": policy_id_by_hash, "extra": {"user": user, "ip": ip, "ipv6": ipv6}})
-            if r3 is not None:
-                success = True
-                result = {"migrated_to_policy_by_hash": True, "new_policy_id": policy_id_by_hash, "fg_used": fg}
-        elif policy_id_exists and not policy_id_by_hash:
-            r1 = await _post(f"{FG_URL}/edit_policy", json={"fg_addr": fg, "action": "remove", "policy_id": policy_id, "extra": {"user": user}})
-            if r1 is None:
-                continue
-            await asyncio.sleep(0)
-            r2 = await _post(f"{FG_URL}/create_ip", json={"fg_addr": fg, "name": user, "ip": ip})
-            if r2 is None:
-                continue
-            await asyncio.sleep(0)
-            r3 = await _post(f"{FG_URL}/create_ipv6", json={"fg_addr": fg, "name": user, "ipv6": ipv6})
-            if r3 is None:
-                continue
-            await asyncio.sleep(0)
-            r4 = await _post(f"{FG_URL}/create_service", json={"fg_addr": fg, "name": hash_val, "tcp": inv_tcp, "udp": inv_udp})
-            if r4 is None:
-                continue
-            await asyncio.sleep(0)
-            resp = await _post(f"{FG_URL}/create_policy", json={"fg_addr": fg, "name": hash_val, "username": user})
-            new_policy_id = resp.json().get("mkey") if resp else None
-            if new_policy_id:
-                await _post(f"{MHE_DB_URL}/firewall_profiles/update_policy_id", json={"login": user, "hash": hash_val, "policy_id": new_policy_id})
-                success = True
-                result = {"migrated_to_new_policy": True, "new_policy_id": new_policy_id, "fg_used": fg}
-        else:  # оба True
-            r1 = await _post(f"{FG_URL}/edit_policy", json={"fg_addr": fg, "action": "remove", "policy_id": policy_id, "extra": {"user": user}})
-            if r1 is None:
-                continue
-            await asyncio.sleep(0)
-            r2 = await _post(f"{FG_URL}/edit_policy", json={"fg_addr": fg, "action": "add", "policy_id": policy_id_by_hash, "extra": {"user": user, "ip": ip, "ipv6": ipv6}})
-            if r2 is not None:
-                success = True
-                result = {"moved_to_policy_by_hash": True, "old_policy_id": policy_id, "new_policy_id": policy_id_by_hash, "fg_used": fg}
-        
-        if success:
-            logger.info(f"Successfully edited on FG: {fg}")
-            return result
-        else:
-            logger.warning(f"FG {fg} unavailable, trying next...")
-    
-    logger.error(f"All FortiGates unavailable for user {user}")
-    return {"error": "All FortiGates unavailable"}
+    # Старая политика ещё нужна другим? Есть ли политика под новый hash? → один из четырёх сценариев
+    if not policy_id_exists:
+        mode = "join" if policy_id_by_hash else "rename"
+    else:
+        mode = "move" if policy_id_by_hash else "split"
+    fg, result = await _workflow("migrate", fg_addr, {
+        "mode": mode, "user": user, "ip": ip, "ipv6": ipv6, "hash": hash_val, "old_hash": old_hash,
+        "tcp": inv_tcp, "udp": inv_udp, "old_policy_id": policy_id, "policy_id": policy_id_by_hash,
+    })
+    if not fg:
+        logger.error(f"All FortiGates unavailable for user {user}")
+        return {"error": "All FortiGates unavailable"}
+
+    new_policy_id = result.get("policy_id")
+    if new_policy_id and new_policy_id != policy_id:
+        await _post(f"{st.config.db_url}/firewall/firewall_profiles/update_policy_id", json={"login": user, "hash": hash_val, "policy_id": new_policy_id})
+    logger.info(f"Successfully edited on FG: {fg} (mode={mode})")
+    return {"mode": mode, "old_policy_id": policy_id, "new_policy_id": new_policy_id, "fg_used": fg, "steps": result["steps"]}
 
 async def handle_delete(data):
     """Delete firewall policy (failover: try first FG, if unavailable → second)"""
@@ -240,60 +267,159 @@ async def handle_delete(data):
 
     found_policy = None
     if policy_id:
-        resp = await _delete(f"{MHE_DB_URL}/query/policy_id/check", json={"policy_id": policy_id})
+        resp = await _delete(f"{st.config.db_url}/query/policy_id/check", json={"policy_id": policy_id})
         if resp:
             found_policy = resp.json().get("data", {}).get("policy_id_exists")
 
-    # Failover: try first FG, if fail → second, etc.
-    for fg in fg_addr:
-        logger.info(f"Attempting delete on FG: {fg}")
-        
-        if policy_id:
-            r1 = await _post(f"{FG_URL}/edit_policy", json={"fg_addr": fg, "action": "remove", "policy_id": policy_id, "extra": {"user": user, "ip": ip, "ipv6": ipv6}})
-            if r1 is None:
-                logger.warning(f"FG {fg} unavailable, trying next...")
-                continue
-            await asyncio.sleep(0)
-        
-        if not found_policy:
-            r2 = await _post(f"{FG_URL}/delete_policy", json={"fg_addr": fg, "policy_id": policy_id})
-            if r2 is None:
-                continue
-            await asyncio.sleep(0)
-            r3 = await _post(f"{FG_URL}/delete_service", json={"fg_addr": fg, "name": hash_val})
-            if r3 is None:
-                continue
-            await asyncio.sleep(0)
-            r4 = await _post(f"{FG_URL}/delete_ip", json={"fg_addr": fg, "name": user})
-            if r4 is None:
-                continue
-            await asyncio.sleep(0)
-            r5 = await _post(f"{FG_URL}/delete_ipv6", json={"fg_addr": fg, "name": user})
-            if r5 is not None:
-                logger.info(f"Successfully deleted on FG: {fg}")
-                return {"deleted_policy": True, "fg_used": fg}
+    # Политику (и её сервис) удаляем, только если на неё больше никто не ссылается;
+    # иначе пользователя убирает из неё пакетное обновление состава до удаления адресов
+    leave = policy_id and found_policy is not False and not _groups_mode()
+    fg, result = await _workflow("deprovision", fg_addr, {
+        "user": user, "ip": ip, "ipv6": ipv6, "hash": hash_val, "policy_id": policy_id,
+        "delete_policy": found_policy is False, "membership": False,
+    }, before=leave and (lambda fg: membership.change(fg, policy_id, remove=[user], remove6=[f"{user}v6"])))
+    if not fg:
+        logger.error(f"All FortiGates unavailable for user {user}")
+        return {"error": "All FortiGates unavailable"}
+    logger.info(f"Successfully deleted on FG: {fg}")
+    if result.get("deleted_policy"):
+        return {"deleted_policy": True, "fg_used": fg, "steps": result["steps"]}
+    return {"removed_user_from_policy": True, "policy_id": policy_id, "fg_used": fg, "steps": result["steps"]}
+
+HANDLERS = {"create": handle_create, "edit": handle_edit, "delete": handle_delete}
+_background = set()
+
+def _priority(action, data):
+    if action == "create" and data.get("source") == "profile":
+        return PRIORITIES["interactive"]
+    return PRIORITIES.get(action, PRIORITIES["create"])
+
+async def _journaled(action, data):
+    """One operation between journal begin and end records (no end when cancelled: resumed after restart)"""
+    op_id = journal.begin(action, data)
+    start = time.perf_counter()
+    try:
+        result = await HANDLERS[action](data) or {}
+    except Exception as e:
+        journal.end(op_id, {"error": str(e)}, (time.perf_counter() - start) * 1000)
+        raise
+    journal.end(op_id, result, (time.perf_counter() - start) * 1000)
+    return result
+
+async def _apply(action, data, priority=None):
+    """Run one operation once: duplicates (retransmits, retries, replays) get the stored or in-flight result"""
+    current_priority.set(_priority(action, data) if priority is None else priority)
+    return await operations.run(operation_key(action, data), lambda: _journaled(action, data))
+
+coalescer = Coalescer(_apply)
+
+def _resume(interrupted):
+    """Operations cut off by the last shutdown: the latest one per user runs again (workflows converge on
+    what the interrupted run already created); older ones are superseded by it"""
+    latest = {record.get("login"): record for record in interrupted}
+    for record in interrupted:
+        resumed = st.AE_JOURNAL_RESUME and latest[record.get("login")] is record and record.get("action") in HANDLERS
+        journal.end(record["op_id"], {"error": "interrupted"}, 0.0, "interrupted, resumed" if resumed else "interrupted")
+        if not resumed:
+            continue
+        logger.warning(f"Resuming interrupted {record['action']} for {record.get('login')}")
+        if st.AE_DEBOUNCE_SECONDS > 0:
+            coalescer.submit(record["action"], record.get("data") or {})
+            continue
+        task = asyncio.create_task(_apply(record["action"], record.get("data") or {}))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+
+async def handle_batch(items):
+    """Run a queued batch of signals one by one (bulk profile import from mhe_db)"""
+    done = 0
+    for item in items:
+        action = item.get("action")
+        if action not in HANDLERS:
+            continue
+        result = await _apply(action, normalize(item.get("data") or {}), PRIORITIES["batch"])
+        if result.get("error"):
+            logger.error(f"Batch {action} failed: {result['error']}")
         else:
-            r2 = await _post(f"{FG_URL}/edit_policy", json={"fg_addr": fg, "action": "remove", "policy_id": policy_id, "extra": {"user": user}})
-            if r2 is None:
-                continue
-            await asyncio.sleep(0)
-            r3 = await _post(f"{FG_URL}/delete_service", json={"fg_addr": fg, "name": hash_val})
-            if r3 is None:
-                continue
-            await asyncio.sleep(0)
-            r4 = await _post(f"{FG_URL}/delete_ip", json={"fg_addr": fg, "name": user})
-            if r4 is None:
-                continue
-            await asyncio.sleep(0)
-            r5 = await _post(f"{FG_URL}/delete_ipv6", json={"fg_addr": fg, "name": user})
-            if r5 is not None:
-                logger.info(f"Successfully deleted on FG: {fg}")
-                return {"removed_user_from_policy": True, "policy_id": policy_id, "fg_used": fg}
-        
-        logger.warning(f"FG {fg} unavailable, trying next...")
-    
-    logger.error(f"All FortiGates unavailable for user {user}")
-    return {"error": "All FortiGates unavailable"}
+            done += 1
+    logger.info(f"Batch finished: {done}/{len(items)} signals processed")
+
+async def _snapshot(fg):
+    """Managed CMDB tables of one FG (breaker already acquired), None on failure"""
+    try:
+        async with scheduler.slot(fg, PRIORITIES["reconcile"]):
+            resp = await _post(f"{st.config.fortiapi_url}/snapshot", json={"fg_addr": fg}, timeout=st.FG_SNAPSHOT_TIMEOUT * 4)
+    except QueueFull as e:
+        logger.warning(f"Reconcile skips FG: {e}")
+        breakers.get(fg).release()
+        return None
+    result = resp.json() if resp else None
+    ok = bool(result and result.get("ok"))
+    tables = result.get("tables") if ok else None
+    # Breaker latency is per paged read, not per whole snapshot
+    breakers.get(fg).record(ok, result["ms"] / max(len(tables or {}), 1) if result and "ms" in result else 0.0,
+                            None if ok else "snapshot failed")
+    return tables
+
+async def _desired_state():
+    resp = await _get(f"{st.config.db_url}/firewall/desired_state", timeout=st.FG_SNAPSHOT_TIMEOUT)
+    body = resp.json() if resp else None
+    if not body or not body.get("success"):
+        return None
+    columns = body["data"]["columns"]
+    return [dict(zip(columns, row)) for row in body["data"]["rows"]]
+
+# Reconciler operation → fortiapi call (delete endpoints are DELETE with a JSON body)
+RECONCILE_OPS = {
+    "delete_policy": (_delete, "delete_policy", ("policy_id",)),
+    "set_policy_members": (_put, "set_policy_members", ("policy_id", "srcaddr", "srcaddr6")),
+    "delete_service": (_delete, "delete_service", ("name",)),
+    "delete_ip": (_delete, "delete_ip", ("name",)),
+    "delete_ipv6": (_delete, "delete_ipv6", ("name",)),
+    "update_ip": (_put, "update_ip", ("name", "ip")),
+    "set_group_members": (_put, "set_group_members", ("table", "name", "members")),
+    "delete_group": (_delete, "delete_group", ("table", "name")),
+}
+
+async def _reconcile_op(fg, op):
+    call, endpoint, fields = RECONCILE_OPS[op["op"]]
+    try:
+        async with scheduler.slot(fg, PRIORITIES["reconcile"]):
+            resp = await call(f"{st.config.fortiapi_url}/{endpoint}", json={"fg_addr": fg, **{f: op[f] for f in fields}})
+    except QueueFull:
+        return False
+    return bool(resp) and resp.json() is not None
+
+RECONCILE_KEY = "__reconcile__"
+
+def _repair(data):
+    """Forget AE's view of the user and queue a fresh create"""
+    coalescer.reset(data["user_name"])
+    operations.forget(data["user_name"])
+    coalescer.submit("create", data)
+
+def _reprovision(row):
+    """Online user with no objects on any FG of its group: repaired by the replica owning the user"""
+    data = {
+        "user_name": row["login"], "hash": row.get("hash"), "policy_id": row.get("policy_id"),
+        "tcp_rules": row.get("tcp_rules"), "udp_rules": row.get("udp_rules"),
+        "Framed-IP-Address": row.get("ip"), "Delegated-IPv6-Prefix": row.get("ipv6"),
+        "NAS-IP-Address": row.get("nas_ip"),
+    }
+    owner = sharding.owner(row["login"])
+    if owner == sharding.self_addr:
+        _repair(data)
+        return
+    task = asyncio.create_task(_forward(owner, {"action": "create", "data": data, "repair": True}))
+    _background.add(task)
+    task.add_done_callback(_background.discard)
+
+reconciler = Reconciler(_snapshot, _desired_state, _reconcile_op, coalescer.busy, _reprovision, breakers.available)
+
+@app.post("/reconcile")
+async def reconcile(apply: bool = False):
+    """One drift reconciliation run now; apply=false returns the planned operations only"""
+    return await reconciler.run(apply=apply)
 
 @app.post("/keepalive")
 def receive_keepalive(payload: dict):
@@ -305,30 +431,112 @@ def receive_keepalive(payload: dict):
         logger.error(f"Keepalive error: {e}")
         return {"success": False, "error": str(e)}
 
+async def _forward(owner, payload):
+    """Hand a signal to the replica owning its user(s); None only if it never reached that replica.
+
+    The owner may run FortiGate workflows before answering, so the call gets AE_WORKFLOW_TIMEOUT;
+    once the request is sent, a timeout or error is that replica's result, not a reason to run it here too."""
+    url = f"http://{owner}/signal"
+    try:
+        resp = await async_client.post(url, json=payload, headers={FORWARDED_HEADER: sharding.self_addr},
+                                       timeout=st.AE_WORKFLOW_TIMEOUT)
+    except (httpx.ConnectError, httpx.ConnectTimeout, httpx.PoolTimeout) as e:
+        logger.error(f"POST {url} failed: {e}")
+        sharding.stats["forward_failed"] += 1
+        return None
+    except Exception as e:
+        logger.error(f"POST {url} failed after sending: {e}")
+        sharding.stats["forwarded"] += 1
+        return {"error": f"owner {owner}: {e}"}
+    sharding.stats["forwarded"] += 1
+    if not resp.is_success:
+        logger.error(f"POST {url} failed: {resp.status_code}")
+        return {"error": f"owner {owner}: HTTP {resp.status_code}"}
+    return resp.json().get("result") or {}
+
+async def _route(action, data):
+    """Forward what other replicas own; returns the part to handle here and what was forwarded"""
+    if action == "batch":
+        items = data if isinstance(data, list) else []
+        groups = sharding.split([(normalize(item.get("data") or {}).get("user_name"), item) for item in items])
+        local = groups.pop(sharding.self_addr, [])
+        owners = list(groups)
+        results = await asyncio.gather(*(_forward(owner, {"action": "batch", "data": groups[owner]}) for owner in owners))
+        for owner, result in zip(owners, results):
+            if result is None:
+                # Owner unreachable: better out of order than lost
+                logger.warning(f"Forward of {len(groups[owner])} signals to {owner} failed, handling them here")
+                local.extend(groups[owner])
+        return local, {owner: len(groups[owner]) for owner, result in zip(owners, results) if result is not None}
+    owner = sharding.owner(data.get("user_name")) if isinstance(data, dict) else sharding.self_addr
+    if owner != sharding.self_addr:
+        result = await _forward(owner, {"action": action, "data": data})
+        if result is not None:
+            return None, {"owner": owner, "result": result}
+        logger.warning(f"Forward of {action} for {data.get('user_name')} to {owner} failed, handling it here")
+    return data, None
+
 @app.post("/signal")
 async def receive_signal(request: Request):
     payload = await request.json()
-    logger.info(f"Received signal: {payload}")
+    logger.info(f"Received signal: {payload}" if payload.get("action") != "batch" else f"Received batch of {len(payload.get('data') or [])} signals")
     action = payload.get("action")
     data = payload.get("data", {})
     if action in ["create", "edit", "delete"]:
-        logger.info(f"Processing {action} signal for user: {data.get('user_name', data.get('login', 'unknown'))}")
+        data = normalize(data)
+        logger.info(f"Processing {action} signal for user: {data.get('user_name', 'unknown')}")
+
+    forwarded = None
+    if sharding.enabled and not request.headers.get(FORWARDED_HEADER) and action in ("create", "edit", "delete", "batch"):
+        data, forwarded = await _route(action, data)
+        if data is None:
+            return {"success": True, "result": {"forwarded": forwarded}}
+    sharding.stats["local"] += 1
+    if payload.get("repair") and action == "create":
+        _repair(data)
+        return {"success": True, "result": {"queued": 1, "repair": True}}
 
     result = {"error": "Unsupported action"}
-    if action == "create":
-        result = await handle_create(data)
-    elif action == "edit":
-        result = await handle_edit(data)
-    elif action == "delete":
-        result = await handle_delete(data)
+    if st.AE_DEBOUNCE_SECONDS > 0 and action in ("create", "edit", "delete", "batch"):
+        # Desired-state mode: signals only update per-user desired state, FortiGate work runs after the window
+        items = (data if isinstance(data, list) else []) if action == "batch" else [{"action": action, "data": data}]
+        queued = sum(coalescer.submit(item.get("action"), item.get("data") or {}) for item in items)
+        result = {"queued": queued, "debounce_s": st.AE_DEBOUNCE_SECONDS}
+    elif action in HANDLERS:
+        result = await _apply(action, data)
+    elif action == "batch":
+        items = data if isinstance(data, list) else []
+        task = asyncio.create_task(handle_batch(items))
+        _background.add(task)
+        task.add_done_callback(_background.discard)
+        result = {"queued": len(items)}
     else:
         logger.warning(f"Unknown action received: {action}")
 
+    if forwarded:
+        result = {**result, "forwarded": forwarded}
     return {"success": True, "result": result}
 
 @app.get("/health")
 def health_check():
-    return {"status": "ok", "service": "mhe_ae"}
+    return {"status": "ok", "service": "mhe_ae", "fortigates": breakers.snapshot(),
+            "signals": {**coalescer.stats, "pending_users": coalescer.pending()}, "reconcile": reconciler.last,
+            "invert_cache": _invert_canonical.cache_info()._asdict(), "config": st.config.summary(),
+            "idempotency": operations.snapshot(), "scheduler": scheduler.snapshot(),
+            "membership": membership.snapshot(), "shard": sharding.snapshot(), "journal": journal.snapshot()}
+
+@app.get("/scheduler")
+def scheduler_stats():
+    """Per-FortiGate queue depth, in-flight calls, token bucket and queue wait times"""
+    return scheduler.snapshot()
+
+@app.get("/state/{login}")
+def user_state(login: str, request: Request):
+    """Last applied and desired FortiGate state AE holds for a user (kept by the replica owning it)"""
+    owner = sharding.owner(login)
+    if owner != sharding.self_addr and not request.headers.get(FORWARDED_HEADER):
+        return RedirectResponse(f"http://{owner}/state/{login}", status_code=307)
+    return coalescer.snapshot(login) or {"applied": None, "known": False, "uncertain": False, "desired": None, "pending_signals": 0}
 
 if __name__ == "__main__":
     import uvicorn
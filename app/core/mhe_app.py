@@ -1,4 +1,3 @@
-import json
 import logging
 from fastapi import FastAPI, HTTPException, Response, status, Query, Body
 from fastapi.responses import ORJSONResponse
@@ -10,10 +9,11 @@ from app.models.fastclass import (
     PrettyJSONResponse,
 )
 from pydantic import BaseModel
-from app.config.env import st
+from app.config.env import st, watch_config
 import requests
 from pathlib import Path
 from logging.handlers import RotatingFileHandler
+from contextlib import asynccontextmanager
 
 logger = logging.getLogger("mhe_app")
 if not logger.handlers:
@@ -22,9 +22,14 @@ if not logger.handlers:
     handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
     logger.addHandler(handler)
     logger.setLevel(logging.INFO)
-app = FastAPI()
 
-MHE_DB_URL = f"http://{st.MHE_DB_HOST}:{st.MHE_DB_PORT}"
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Port matrix and service URLs come from the config snapshot, reloaded on file change / SIGHUP
+    watch_config()
+    yield
+
+app = FastAPI(lifespan=lifespan)
 
 class KeepaliveRequest(BaseModel):
     login: str
@@ -33,7 +38,7 @@ _SESSION = requests.Session()
 
 def db_request(method: str, path: str, **kwargs):
     try:
-        resp = _SESSION.request(method.upper(), f"{MHE_DB_URL}{path}", timeout=3, **kwargs)
+        resp = _SESSION.request(method.upper(), f"{st.config.db_url}{path}", timeout=3, **kwargs)
         resp.raise_for_status()
         js = resp.json()
         if not js.get("success", True):
@@ -51,14 +56,14 @@ def db_request(method: str, path: str, **kwargs):
 
 @app.get("/api/firewall_profile_rules", response_class=ORJSONResponse)
 async def get_firewall_profiles(page: int = 1, page_size: int = 25):
-    with open('app/config/ports.json') as f:
-        raw_data = json.load(f)
-    return FirewallProfilePagination(raw_data, page_size).paginate(page)
+    return FirewallProfilePagination([dict(p) for p in st.config.profiles], page_size).paginate(page)
 
 @app.get("/api/firewall_custom_profile_unauthorized", response_class=PrettyJSONResponse)
 async def get_custom_profile(logins: str):
     login_set = {l.strip() for l in logins.split(',') if l.strip()}
-    resp = db_request("GET", "/firewall_profiles", params={"page": 1, "page_size": 10000, "login": None})
+    if not login_set:
+        raise HTTPException(status_code=404, detail="Профиль не найден")
+    resp = db_request("GET", "/firewall_profiles", params={"logins": ",".join(sorted(login_set)), "page_size": len(login_set)})
     profiles = resp.get("data", []) or []
     result = {p['login']: p for p in profiles if p['login'] in login_set}
     if not result:
@@ -70,7 +75,7 @@ async def create_custom_profile(profile_data: CreateProfileRequest):
     required = (profile_data.name, profile_data.login, profile_data.tcp_rules, profile_data.udp_rules)
     if not all(required):
         raise HTTPException(status_code=400, detail="Недостаточно данных для создания профиля")
-    resp = db_request("GET", "/firewall_profiles", params={"page": 1, "page_size": 10000, "login": profile_data.login})
+    resp = db_request("GET", "/firewall_profiles", params={"login": profile_data.login, "page_size": 1})
     profiles = resp.get("data", []) or []
     if any(p['login'] == profile_data.login for p in profiles):
         raise HTTPException(status_code=400, detail=f"Профиль для логина {profile_data.login} уже существует")
@@ -134,7 +139,7 @@ async def receive_keepalive(keepalive_data: KeepaliveRequest = Body(...)):
     login = keepalive_data.login
     logger.info(f"Received keepalive for login: {login}")
     try:
-        url = f"http://{st.MHE_AE_HOST}:{st.MHE_AE_PORT}/keepalive"
+        url = f"{st.config.ae_url}/keepalive"
         result = _SESSION.post(url, json={"login": login}, timeout=2)
         if result.status_code == 200:
             return {"success": True, "message": f"Keepalive forwarded for {login}"}
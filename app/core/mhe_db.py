@@ -1,10 +1,17 @@
+import asyncio
 import logging
 from logging.handlers import RotatingFileHandler
 from pathlib import Path
+from contextlib import asynccontextmanager
 from fastapi import FastAPI
 from app.routers.routes_firewall import router as firewall_router
-from app.routers.routes_radius import router as radius_router
-from app.routers.routes_query import router as query_router
+from app.routers.routes_radius import router as radius_router, seed_sessions, session_removal_flusher
+from app.routers.routes_query import router as query_router, policy_index_refresher
+from app.db import aio
+from app.db import query as q
+from app.db.pool import pools
+from app.db.policies import policies
+from app.config.env import st, watch_config
 
 log_dir = Path("logs")
 log_dir.mkdir(exist_ok=True)
@@ -13,11 +20,43 @@ handler.setFormatter(logging.Formatter("%(asctime)s - %(name)s - %(levelname)s -
 logging.basicConfig(level=logging.INFO, handlers=[handler])
 logging.getLogger("uvicorn.access").handlers = []
 
-app = FastAPI()
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Startup: open the shared pools off the loop, seed in-memory RADIUS session registry, start batched stop flusher
+    # and the policy index (lookups fall back to SQL until it is seeded); service URLs follow config reloads
+    watch_config()
+    await aio.run_blocking(pools.warm, "radius", "firewall", "query", timeout=0)
+    await seed_sessions()
+    flusher = asyncio.create_task(session_removal_flusher())
+    policy_refresher = asyncio.create_task(policy_index_refresher())
+    lag_monitor = asyncio.create_task(aio.monitor_loop_lag())
+    yield
+    # Shutdown: cancel flusher (it flushes pending removals on the way out)
+    lag_monitor.cancel()
+    policy_refresher.cancel()
+    flusher.cancel()
+    try:
+        await flusher
+    except asyncio.CancelledError:
+        pass
+    aio.executor.shutdown(wait=True)
+
+app = FastAPI(lifespan=lifespan)
 app.include_router(firewall_router, prefix="/firewall")
 app.include_router(radius_router, prefix="/radius")
 app.include_router(query_router, prefix="/query")
 
+@app.get("/metrics")
+def metrics():
+    """Executor, connection-pool and event-loop lag metrics (loop lag stays near zero when nothing blocks it)"""
+    return {**aio.stats(), "pools": pools.stats(), "policy_index": policies.stats(),
+            "config": st.config.summary()}
+
+@app.get("/debug/statements")
+def debug_statements(reset: bool = False):
+    """Per-statement call counts and latency histograms, slowest total first (reset=true clears them)"""
+    return q.stats(reset)
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=80, log_config=None)
@@ -11,13 +11,13 @@ from datetime import datetime, timedelta, time as dt_time
 from concurrent.futures import ThreadPoolExecutor
 from contextlib import asynccontextmanager
 
-import mysql.connector
-from mysql.connector import pooling
 import requests
 from fastapi import FastAPI, Query
 from fastapi.responses import HTMLResponse, StreamingResponse, JSONResponse
 
 from app.config.env import st
+from app.db.pool import pools
+from app.db import query as q
 
 EXTENDED_COLUMNS = [
     "action", "date", "dstcountry", "dstip", "dstport",
@@ -26,6 +26,11 @@ EXTENDED_COLUMNS = [
     "service", "url", "httpagent", "level", "threat"
 ]
 
+q.register("utm_logs_by_user_date", (
+    f"SELECT {', '.join(f'`{c}`' for c in EXTENDED_COLUMNS)} FROM UTMLogs "
+    "WHERE `user` = %s AND `reporting_date` = %s ORDER BY `event_time` ASC"
+))
+
 # --- Simple Logging ---
 def setup_logging():
     Path("logs").mkdir(exist_ok=True)
@@ -37,18 +42,8 @@ setup_logging()
 logger = logging.getLogger(__name__)
 
 # --- Connection Pool ---
-# Reuse DB connections for better performance (saves ~15-20ms per query)
-try:
-    db_pool = pooling.MySQLConnectionPool(
-        pool_name="starrocks_pool",
-        pool_size=50,  # Max 50 concurrent connections (для 1000+ пользователей)
-        pool_reset_session=True,
-        **getattr(st, 'starrocks_config', st.mysql_config)
-    )
-    logger.info("Database connection pool created (size=50)")
-except Exception as e:
-    logger.error(f"Failed to create connection pool: {e}")
-    db_pool = None
+# DB connections come from the shared pool manager ("email" class, sized by DB_POOL_SIZES),
+# created lazily on the first report query
 
 # --- Thread Pool for blocking I/O ---
 # Used for parallel processing of DB queries and email sending
@@ -60,7 +55,7 @@ async def lifespan(app: FastAPI):
     # Startup: resources are already initialized above
     yield
     # Shutdown: cleanup resources
-    logger.info("Shutting down: cleaning up executor and connection pool")
+    logger.info("Shutting down: cleaning up executor")
     executor.shutdown(wait=True, cancel_futures=False)
     logger.info("Executor shut down successfully")
 
@@ -129,28 +124,9 @@ def query_utmlogs_by_user_and_reporting_date(login, reporting_date):
         List of rows with all UTM log columns
     """
     try:
-        # StarRocks (MySQL protocol) as primary storage
-        # Uses connection pool for better performance (~15-20ms faster)
-        if db_pool:
-            cnx = db_pool.get_connection()
-        else:
-            cnx = mysql.connector.connect(**getattr(st, 'starrocks_config', st.mysql_config))
-        
-        cursor = cnx.cursor()
-        cols = ", ".join(f"`{c}`" for c in EXTENDED_COLUMNS)
-        cursor.execute(
-            f"""
-            SELECT {cols}
-            FROM UTMLogs
-            WHERE `user` = %s AND `reporting_date` = %s
-            ORDER BY `event_time` ASC
-            """,
-            (login, reporting_date),
-        )
-        rows = cursor.fetchall()
-        cursor.close()
-        cnx.close()
-        return rows
+        # StarRocks (MySQL protocol) as primary storage, via the shared "email" pool
+        with pools.connection("email") as (cnx, cursor):
+            return q.fetchall(cnx, cursor, "utm_logs_by_user_date", (login, reporting_date))
     except Exception as e:
         logger.error(f"DB query failed for {login}, reporting_date={reporting_date}: {e}")
         return []
@@ -349,6 +325,11 @@ def download_excel(token: str = Query(...)):
 def health():
     return {"status": "ok", "service": "mhe_email"}
 
+@app.get("/debug/statements")
+def debug_statements(reset: bool = False):
+    """Per-statement call counts and latency histograms (reset=true clears them)"""
+    return {**q.stats(reset), "pools": pools.stats()}
+
 if __name__ == "__main__":
     import uvicorn
 
@@ -0,0 +1,398 @@
+import asyncio
+import logging
+import random
+import time
+from logging.handlers import RotatingFileHandler
+from pathlib import Path
+from typing import Dict, List, Optional
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from app.config.env import st
+
+# Local FortiOS REST API emulator for load tests of mhe_ae + mhe_fortiapi without a FortiGate.
+# Emulates the /api/v2/cmdb tables fortiapi uses (address, address6, addrgrp, addrgrp6, service custom,
+# policy with move and member sub-resources) plus /api/v2/monitor/system/status, with an in-memory
+# config per emulated device. Devices are told apart by the Host header, so one process on
+# 0.0.0.0:FGEMU_PORT serves every FortiGate listed as 127.0.0.x:FGEMU_PORT in FORTI_GATE.
+# Point fortiapi at it with FG_SCHEME=http.
+
+logger = logging.getLogger("mhe_fgemu")
+if not logger.handlers:
+    Path("logs").mkdir(exist_ok=True)
+    handler = RotatingFileHandler("logs/mhe_fgemu.log", maxBytes=10*1024*1024, backupCount=5, encoding="utf-8")
+    handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+
+# CMDB table → key field
+TABLES = {
+    "firewall/address": "name",
+    "firewall/address6": "name",
+    "firewall/addrgrp": "name",
+    "firewall/addrgrp6": "name",
+    "firewall.service/custom": "name",
+    "firewall/policy": "policyid",
+}
+
+# Member fields that must name existing objects (table, field) → tables searched
+REFERENCES = {
+    ("firewall/policy", "srcaddr"): ("firewall/address", "firewall/addrgrp"),
+    ("firewall/policy", "srcaddr6"): ("firewall/address6", "firewall/addrgrp6"),
+    ("firewall/policy", "service"): ("firewall.service/custom",),
+    ("firewall/addrgrp", "member"): ("firewall/address", "firewall/addrgrp"),
+    ("firewall/addrgrp6", "member"): ("firewall/address6", "firewall/addrgrp6"),
+}
+
+# Member fields FortiOS refuses to leave empty
+REQUIRED = {("firewall/policy", "srcaddr"), ("firewall/addrgrp", "member"), ("firewall/addrgrp6", "member")}
+
+# FortiOS CMDB error codes
+ERR_NOT_FOUND = -3
+ERR_DUPLICATE = -5
+ERR_IN_USE = -23
+ERR_EMPTY = -651
+
+BUILTIN = {"firewall/address": ("all", "none"), "firewall/address6": ("all", "none")}
+
+
+class Faults:
+    """Injected behaviour, from FGEMU_* settings; changed at runtime with POST /emu/faults"""
+
+    FIELDS = ("latency_ms", "jitter_ms", "write_ms", "member_us", "error_rate", "timeout_rate", "timeout_s", "concurrency")
+
+    def __init__(self):
+        self.latency_ms = st.FGEMU_LATENCY_MS
+        self.jitter_ms = st.FGEMU_JITTER_MS
+        self.write_ms = st.FGEMU_WRITE_MS
+        self.member_us = st.FGEMU_MEMBER_US
+        self.error_rate = st.FGEMU_ERROR_RATE
+        self.timeout_rate = st.FGEMU_TIMEOUT_RATE
+        self.timeout_s = st.FGEMU_TIMEOUT_SECONDS
+        self.concurrency = st.FGEMU_CONCURRENCY
+
+    def update(self, values: dict):
+        for field in self.FIELDS:
+            if field in values:
+                setattr(self, field, type(getattr(self, field))(values[field]))
+
+    def as_dict(self) -> dict:
+        return {field: getattr(self, field) for field in self.FIELDS}
+
+
+class APIError(Exception):
+    def __init__(self, code: int, http_status: int = 500):
+        self.code = code
+        self.http_status = http_status
+
+
+class Device:
+    """In-memory CMDB of one emulated FortiGate"""
+
+    def __init__(self, host: str):
+        self.host = host
+        self.revision = 0
+        self.tables: Dict[str, Dict[str, dict]] = {t: {} for t in TABLES}
+        for table, names in BUILTIN.items():
+            for name in names:
+                self.tables[table][name] = {"name": name}
+        self.next_policyid = 1
+        self.limiter = asyncio.Semaphore(faults.concurrency)
+        self.stats = {"requests": 0, "writes": 0, "errors": 0, "injected_errors": 0, "injected_timeouts": 0,
+                      "in_flight": 0, "max_in_flight": 0, "queue_ms_total": 0.0, "queue_ms_max": 0.0}
+
+    def _bump(self):
+        self.revision += 1
+
+    @property
+    def revision_id(self) -> str:
+        return f"{self.revision:032x}"
+
+    def table(self, path: str) -> Dict[str, dict]:
+        if path not in self.tables:
+            raise APIError(ERR_NOT_FOUND, 404)
+        return self.tables[path]
+
+    def get(self, path: str, mkey: str) -> dict:
+        obj = self.table(path).get(mkey)
+        if obj is None:
+            raise APIError(ERR_NOT_FOUND, 404)
+        return obj
+
+    def _check_refs(self, path: str, obj: dict):
+        for (table, field), targets in REFERENCES.items():
+            if table != path or field not in obj:
+                continue
+            if (table, field) in REQUIRED and not obj[field]:
+                raise APIError(ERR_EMPTY)
+            for ref in obj[field]:
+                if not any(ref.get("name") in self.tables[t] for t in targets):
+                    raise APIError(ERR_NOT_FOUND)
+
+    def _used(self, path: str, name: str) -> bool:
+        for (table, field), targets in REFERENCES.items():
+            if path in targets and any(any(r.get("name") == name for r in o.get(field) or []) for o in self.tables[table].values()):
+                return True
+        return False
+
+    def create(self, path: str, body: dict) -> str:
+        rows = self.table(path)
+        key = TABLES[path]
+        obj = dict(body)
+        if key == "policyid":
+            obj["policyid"] = int(obj.get("policyid") or self.next_policyid)
+            self.next_policyid = max(self.next_policyid, obj["policyid"]) + 1
+        mkey = str(obj.get(key) or "")
+        if not mkey:
+            raise APIError(ERR_NOT_FOUND)
+        if mkey in rows:
+            raise APIError(ERR_DUPLICATE)
+        self._check_refs(path, obj)
+        rows[mkey] = obj
+        self._bump()
+        return mkey
+
+    def update(self, path: str, mkey: str, body: dict) -> str:
+        obj = self.get(path, mkey)
+        merged = {**obj, **body}
+        self._check_refs(path, merged)
+        new_key = str(merged.get(TABLES[path]))
+        rows = self.tables[path]
+        if new_key != mkey:
+            # Rename: references follow the object, as on FortiOS
+            if new_key in rows:
+                raise APIError(ERR_DUPLICATE)
+            del rows[mkey]
+            self._rename_refs(path, mkey, new_key)
+        rows[new_key] = merged
+        self._bump()
+        return new_key
+
+    def _rename_refs(self, path: str, old: str, new: str):
+        for (table, field), targets in REFERENCES.items():
+            if path in targets:
+                for o in self.tables[table].values():
+                    for ref in o.get(field) or []:
+                        if ref.get("name") == old:
+                            ref["name"] = new
+
+    def delete(self, path: str, mkey: str):
+        self.get(path, mkey)
+        if mkey in BUILTIN.get(path, ()) or self._used(path, mkey):
+            raise APIError(ERR_IN_USE)
+        del self.tables[path][mkey]
+        self._bump()
+
+    def move(self, mkey: str, before: Optional[str], after: Optional[str]):
+        rows = self.tables["firewall/policy"]
+        obj = self.get("firewall/policy", mkey)
+        anchor = before or after
+        if anchor not in rows:
+            raise APIError(ERR_NOT_FOUND)
+        if anchor != mkey:
+            order = [k for k in rows if k != mkey]
+            at = order.index(anchor) + (0 if before else 1)
+            order.insert(at, mkey)
+            reordered = {k: (obj if k == mkey else rows[k]) for k in order}
+            rows.clear()
+            rows.update(reordered)
+        self._bump()
+
+    def add_member(self, path: str, mkey: str, field: str, name: str):
+        obj = self.get(path, mkey)
+        members = obj.setdefault(field, [])
+        if any(m.get("name") == name for m in members):
+            raise APIError(ERR_DUPLICATE)
+        self._check_refs(path, {field: [{"name": name}]})
+        members.append({"name": name})
+        self._bump()
+
+    def remove_member(self, path: str, mkey: str, field: str, name: str):
+        obj = self.get(path, mkey)
+        members = obj.get(field) or []
+        if not any(m.get("name") == name for m in members):
+            raise APIError(ERR_NOT_FOUND, 404)
+        if (path, field) in REQUIRED and len(members) == 1:
+            raise APIError(ERR_EMPTY)
+        obj[field] = [m for m in members if m.get("name") != name]
+        self._bump()
+
+    def size(self, path: str, mkey: Optional[str]) -> int:
+        """Members of an object: what a write of it costs the management plane"""
+        obj = self.tables.get(path, {}).get(mkey or "") or {}
+        return sum(len(v) for v in obj.values() if isinstance(v, list))
+
+    def snapshot(self) -> dict:
+        s = self.stats
+        return {**{k: v for k, v in s.items() if k != "queue_ms_total"},
+                "queue_ms_avg": round(s["queue_ms_total"] / s["requests"], 2) if s["requests"] else 0.0,
+                "queue_ms_max": round(s["queue_ms_max"], 2), "revision": self.revision,
+                "objects": {t: len(rows) for t, rows in self.tables.items()}}
+
+
+faults = Faults()
+devices: Dict[str, Device] = {}
+
+app = FastAPI()
+
+
+def _device(request: Request) -> Device:
+    host = request.headers.get("host") or "default"
+    device = devices.get(host)
+    if device is None:
+        device = devices[host] = Device(host)
+        logger.info(f"Emulated FortiGate {host} created")
+    return device
+
+
+def _fields(obj: dict, fmt: Optional[str]) -> dict:
+    if not fmt:
+        return obj
+    keep = fmt.split("|")
+    return {k: v for k, v in obj.items() if k in keep}
+
+
+def _ok(device: Device, method: str, request: Request, **extra) -> dict:
+    return {"http_method": method, "revision": device.revision_id, "revision_changed": method != "GET",
+            "vdom": request.query_params.get("vdom", "root"), "status": "success", "http_status": 200, **extra}
+
+
+async def _admitted(device: Device, request: Request, write_cost: int, handler):
+    """Management-plane model: FGEMU_CONCURRENCY calls at a time per device, each taking the injected latency"""
+    start = time.perf_counter()
+    async with device.limiter:
+        waited = (time.perf_counter() - start) * 1000
+        s = device.stats
+        s["requests"] += 1
+        s["queue_ms_total"] += waited
+        s["queue_ms_max"] = max(s["queue_ms_max"], waited)
+        s["in_flight"] += 1
+        s["max_in_flight"] = max(s["max_in_flight"], s["in_flight"])
+        try:
+            roll = random.random()
+            if roll < faults.timeout_rate:
+                s["injected_timeouts"] += 1
+                await asyncio.sleep(faults.timeout_s)
+                return JSONResponse({"status": "error", "http_status": 504}, status_code=504)
+            if roll < faults.timeout_rate + faults.error_rate:
+                s["injected_errors"] += 1
+                return JSONResponse({"status": "error", "http_status": 503, "error": -1}, status_code=503)
+            delay = faults.latency_ms + random.uniform(-faults.jitter_ms, faults.jitter_ms)
+            if request.method != "GET":
+                s["writes"] += 1
+                delay += faults.write_ms + write_cost * faults.member_us / 1000
+            await asyncio.sleep(max(delay, 0) / 1000)
+            try:
+                return handler()
+            except APIError as e:
+                s["errors"] += 1
+                return JSONResponse({"http_method": request.method, "status": "error", "http_status": e.http_status,
+                                     "error": e.code, "vdom": request.query_params.get("vdom", "root")},
+                                    status_code=e.http_status)
+        finally:
+            s["in_flight"] -= 1
+
+
+@app.get("/api/v2/monitor/system/status")
+async def system_status(request: Request):
+    device = _device(request)
+    return await _admitted(device, request, 0, lambda: _ok(device, "GET", request, results={
+        "model_name": "FortiGate", "model_number": "EMU", "hostname": device.host}, version="v7.2.8"))
+
+
+@app.api_route("/api/v2/cmdb/{path:path}", methods=["GET", "POST", "PUT", "DELETE"])
+async def cmdb(path: str, request: Request):
+    device = _device(request)
+    parts = path.strip("/").split("/")
+    table, rest = "/".join(parts[:2]), parts[2:]
+    method = request.method
+    body = {}
+    if method in ("POST", "PUT"):
+        raw = await request.body()
+        if raw:
+            try:
+                body = await request.json()
+            except ValueError:
+                return JSONResponse({"status": "error", "http_status": 400, "error": -1}, status_code=400)
+    q = request.query_params
+    mkey = rest[0] if rest else None
+
+    def handle():
+        if not rest:
+            if method == "GET":
+                rows = list(device.table(table).values())
+                start, count = int(q.get("start", 0)), int(q.get("count", 0)) or len(rows)
+                return _ok(device, method, request, results=[_fields(r, q.get("format")) for r in rows[start:start + count]])
+            if method == "POST":
+                return _ok(device, method, request, mkey=_mkey(device.create(table, body)))
+        elif len(rest) == 1:
+            if method == "GET":
+                return _ok(device, method, request, results=[_fields(device.get(table, mkey), q.get("format"))])
+            if method == "PUT" and q.get("action") == "move":
+                device.move(mkey, q.get("before"), q.get("after"))
+                return _ok(device, method, request, mkey=_mkey(mkey))
+            if method == "PUT":
+                return _ok(device, method, request, mkey=_mkey(device.update(table, mkey, body)))
+            if method == "DELETE":
+                device.delete(table, mkey)
+                return _ok(device, method, request, mkey=_mkey(mkey))
+        elif len(rest) == 2:
+            if method == "GET":
+                return _ok(device, method, request, results=device.get(table, mkey).get(rest[1]) or [])
+            if method == "POST":
+                device.add_member(table, mkey, rest[1], body.get("name"))
+                return _ok(device, method, request, mkey=body.get("name"))
+        elif len(rest) == 3 and method == "DELETE":
+            device.remove_member(table, mkey, rest[1], rest[2])
+            return _ok(device, method, request, mkey=rest[2])
+        raise APIError(ERR_NOT_FOUND, 404)
+
+    cost = device.size(table, mkey) + sum(len(v) for v in body.values() if isinstance(v, list))
+    return await _admitted(device, request, cost, handle)
+
+
+def _mkey(key):
+    return int(key) if str(key).isdigit() else key
+
+
+@app.get("/emu/stats")
+def emu_stats():
+    """Per emulated device: calls, queueing behind the concurrency limit, injected faults, object counts"""
+    return {"faults": faults.as_dict(), "devices": {host: d.snapshot() for host, d in devices.items()}}
+
+
+@app.post("/emu/faults")
+def emu_faults(values: dict):
+    """Change latency / error / timeout injection and the concurrency limit while running"""
+    faults.update(values)
+    for device in devices.values():
+        device.limiter = asyncio.Semaphore(faults.concurrency)
+    logger.info(f"Faults set: {faults.as_dict()}")
+    return faults.as_dict()
+
+
+@app.post("/emu/reset")
+def emu_reset():
+    """Forget every emulated device's config and counters"""
+    devices.clear()
+    return {"ok": True}
+
+
+@app.get("/emu/config/{host}")
+def emu_config(host: str, table: Optional[str] = None):
+    device = devices.get(host)
+    if device is None:
+        return JSONResponse({"error": "unknown device"}, status_code=404)
+    tables: List[str] = [table] if table else list(TABLES)
+    return {t: list(device.tables.get(t, {}).values()) for t in tables}
+
+
+@app.get("/health")
+def health_check():
+    return {"status": "ok", "service": "mhe_fgemu", "devices": len(devices)}
+
+
+if __name__ == "__main__":
+    import uvicorn
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
+    uvicorn.run(app, host="0.0.0.0", port=st.FGEMU_PORT)
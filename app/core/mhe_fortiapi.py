@@ -1,14 +1,24 @@
+import asyncio
 import logging
 import json
+import time
 import httpx
 from pathlib import Path
+from urllib.parse import quote
 from logging.handlers import RotatingFileHandler
 from contextlib import asynccontextmanager
 from fastapi import FastAPI
+from pydantic import ValidationError
 from app.config.env import st
+from app.fortiapi.workflow import DEVICE, REFUSED, Workflow, fault_of, fault_scope, report_fault
+from app.fortiapi.policy_cache import NONE_ADDRESS, policy_cache
+from app.fortiapi.sessions import HTTP2_AVAILABLE, sessions
 from app.models.fortigate_models import (
     CreateIPRequest, CreateIPv6Request, CreateServiceRequest, CreatePolicyRequest,
-    DeleteObjectRequest, DeletePolicyRequest, MovePolicyRequest, GetPolicyRequest, EditPolicyRequest
+    DeleteObjectRequest, DeletePolicyRequest, MovePolicyRequest, GetPolicyRequest, EditPolicyRequest,
+    ProvisionUserRequest, MigrateUserRequest, DeprovisionUserRequest, ProbeRequest,
+    SnapshotRequest, UpdateIPRequest, PolicyMembersRequest, PolicyMembersPatchRequest,
+    GroupMembersRequest, DeleteGroupRequest
 )
 
 logger = logging.getLogger("mhe_fortiapi")
@@ -19,82 +29,124 @@ if not logger.handlers:
     logger.addHandler(handler)
     logger.setLevel(logging.INFO)
 
-API_TOKEN = st.API_TOKEN
-
-# Async HTTP client for non-blocking I/O
-async_client = httpx.AsyncClient(verify=False, timeout=3.0)
-logger.info("FortiAPI async HTTP client created (httpx)")
-
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    # Startup: client already initialized
+    # Startup: one HTTP client per FortiGate (see app/fortiapi/sessions.py), connections to the configured
+    # FortiGates opened before the first event; idle ones kept warm in the background
+    try:
+        await asyncio.wait_for(sessions.warm(st.config.fortigates), timeout=st.FG_TIMEOUT * 2)
+    except asyncio.TimeoutError:
+        logger.warning("FortiGate warm-up did not finish in time, continuing")
+    keepalive = asyncio.create_task(sessions.keepalive_loop()) if st.FG_KEEPALIVE_INTERVAL > 0 else None
     yield
     # Shutdown: cleanup
-    logger.info("Shutting down: closing httpx client")
-    await async_client.aclose()
-    logger.info("FortiAPI httpx client closed")
+    if keepalive:
+        keepalive.cancel()
+    logger.info("Shutting down: closing FortiGate sessions")
+    await sessions.aclose()
+    logger.info("FortiAPI FortiGate sessions closed")
 
 app = FastAPI(lifespan=lifespan)
 
-def _headers():
-    return {
-        'Authorization': f'Bearer {API_TOKEN}',
-        'Content-Type': 'application/json'
-    }
+def _fg(fg_addr):
+    """Base URL of a FortiGate (FG_SCHEME=http for a local emulator)"""
+    return f"{st.FG_SCHEME}://{fg_addr}"
+
+# FortiOS CMDB error codes: the object is already there / already gone
+FG_ERR_DUPLICATE = -5
+FG_ERR_NOT_FOUND = -3
+
+def _fg_error(resp):
+    """"exists" / "missing" when FortiGate refused because the desired state already holds"""
+    try:
+        code = resp.json().get("error")
+    except Exception:
+        code = None
+    if code == FG_ERR_DUPLICATE or (resp.status_code == 500 and "duplicate" in resp.text.lower()):
+        return "exists"
+    if code == FG_ERR_NOT_FOUND or resp.status_code == 404:
+        return "missing"
+    return None
 
-async def _req(method, url, data=None):
-    """Async HTTP request to FortiGate API"""
+def _fault_kind(resp):
+    """FortiOS CMDB errors come as 500 with an error code: the request was refused, the FortiGate is fine"""
+    if resp.status_code in (429, 502, 503, 504):
+        return DEVICE
+    try:
+        code = resp.json().get("error")
+    except Exception:
+        code = None
+    return DEVICE if resp.status_code >= 500 and code is None else REFUSED
+
+async def _req(method, url, data=None, timeout=None, tolerate=None):
+    """Async HTTP request to FortiGate API.
+    `tolerate` ("exists" for creates, "missing" for deletes): that refusal means the object is
+    already in the wanted state, so a replayed step succeeds instead of failing over."""
     try:
         payload = json.dumps(data) if data is not None and not isinstance(data, str) else data
-        resp = await async_client.request(
-            method.upper(), 
-            url, 
-            headers=_headers(), 
-            content=payload.encode() if payload else None
+        resp = await sessions.request(
+            method.upper(),
+            url,
+            content=payload.encode() if payload else None,
+            timeout=timeout or httpx.USE_CLIENT_DEFAULT
         )
         if resp.is_success:
             try:
                 return resp.json()
             except Exception:
                 return resp.text
+        if tolerate and _fg_error(resp) == tolerate:
+            logger.info(f"[FG] {method} {url}: object {'already exists' if tolerate == 'exists' else 'already gone'}, treated as done")
+            return {"status": "success", "http_status": resp.status_code, "idempotent": tolerate}
         logger.error(f"[FG] {method} {url} failed: {resp.status_code} {resp.text}")
+        report_fault(_fault_kind(resp))
         return None
     except Exception as e:
         logger.error(f"[FG] {method} {url} exception: {e}")
+        report_fault(DEVICE)
         return None
 
 @app.post("/create_ip")
 async def create_ip(req: CreateIPRequest):
-    url = f"https://{req.fg_addr}/api/v2/cmdb/firewall/address"
+    url = f"{_fg(req.fg_addr)}/api/v2/cmdb/firewall/address"
     payload = {"name": req.name, "subnet": f"{req.ip} 255.255.255.255"}
     logger.info(f"[FG] Create IP {req.ip} for {req.name} on {req.fg_addr}")
-    return await _req("POST", url, payload)
+    resp = await _req("POST", url, payload, tolerate="exists")
+    if isinstance(resp, dict) and resp.get("idempotent"):
+        # Same name, maybe an older session address: converge it
+        return await _req("PUT", f"{url}/{req.name}", payload)
+    return resp
 
 @app.post("/create_ipv6")
 async def create_ipv6(req: CreateIPv6Request):
-    url = f"https://{req.fg_addr}/api/v2/cmdb/firewall/address6"
+    url = f"{_fg(req.fg_addr)}/api/v2/cmdb/firewall/address6"
     payload = {"name": f"{req.name}v6", "ip6": req.ipv6}
     logger.info(f"[FG] Create IPv6 {req.ipv6} for {req.name} on {req.fg_addr}")
-    return await _req("POST", url, payload)
+    resp = await _req("POST", url, payload, tolerate="exists")
+    if isinstance(resp, dict) and resp.get("idempotent"):
+        return await _req("PUT", f"{url}/{req.name}v6", payload)
+    return resp
 
 @app.post("/create_service")
 async def create_service(req: CreateServiceRequest):
-    url = f"https://{req.fg_addr}/api/v2/cmdb/firewall.service/custom"
+    url = f"{_fg(req.fg_addr)}/api/v2/cmdb/firewall.service/custom"
     payload = {"name": req.name, "tcp-portrange": req.tcp, "udp-portrange": req.udp}
     logger.info(f"[FG] Create service {req.name} (tcp={req.tcp}, udp={req.udp}) on {req.fg_addr}")
-    return await _req("POST", url, payload)
+    # Named after the hash of its rules: an existing one has the same ports
+    return await _req("POST", url, payload, tolerate="exists")
 
 @app.post("/create_policy")
 async def create_policy(req: CreatePolicyRequest):
-    url = f"https://{req.fg_addr}/api/v2/cmdb/firewall/policy?datasource=true&with_meta=true&vdom=transparent"
+    url = f"{_fg(req.fg_addr)}/api/v2/cmdb/firewall/policy?datasource=true&with_meta=true&vdom=transparent"
+    src, src6 = _group_names(req.name) if _groups_mode() else (req.username, f"{req.username}v6")
     payload = {
         "name": req.name,
         "action": "deny",
         "srcintf": [{"name": "PPPoE_vlan"}],
         "dstintf": [{"name": "Core_vlan"}],
-        "srcaddr": [{"name": req.username}],
+        "srcaddr": [{"name": src}],
         "dstaddr": [{"name": "ns4.belpak.by_ipv4"}, {"name": "ns3.belpak.by_ipv4"}],
-        "srcaddr6": [{"name": f"{req.username}v6"}],
+        "srcaddr6": [{"name": src6}],
         "dstaddr6": [{"name": "ns3.belpak.by_ipv6"}, {"name": "ns4.belpak.by_ipv6"}],
         "schedule": "always",
         "service": [{"name": req.name}],
@@ -106,61 +158,532 @@ async def create_policy(req: CreatePolicyRequest):
     }
     logger.info(f"[FG] Create policy {req.name} for user {req.username} on {req.fg_addr}")
     resp = await _req("POST", url, payload)
-    return {"mkey": resp.get("mkey") if isinstance(resp, dict) else None}
+    mkey = resp.get("mkey") if isinstance(resp, dict) else None
+    if mkey:
+        policy_cache.put(req.fg_addr, mkey, [src], [src6], policy_cache.observe(req.fg_addr, resp))
+    return {"mkey": mkey}
 
 @app.delete("/delete_ip")
 async def delete_ip(req: DeleteObjectRequest):
-    url = f"https://{req.fg_addr}/api/v2/cmdb/firewall/address/{req.name}"
+    url = f"{_fg(req.fg_addr)}/api/v2/cmdb/firewall/address/{req.name}"
     logger.info(f"[FG] Delete IP {req.name} on {req.fg_addr}")
-    return await _req("DELETE", url)
+    return await _req("DELETE", url, tolerate="missing")
 
 @app.delete("/delete_ipv6")
 async def delete_ipv6(req: DeleteObjectRequest):
-    url = f"https://{req.fg_addr}/api/v2/cmdb/firewall/address6/{req.name}v6"
+    url = f"{_fg(req.fg_addr)}/api/v2/cmdb/firewall/address6/{req.name}v6"
     logger.info(f"[FG] Delete IPv6 {req.name}v6 on {req.fg_addr}")
-    return await _req("DELETE", url)
+    return await _req("DELETE", url, tolerate="missing")
 
 @app.delete("/delete_service")
 async def delete_service(req: DeleteObjectRequest):
-    url = f"https://{req.fg_addr}/api/v2/cmdb/firewall.service/custom/{req.name}"
+    url = f"{_fg(req.fg_addr)}/api/v2/cmdb/firewall.service/custom/{req.name}"
     logger.info(f"[FG] Delete service {req.name} on {req.fg_addr}")
-    return await _req("DELETE", url)
+    return await _req("DELETE", url, tolerate="missing")
 
 @app.delete("/delete_policy")
 async def delete_policy(req: DeletePolicyRequest):
-    url = f"https://{req.fg_addr}/api/v2/cmdb/firewall/policy/{req.policy_id}"
+    url = f"{_fg(req.fg_addr)}/api/v2/cmdb/firewall/policy/{req.policy_id}"
     logger.info(f"[FG] Delete policy {req.policy_id} on {req.fg_addr}")
-    return await _req("DELETE", url)
+    resp = await _req("DELETE", url, tolerate="missing")
+    if resp is not None:
+        policy_cache.invalidate(req.fg_addr, req.policy_id)
+    return resp
 
 @app.post("/move_policy_to_top")
 async def move_policy_to_top(req: MovePolicyRequest):
-    url = f"https://{req.fg_addr}/api/v2/cmdb/firewall/policy/{req.policy_id}?action=move&before=1"
+    url = f"{_fg(req.fg_addr)}/api/v2/cmdb/firewall/policy/{req.policy_id}?action=move&before=1"
     logger.info(f"[FG] Move policy {req.policy_id} to top on {req.fg_addr}")
     return await _req("PUT", url)
 
 @app.post("/get_policy")
 async def get_policy(req: GetPolicyRequest):
-    url = f"https://{req.fg_addr}/api/v2/cmdb/firewall/policy/{req.policy_id}"
+    url = f"{_fg(req.fg_addr)}/api/v2/cmdb/firewall/policy/{req.policy_id}"
     logger.info(f"[FG] Get policy {req.policy_id} from {req.fg_addr}")
     return await _req("GET", url)
 
+def _policy_url(fg_addr, policy_id, sub=""):
+    return f"{_fg(fg_addr)}/api/v2/cmdb/firewall/policy/{policy_id}{sub}?vdom=transparent"
+
 @app.post("/edit_policy")
 async def edit_policy(req: EditPolicyRequest):
-    policy = await get_policy(GetPolicyRequest(fg_addr=req.fg_addr, policy_id=req.policy_id))
-    if not policy or not isinstance(policy, dict):
-        logger.error(f"[FG] Policy {req.policy_id} not found on {req.fg_addr}")
-        return {"mkey": None}
-    logger.info(f"[FG] Edit policy {req.policy_id} action={req.action} on {req.fg_addr} with payload: {req.extra}")
-    if req.action in ("add", "rename"):
-        resp = await _req("POST", f"https://{req.fg_addr}/api/v2/cmdb/firewall/policy", policy)
-        return {"mkey": resp.get("mkey") if isinstance(resp, dict) else None}
-    elif req.action == "remove":
-        await _req("PUT", f"https://{req.fg_addr}/api/v2/cmdb/firewall/policy/{req.policy_id}", policy)
-    return {"mkey": None}
+    """add / remove: the user's addresses (extra: user, ip, ipv6) join or leave the policy, one member call each;
+    rename: policy and its service reference to extra.new_hash. None if the edit failed."""
+    extra = req.extra or {}
+    user = extra.get("user")
+    logger.info(f"[FG] Edit policy {req.policy_id} action={req.action} on {req.fg_addr}: {extra}")
+    if req.action == "rename":
+        if not extra.get("new_hash"):
+            return None
+        payload = {"name": extra["new_hash"], "service": [{"name": extra["new_hash"]}]}
+        if _groups_mode():
+            # The policy follows the hash's groups (joined by the workflow before the rename)
+            group, group6 = _group_names(extra["new_hash"])
+            payload.update({"srcaddr": [{"name": group}], "srcaddr6": [{"name": group6}]})
+            policy_cache.invalidate(req.fg_addr, req.policy_id)
+        resp = await _req("PUT", _policy_url(req.fg_addr, req.policy_id), payload)
+        policy_cache.observe(req.fg_addr, resp)
+        return {"mkey": req.policy_id} if resp is not None else None
+    if req.action not in ("add", "remove") or not user:
+        logger.error(f"[FG] Edit policy {req.policy_id}: unsupported action {req.action} or no user")
+        return None
+    if req.action == "add":
+        change = {"add": [user] if extra.get("ip") else [], "add6": [f"{user}v6"] if extra.get("ipv6") else []}
+    else:
+        change = {"remove": [user], "remove6": [f"{user}v6"]}
+    async with _policy_lock(req.fg_addr, req.policy_id):
+        result = await _change_members(req.fg_addr, req.policy_id, **change)
+    return {"mkey": req.policy_id, **result} if result.get("ok") else None
+
+@app.put("/update_ip")
+async def update_ip(req: UpdateIPRequest):
+    url = f"{_fg(req.fg_addr)}/api/v2/cmdb/firewall/address/{req.name}"
+    logger.info(f"[FG] Update IP of {req.name} to {req.ip} on {req.fg_addr}")
+    return await _req("PUT", url, {"subnet": f"{req.ip} 255.255.255.255"})
+
+@app.put("/set_policy_members")
+async def set_policy_members(req: PolicyMembersRequest):
+    """Replace srcaddr/srcaddr6 of a policy in one PUT (FortiOS refuses an empty srcaddr: delete the policy instead)"""
+    payload = {"srcaddr": [{"name": n} for n in req.srcaddr], "srcaddr6": [{"name": n} for n in req.srcaddr6]}
+    logger.info(f"[FG] Set members of policy {req.policy_id} on {req.fg_addr}: {len(req.srcaddr)} v4, {len(req.srcaddr6)} v6")
+    async with _policy_lock(req.fg_addr, req.policy_id):
+        resp = await _req("PUT", _policy_url(req.fg_addr, req.policy_id), payload)
+        if resp is None:
+            policy_cache.invalidate(req.fg_addr, req.policy_id)
+        else:
+            policy_cache.put(req.fg_addr, req.policy_id, req.srcaddr, req.srcaddr6, policy_cache.observe(req.fg_addr, resp))
+    return resp
+
+_policy_locks = {}
+
+def _policy_lock(fg_addr, policy_id):
+    """Membership changes of one policy (from any AE replica) must not interleave here"""
+    return _policy_locks.setdefault((fg_addr, str(policy_id)), asyncio.Lock())
+
+@app.put("/patch_policy_members")
+async def patch_policy_members(req: PolicyMembersPatchRequest):
+    """Apply a batch of srcaddr/srcaddr6 adds and removes (see _change_members)"""
+    async with _policy_lock(req.fg_addr, req.policy_id):
+        with fault_scope() as faults:
+            result = await _change_members(req.fg_addr, req.policy_id, req.add, req.add6, req.remove, req.remove6)
+    if not result.get("ok"):
+        result["fault"] = fault_of(faults)
+    return result
+
+async def _policy_members(fg_addr, policy_id):
+    """Cached membership of a policy, else one GET of its srcaddr/srcaddr6; None if unreadable, False if gone"""
+    cached = policy_cache.get(fg_addr, policy_id)
+    if cached is not None:
+        return cached
+    current = await _req("GET", f"{_policy_url(fg_addr, policy_id)}&format=policyid|srcaddr|srcaddr6", tolerate="missing")
+    if not isinstance(current, dict):
+        return None
+    if current.get("idempotent"):
+        return False
+    policy = (current.get("results") or [{}])[0]
+    return policy_cache.put(fg_addr, policy_id, [a["name"] for a in policy.get("srcaddr") or []],
+                            [a["name"] for a in policy.get("srcaddr6") or []], policy_cache.observe(fg_addr, current))
+
+async def _still_current(fg_addr, url, entry):
+    """Cheap check of a cached entry before it decides a skipped write or a whole-list PUT:
+    one GET of the object's key only, its config revision compared with the entry's"""
+    resp = await _req("GET", url)
+    return isinstance(resp, dict) and policy_cache.observe(fg_addr, resp) is not None and policy_cache.current(fg_addr, entry)
+
+async def _member_calls(url, add, remove):
+    """Append / delete single members through a member sub-resource (`url("")` the table, `url("/name")`
+    one member); last response or None"""
+    resp = {}
+    for name in add:
+        resp = await _req("POST", url(""), {"name": name}, tolerate="exists")
+        if resp is None:
+            return None
+    for name in remove:
+        resp = await _req("DELETE", url(f"/{quote(name, safe='')}"), tolerate="missing")
+        if resp is None:
+            return None
+    return resp
+
+async def _change_members(fg_addr, policy_id, add=(), add6=(), remove=(), remove6=()):
+    """Net srcaddr/srcaddr6 change of a policy against its cached membership (no read when cached).
+    Up to FG_MEMBER_CALLS_MAX changed members go as single-member sub-resource calls, more as one PUT
+    of both lists. A policy left without v4 members gets the built-in "none" address (FortiOS refuses
+    an empty srcaddr)."""
+    current = await _policy_members(fg_addr, policy_id)
+    for reread in (False, True):
+        if current is None:
+            return {"ok": False, "error": "Policy read failed"}
+        if current is False:
+            # Gone: removals are done, adds can't be
+            return {"ok": not (add or add6), "policy_id": policy_id, "changed": False, "missing": True}
+        src, src6 = current.members, current.srcaddr6
+        new_src = [n for n in src if n not in set(remove)] + [n for n in dict.fromkeys(add) if n not in src]
+        new_src6 = [n for n in src6 if n not in set(remove6)] + [n for n in dict.fromkeys(add6) if n not in src6]
+        final = new_src or [NONE_ADDRESS]
+        plus = [n for n in final if n not in current.srcaddr]
+        minus = [n for n in current.srcaddr if n not in final]
+        plus6, minus6 = [n for n in new_src6 if n not in src6], [n for n in src6 if n not in new_src6]
+        unchanged = new_src == src and new_src6 == src6
+        bulk = len(plus) + len(minus) + len(plus6) + len(minus6) > st.FG_MEMBER_CALLS_MAX
+        if reread or not (unchanged or bulk) or await _still_current(
+                fg_addr, f"{_policy_url(fg_addr, policy_id)}&format=policyid", current):
+            break
+        # The FortiGate changed since this was cached: read it again rather than skip the write or PUT a stale list
+        policy_cache.stats["rereads"] += 1
+        policy_cache.invalidate(fg_addr, policy_id)
+        current = await _policy_members(fg_addr, policy_id)
+    if unchanged:
+        return {"ok": True, "policy_id": policy_id, "changed": False, "srcaddr": len(src), "srcaddr6": len(src6)}
+    logger.info(f"[FG] Members of policy {policy_id} on {fg_addr}: +{len(plus)}/{len(plus6)} -{len(minus)}/{len(minus6)} "
+                f"(v4/v6) -> {len(new_src)}/{len(new_src6)}")
+    if not bulk:
+        # Adds first: srcaddr is never empty in between
+        resp = await _member_calls(lambda sub: _policy_url(fg_addr, policy_id, f"/srcaddr{sub}"), plus, minus)
+        if resp is not None:
+            resp = await _member_calls(lambda sub: _policy_url(fg_addr, policy_id, f"/srcaddr6{sub}"), plus6, minus6)
+    else:
+        resp = await _req("PUT", _policy_url(fg_addr, policy_id),
+                          {"srcaddr": [{"name": n} for n in final], "srcaddr6": [{"name": n} for n in new_src6]})
+    if resp is None:
+        # Partly applied or stale: read it again next time
+        policy_cache.invalidate(fg_addr, policy_id)
+        return {"ok": False, "policy_id": policy_id, "error": "Policy update failed"}
+    policy_cache.put(fg_addr, policy_id, final, new_src6, policy_cache.observe(fg_addr, resp))
+    return {"ok": True, "policy_id": policy_id, "changed": True, "srcaddr": len(new_src), "srcaddr6": len(new_src6)}
+
+# --- FG_PROVISION_MODE=groups: the users of a profile hash are members of one address group and one
+# address6 group, the hash's policy references only those; joining or leaving is a group member change ---
+
+GROUP_TABLES = {"addrgrp": "firewall/addrgrp", "addrgrp6": "firewall/addrgrp6"}
+
+def _groups_mode():
+    return st.FG_PROVISION_MODE == "groups"
+
+def _group_names(hash_val):
+    return f"{hash_val}_g", f"{hash_val}_g6"
+
+def _group_url(fg_addr, table, name=None, sub=""):
+    return f"{_fg(fg_addr)}/api/v2/cmdb/{GROUP_TABLES[table]}" + (f"/{quote(name, safe='')}{sub}" if name else "")
+
+async def _group_members(fg_addr, table, name):
+    """Cached members of an address group, else one GET; None if unreadable, False if there is no such group"""
+    cached = policy_cache.get_group(fg_addr, table, name)
+    if cached is not None:
+        return cached
+    current = await _req("GET", f"{_group_url(fg_addr, table, name)}?format=name|member", tolerate="missing")
+    if not isinstance(current, dict):
+        return None
+    if current.get("idempotent"):
+        return False
+    group = (current.get("results") or [{}])[0]
+    return policy_cache.put_group(fg_addr, table, name, [m["name"] for m in group.get("member") or []],
+                                  policy_cache.observe(fg_addr, current))
+
+async def _change_group(fg_addr, table, name, add=(), remove=(), ensure=False):
+    """Net member change of an address group, as single-member calls up to FG_MEMBER_CALLS_MAX (else one PUT).
+    A missing group is created when there is something to add or `ensure` (a policy is about to reference it);
+    a group left empty keeps the built-in "none" address."""
+    async with _policy_lock(fg_addr, f"{table}/{name}"):
+        current = await _group_members(fg_addr, table, name)
+        if current is None:
+            return {"ok": False, "error": f"Reading {table} {name} failed"}
+        if current is False:
+            if not (add or ensure):
+                return {"ok": True, "changed": False, "missing": True}
+            members = list(dict.fromkeys(add)) or [NONE_ADDRESS]
+            resp = await _req("POST", _group_url(fg_addr, table), {"name": name, "member": [{"name": n} for n in members]}, tolerate="exists")
+            if resp is None:
+                return {"ok": False, "error": f"Creating {table} {name} failed"}
+            if not resp.get("idempotent"):
+                policy_cache.put_group(fg_addr, table, name, members, policy_cache.observe(fg_addr, resp))
+                return {"ok": True, "changed": True, "created": True, "members": len(list(dict.fromkeys(add)))}
+            # Created meanwhile by someone else: change its members instead
+            current = await _group_members(fg_addr, table, name)
+            if not current:
+                return {"ok": False, "error": f"Reading {table} {name} failed"}
+        for reread in (False, True):
+            members = current.members
+            new = [n for n in members if n not in set(remove)] + [n for n in dict.fromkeys(add) if n not in members]
+            final = new or [NONE_ADDRESS]
+            plus = [n for n in final if n not in current.srcaddr]
+            minus = [n for n in current.srcaddr if n not in final]
+            bulk = len(plus) + len(minus) > st.FG_MEMBER_CALLS_MAX
+            if reread or not (new == members or bulk) or await _still_current(
+                    fg_addr, f"{_group_url(fg_addr, table, name)}?format=name", current):
+                break
+            # Cached before the FortiGate's last change (see _change_members)
+            policy_cache.stats["rereads"] += 1
+            policy_cache.invalidate_group(fg_addr, table, name)
+            current = await _group_members(fg_addr, table, name)
+            if current is None:
+                return {"ok": False, "error": f"Reading {table} {name} failed"}
+            if current is False:
+                return {"ok": not add, "changed": False, "missing": True}
+        if new == members:
+            return {"ok": True, "changed": False, "members": len(members)}
+        logger.info(f"[FG] Members of {table} {name} on {fg_addr}: +{len(plus)} -{len(minus)} -> {len(new)}")
+        if not bulk:
+            resp = await _member_calls(lambda sub: _group_url(fg_addr, table, name, f"/member{sub}"), plus, minus)
+        else:
+            resp = await _req("PUT", _group_url(fg_addr, table, name), {"member": [{"name": n} for n in final]})
+        if resp is None:
+            policy_cache.invalidate_group(fg_addr, table, name)
+            return {"ok": False, "error": f"Updating {table} {name} failed"}
+        policy_cache.put_group(fg_addr, table, name, final, policy_cache.observe(fg_addr, resp))
+        return {"ok": True, "changed": True, "members": len(new)}
+
+@app.put("/set_group_members")
+async def set_group_members(req: GroupMembersRequest):
+    """Replace the members of an address group (drift repair)"""
+    members = [n for n in req.members if n != NONE_ADDRESS]
+    current = await _group_members(req.fg_addr, req.table, req.name)
+    if current is None:
+        return None
+    if current is False:
+        return {"ok": True, "missing": True}
+    result = await _change_group(req.fg_addr, req.table, req.name, add=members,
+                                 remove=[n for n in current.members if n not in members])
+    return result if result.get("ok") else None
+
+@app.delete("/delete_group")
+async def delete_group(req: DeleteGroupRequest):
+    logger.info(f"[FG] Delete {req.table} {req.name} on {req.fg_addr}")
+    resp = await _req("DELETE", _group_url(req.fg_addr, req.table, req.name), tolerate="missing")
+    policy_cache.invalidate_group(req.fg_addr, req.table, req.name)
+    return resp
+
+# CMDB tables read in bulk by the drift reconciler: path, fields kept, extra query
+SNAPSHOT_TABLES = {
+    "address": ("firewall/address", "name|subnet", ""),
+    "address6": ("firewall/address6", "name|ip6", ""),
+    "addrgrp": ("firewall/addrgrp", "name|member", ""),
+    "addrgrp6": ("firewall/addrgrp6", "name|member", ""),
+    "service": ("firewall.service/custom", "name", ""),
+    "policy": ("firewall/policy", "policyid|name|srcaddr|srcaddr6|dstaddr|dstaddr6|service", "&vdom=transparent"),
+}
+
+async def _read_table(fg_addr, path, fields, extra):
+    """Whole CMDB table in FG_SNAPSHOT_PAGE-sized pages; None if any page fails"""
+    rows, start = [], 0
+    while True:
+        url = f"{_fg(fg_addr)}/api/v2/cmdb/{path}?format={fields}&start={start}&count={st.FG_SNAPSHOT_PAGE}{extra}"
+        resp = await _req("GET", url, timeout=st.FG_SNAPSHOT_TIMEOUT)
+        if not isinstance(resp, dict):
+            return None
+        page = resp.get("results") or []
+        rows.extend(page)
+        if len(page) < st.FG_SNAPSHOT_PAGE:
+            return rows
+        start += len(page)
+
+@app.post("/snapshot")
+async def snapshot(req: SnapshotRequest):
+    """Bulk read of the managed CMDB tables (a few paged GETs instead of one GET per object)"""
+    started = time.perf_counter()
+    result = {}
+    for table in req.tables or list(SNAPSHOT_TABLES):
+        if table not in SNAPSHOT_TABLES:
+            return {"ok": False, "error": f"Unknown table {table}"}
+        rows = await _read_table(req.fg_addr, *SNAPSHOT_TABLES[table])
+        if rows is None:
+            return {"ok": False, "error": f"Reading {table} failed"}
+        result[table] = rows
+    if not req.tables:
+        policy_cache.load(req.fg_addr, result)
+    ms = round((time.perf_counter() - started) * 1000, 2)
+    logger.info(f"[FG] Snapshot of {req.fg_addr}: {({t: len(r) for t, r in result.items()})} in {ms} ms")
+    return {"ok": True, "ms": ms, "tables": result}
+
+@app.post("/probe")
+async def probe(req: ProbeRequest):
+    """Cheap liveness check of one FortiGate (AE circuit breaker half-open trial)"""
+    start = time.perf_counter()
+    resp = await _req("GET", f"{_fg(req.fg_addr)}/api/v2/monitor/system/status")
+    return {"ok": resp is not None, "ms": round((time.perf_counter() - start) * 1000, 2)}
+
+# --- Composite workflows: one AE call per event, steps run here in order ---
+
+async def _call(endpoint, model, **fields):
+    """Build the step request and call the endpoint in-process; None (failed step) on bad input"""
+    try:
+        req = model(**fields)
+    except ValidationError as e:
+        logger.error(f"[WF] {endpoint.__name__}: invalid request {fields}: {e.errors()}")
+        return None
+    return await endpoint(req)
+
+def _has_mkey(result):
+    return isinstance(result, dict) and bool(result.get("mkey"))
+
+async def _new_policy(wf: Workflow, req):
+    """create_service + create_policy + move_policy_to_top; returns the new policy id"""
+    fg = req.fg_addr
+    await wf.step("create_service", _call(create_service, CreateServiceRequest, fg_addr=fg, name=req.hash, tcp=req.tcp, udp=req.udp))
+    created = await wf.step("create_policy", _call(create_policy, CreatePolicyRequest, fg_addr=fg, name=req.hash, username=req.user), check=_has_mkey)
+    if not wf.ok:
+        return None
+    policy_id = str(created["mkey"])
+    # Not fatal: the policy exists and works, only its position is off
+    await wf.step("move_policy_to_top", _call(move_policy_to_top, MovePolicyRequest, fg_addr=fg, policy_id=policy_id), required=False)
+    return policy_id
+
+async def _add_addresses(wf: Workflow, req):
+    fg = req.fg_addr
+    await wf.step("create_ip", _call(create_ip, CreateIPRequest, fg_addr=fg, name=req.user, ip=req.ip))
+    await wf.step("create_ipv6", _call(create_ipv6, CreateIPv6Request, fg_addr=fg, name=req.user, ipv6=req.ipv6))
+
+def _group_ok(result):
+    return isinstance(result, dict) and bool(result.get("ok"))
+
+async def _join_groups(wf: Workflow, fg, hash_val, user, ip, ipv6, policy_id=None):
+    """The user's addresses into the hash's groups (created if missing: a policy may be about to reference them);
+    `policy_id`: the hash's existing policy, made to reference the groups if it doesn't yet"""
+    group, group6 = _group_names(hash_val)
+    await wf.step("group_join", _change_group(fg, "addrgrp", group, add=[user] if ip else [], ensure=True), check=_group_ok)
+    await wf.step("group6_join", _change_group(fg, "addrgrp6", group6, add=[f"{user}v6"] if ipv6 else [], ensure=True), check=_group_ok)
+    if policy_id and wf.ok:
+        await wf.step("policy_groups", _policy_groups(fg, policy_id, group, group6), check=_group_ok)
+
+async def _leave_groups(wf: Workflow, fg, hash_val, user, policy_id=None):
+    """The user's addresses out of the hash's groups and, if it still holds them, out of `policy_id` itself"""
+    group, group6 = _group_names(hash_val)
+    await wf.step("group_leave", _change_group(fg, "addrgrp", group, remove=[user]), check=_group_ok)
+    await wf.step("group6_leave", _change_group(fg, "addrgrp6", group6, remove=[f"{user}v6"]), check=_group_ok)
+    if policy_id:
+        await wf.step("policy_leave", _policy_leave(fg, policy_id, user), check=_group_ok)
+
+async def _policy_groups(fg, policy_id, group, group6):
+    """A policy made in members mode references its users, not the hash's groups: add the groups
+    (no call when the cache already shows them). Its remaining users leave it one by one (_policy_leave)."""
+    cached = policy_cache.get(fg, policy_id)
+    if cached is not None and group in cached.srcaddr and group6 in cached.srcaddr6:
+        return {"ok": True, "changed": False}
+    async with _policy_lock(fg, policy_id):
+        return await _change_members(fg, policy_id, add=[group], add6=[group6])
+
+async def _policy_leave(fg, policy_id, user):
+    """The user's own addresses out of a policy from members mode (no write when it only references groups);
+    the addresses can't be deleted while it does"""
+    async with _policy_lock(fg, policy_id):
+        return await _change_members(fg, policy_id, remove=[user], remove6=[f"{user}v6"])
+
+async def _drop_groups(wf: Workflow, fg, hash_val):
+    """Both groups of a hash whose policy is gone"""
+    group, group6 = _group_names(hash_val)
+    await wf.step("delete_group", _call(delete_group, DeleteGroupRequest, fg_addr=fg, table="addrgrp", name=group))
+    await wf.step("delete_group6", _call(delete_group, DeleteGroupRequest, fg_addr=fg, table="addrgrp6", name=group6))
+
+def _edit(fg, action, policy_id, **extra):
+    return _call(edit_policy, EditPolicyRequest, fg_addr=fg, action=action, policy_id=policy_id, extra=extra)
+
+@app.post("/workflow/provision")
+async def provision_user(req: ProvisionUserRequest):
+    """Addresses for the user, then join the hash's policy or create service + policy for it"""
+    wf = Workflow("provision", req.fg_addr)
+    logger.info(f"[WF] Provision {req.user} (hash={req.hash}, policy={req.policy_id}) on {req.fg_addr}")
+    await _add_addresses(wf, req)
+    if _groups_mode():
+        # The policy only references the groups: joining never touches it
+        await _join_groups(wf, req.fg_addr, req.hash, req.user, req.ip, req.ipv6, req.policy_id)
+        if req.policy_id:
+            return wf.result(policy_id=req.policy_id, created_policy=False)
+        policy_id = await _new_policy(wf, req)
+        return wf.result(policy_id=policy_id, created_policy=bool(policy_id))
+    if req.policy_id and not req.membership:
+        return wf.result(policy_id=req.policy_id, created_policy=False)
+    if req.policy_id:
+        await wf.step("edit_policy_add", _edit(req.fg_addr, "add", req.policy_id, user=req.user, ip=req.ip, ipv6=req.ipv6))
+        return wf.result(policy_id=req.policy_id, created_policy=False)
+    policy_id = await _new_policy(wf, req)
+    return wf.result(policy_id=policy_id, created_policy=bool(policy_id))
+
+@app.post("/workflow/migrate")
+async def migrate_user(req: MigrateUserRequest):
+    """Move the user to the policy of their new hash (see MigrateUserRequest.mode)"""
+    wf = Workflow(f"migrate:{req.mode}", req.fg_addr)
+    fg = req.fg_addr
+    logger.info(f"[WF] Migrate {req.user} mode={req.mode} ({req.old_hash} -> {req.hash}, policy {req.old_policy_id} -> {req.policy_id}) on {fg}")
+    if _groups_mode():
+        return await _migrate_groups(wf, req)
+    if req.mode == "rename":
+        # The policy can only point at an existing service, and the old one is in use until it doesn't
+        await wf.step("create_service", _call(create_service, CreateServiceRequest, fg_addr=fg, name=req.hash, tcp=req.tcp, udp=req.udp))
+        await wf.step("edit_policy_rename", _edit(fg, "rename", req.old_policy_id, user=req.user, old_hash=req.old_hash, new_hash=req.hash))
+        await wf.step("delete_service", _call(delete_service, DeleteObjectRequest, fg_addr=fg, name=req.old_hash))
+        return wf.result(policy_id=req.old_policy_id)
+    if req.mode == "join":
+        await wf.step("delete_policy", _call(delete_policy, DeletePolicyRequest, fg_addr=fg, policy_id=req.old_policy_id))
+        await wf.step("delete_service", _call(delete_service, DeleteObjectRequest, fg_addr=fg, name=req.old_hash))
+        await wf.step("edit_policy_add", _edit(fg, "add", req.policy_id, user=req.user, ip=req.ip, ipv6=req.ipv6))
+        return wf.result(policy_id=req.policy_id)
+    await wf.step("edit_policy_remove", _edit(fg, "remove", req.old_policy_id, user=req.user))
+    if req.mode == "move":
+        await wf.step("edit_policy_add", _edit(fg, "add", req.policy_id, user=req.user, ip=req.ip, ipv6=req.ipv6))
+        return wf.result(policy_id=req.policy_id)
+    await _add_addresses(wf, req)
+    policy_id = await _new_policy(wf, req)
+    return wf.result(policy_id=policy_id, created_policy=bool(policy_id))
+
+async def _migrate_groups(wf: Workflow, req: MigrateUserRequest):
+    """Migrate in groups mode: the user changes groups; policies change only when one is renamed or dropped"""
+    fg = req.fg_addr
+    if req.mode == "rename":
+        await wf.step("create_service", _call(create_service, CreateServiceRequest, fg_addr=fg, name=req.hash, tcp=req.tcp, udp=req.udp))
+        await _join_groups(wf, fg, req.hash, req.user, req.ip, req.ipv6)
+        await wf.step("edit_policy_rename", _edit(fg, "rename", req.old_policy_id, user=req.user, old_hash=req.old_hash, new_hash=req.hash))
+        await wf.step("delete_service", _call(delete_service, DeleteObjectRequest, fg_addr=fg, name=req.old_hash))
+        if req.old_hash:
+            await _drop_groups(wf, fg, req.old_hash)
+        return wf.result(policy_id=req.old_policy_id)
+    if req.mode == "join":
+        await wf.step("delete_policy", _call(delete_policy, DeletePolicyRequest, fg_addr=fg, policy_id=req.old_policy_id))
+        await wf.step("delete_service", _call(delete_service, DeleteObjectRequest, fg_addr=fg, name=req.old_hash))
+        if req.old_hash:
+            await _drop_groups(wf, fg, req.old_hash)
+        await _join_groups(wf, fg, req.hash, req.user, req.ip, req.ipv6, req.policy_id)
+        return wf.result(policy_id=req.policy_id)
+    if req.old_hash:
+        await _leave_groups(wf, fg, req.old_hash, req.user, req.old_policy_id)
+    if req.mode == "move":
+        await _join_groups(wf, fg, req.hash, req.user, req.ip, req.ipv6, req.policy_id)
+        return wf.result(policy_id=req.policy_id)
+    await _add_addresses(wf, req)
+    await _join_groups(wf, fg, req.hash, req.user, req.ip, req.ipv6)
+    policy_id = await _new_policy(wf, req)
+    return wf.result(policy_id=policy_id, created_policy=bool(policy_id))
+
+@app.post("/workflow/deprovision")
+async def deprovision_user(req: DeprovisionUserRequest):
+    """Take the user out of its policy (deleting policy + service when unused), then drop the addresses"""
+    wf = Workflow("deprovision", req.fg_addr)
+    fg = req.fg_addr
+    logger.info(f"[WF] Deprovision {req.user} (policy={req.policy_id}, delete_policy={req.delete_policy}) on {fg}")
+    if _groups_mode() and req.hash:
+        # Addresses can't be deleted while a group holds them
+        if req.policy_id and req.delete_policy:
+            await wf.step("delete_policy", _call(delete_policy, DeletePolicyRequest, fg_addr=fg, policy_id=req.policy_id))
+            await wf.step("delete_service", _call(delete_service, DeleteObjectRequest, fg_addr=fg, name=req.hash))
+            await _drop_groups(wf, fg, req.hash)
+        else:
+            await _leave_groups(wf, fg, req.hash, req.user, req.policy_id)
+    elif req.policy_id:
+        if req.membership and not req.delete_policy:
+            await wf.step("edit_policy_remove", _edit(fg, "remove", req.policy_id, user=req.user, ip=req.ip, ipv6=req.ipv6))
+        if req.delete_policy:
+            await wf.step("delete_policy", _call(delete_policy, DeletePolicyRequest, fg_addr=fg, policy_id=req.policy_id))
+            await wf.step("delete_service", _call(delete_service, DeleteObjectRequest, fg_addr=fg, name=req.hash))
+    await wf.step("delete_ip", _call(delete_ip, DeleteObjectRequest, fg_addr=fg, name=req.user))
+    await wf.step("delete_ipv6", _call(delete_ipv6, DeleteObjectRequest, fg_addr=fg, name=req.user))
+    return wf.result(policy_id=req.policy_id, deleted_policy=bool(req.policy_id and req.delete_policy))
 
 @app.get("/health")
 def health_check():
-    return {"status": "ok", "service": "mhe_fortiapi"}
+    return {"status": "ok", "service": "mhe_fortiapi", "policy_cache": policy_cache.snapshot(), "sessions": sessions.snapshot()}
+
+@app.get("/sessions")
+def session_stats():
+    """Per-FortiGate request latency, connections opened vs reused, HTTP versions negotiated"""
+    return {"http2_available": HTTP2_AVAILABLE, "http2": st.FG_HTTP2 and HTTP2_AVAILABLE, "fortigates": sessions.snapshot()}
 
 if __name__ == "__main__":
     import uvicorn
@@ -5,7 +5,7 @@ from scapy.all import sniff
 from scapy.layers.radius import Radius
 from scapy.layers.inet import IP
 from pyrad.packet import Packet
-from app.config.env import st
+from app.config.env import st, watch_config
 import requests
 
 logger = logging.getLogger("mhe_radius")
@@ -104,6 +104,8 @@ def parse_packet(pkt):
 def main():
     logging.basicConfig(filename='mhe_radius.log', level=logging.INFO, format='%(asctime)s %(levelname)s %(name)s: %(message)s')
     logger.info("Starting MHE RADIUS sniffer on UDP port 1813...")
+    # NAS → FortiGate table is reloaded on .env change / SIGHUP without restarting the sniffer
+    watch_config()
     try:
         sniff(prn=parse_packet, filter="udp and port 1813", store=0)
     except KeyboardInterrupt:
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import mysql.connector
+from app.config.env import st
+
+logger = logging.getLogger(__name__)
+
+# Bounded executor shared by every mhe_db router: blocking connector calls and
+# inner-service HTTP posts never run on the event loop.
+executor = ThreadPoolExecutor(max_workers=st.DB_EXECUTOR_WORKERS, thread_name_prefix="db_worker")
+logger.info(f"DB executor created (max_workers={st.DB_EXECUTOR_WORKERS})")
+
+_lock = threading.Lock()
+_stats = {"calls": 0, "queued": 0, "running": 0, "timeouts": 0, "errors": 0, "killed": 0, "abandoned": 0}
+_lag = {"last_ms": 0.0, "avg_ms": 0.0, "max_ms": 0.0, "stalls": 0, "samples": 0}
+
+
+def _bump(key: str, delta: int = 1):
+    with _lock:
+        _stats[key] += delta
+
+
+def kill_query(connection_id: int):
+    """Cancel the statement still running on `connection_id` (after a client-side timeout)"""
+    try:
+        cnx = mysql.connector.connect(**getattr(st, 'starrocks_config', st.mysql_config))
+        try:
+            cursor = cnx.cursor()
+            cursor.execute(f"KILL QUERY {int(connection_id)}")
+            cursor.close()
+            _bump("killed")
+        finally:
+            cnx.close()
+    except Exception as e:
+        logger.warning(f"KILL QUERY {connection_id} failed: {e}")
+
+
+async def _run(call, timeout: Optional[float], state: dict):
+    timeout = st.DB_QUERY_TIMEOUT if timeout is None else timeout
+
+    def wrapped():
+        with _lock:
+            if state.get("abandoned"):
+                return None
+            state["started"] = True
+            _stats["queued"] -= 1
+            _stats["running"] += 1
+        try:
+            return call()
+        finally:
+            _bump("running", -1)
+
+    _bump("calls")
+    _bump("queued")
+    fut = asyncio.get_running_loop().run_in_executor(executor, wrapped)
+    try:
+        return await asyncio.wait_for(fut, timeout) if timeout else await fut
+    except asyncio.TimeoutError:
+        # Still queued or waiting for a pooled connection: never run it. Already running: cancel the
+        # statement server-side.
+        with _lock:
+            _stats["timeouts"] += 1
+            if not state.get("started"):
+                _stats["queued"] -= 1
+            state["abandoned"] = True
+            cnx_id = state.get("cnx_id")
+        if cnx_id:
+            threading.Thread(target=kill_query, args=(cnx_id,), daemon=True).start()
+        raise TimeoutError(f"DB call timed out after {timeout}s")
+    except Exception:
+        _bump("errors")
+        raise
+
+
+async def run_db(connect, fn, *args, timeout: Optional[float] = None):
+    """Run ``fn(cnx, cursor, *args)`` on the DB executor with a per-query timeout.
+
+    `connect` is the router's ``db()`` context manager. On timeout the request
+    is released at once and the statement is cancelled with KILL QUERY.
+    ``timeout=None`` means DB_QUERY_TIMEOUT, ``timeout=0`` waits indefinitely.
+    """
+    state = {}
+
+    def call():
+        with connect() as (cnx, cursor):
+            # The pool wait (DB_POOL_TIMEOUT) can outlast the query timeout: the caller may be gone already
+            with _lock:
+                if state.get("abandoned"):
+                    _stats["abandoned"] += 1
+                    return None
+                state["cnx_id"] = getattr(cnx, "connection_id", None)
+            return fn(cnx, cursor, *args)
+
+    return await _run(call, timeout, state)
+
+
+async def run_blocking(fn, *args, timeout: Optional[float] = None):
+    """Run a blocking callable (SQL helper, requests.post) on the DB executor"""
+    return await _run(lambda: fn(*args), timeout, {})
+
+
+def spawn_blocking(fn, *args):
+    """Fire-and-forget a blocking callable on the DB executor"""
+    return executor.submit(fn, *args)
+
+
+async def monitor_loop_lag(interval: float = 0.25, stall_ms: float = 50.0):
+    """Background task: measure how late the loop wakes up (blocked loop => growing lag)"""
+    loop = asyncio.get_running_loop()
+    while True:
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lag_ms = max(0.0, (loop.time() - start - interval) * 1000)
+        _lag["last_ms"] = round(lag_ms, 2)
+        _lag["avg_ms"] = round(lag_ms if not _lag["samples"] else _lag["avg_ms"] * 0.9 + lag_ms * 0.1, 2)
+        _lag["max_ms"] = max(_lag["max_ms"], round(lag_ms, 2))
+        _lag["samples"] += 1
+        if lag_ms >= stall_ms:
+            _lag["stalls"] += 1
+            logger.warning(f"Event loop stalled for {lag_ms:.0f} ms")
+
+
+def stats() -> dict:
+    with _lock:
+        executor_stats = dict(_stats, max_workers=st.DB_EXECUTOR_WORKERS)
+    return {"executor": executor_stats, "loop_lag": dict(_lag), "ts": time.time()}
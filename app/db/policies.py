@@ -0,0 +1,127 @@
+import logging
+import threading
+from collections import Counter
+from typing import Dict, Iterable, List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class PolicyIndex:
+    """In-memory view of FW_Profiles policy assignments.
+
+    Keeps login -> (hash, policy_id) plus two derived maps: hash -> policy_ids
+    in use (with counts) and policy_id -> number of profiles referencing it.
+    Routes update it right after their own writes, so by-hash and
+    policy-exists lookups never touch the database once seeded.
+
+    Writes follow the table's REPLACE_IF_NOT_NULL semantics: None keeps the
+    current value, '' clears it. A periodic reseed corrects drift from writes
+    made outside this process; writes made while a reseed query runs are
+    replayed on top of the (possibly older) table rows. Until then another
+    worker's writes are invisible here, so callers confirm misses in SQL
+    (routes_query). Hashes and policy ids are compared as strings.
+    """
+
+    def __init__(self):
+        self._rows: Dict[str, Tuple[str, str]] = {}
+        self._by_hash: Dict[str, Counter] = {}
+        self._refs: Counter = Counter()
+        self._touched: Optional[Dict[str, Optional[Tuple[Optional[str], Optional[str]]]]] = None
+        self._lock = threading.Lock()
+        self.ready = False
+
+    def _link(self, login: str, hash_val: str, policy_id: str):
+        # Keys are strings whatever callers pass (policy ids arrive as int from fortiapi results)
+        hash_val, policy_id = str(hash_val or ""), str(policy_id or "")
+        self._rows[login] = (hash_val, policy_id)
+        if policy_id:
+            self._refs[policy_id] += 1
+            if hash_val:
+                self._by_hash.setdefault(hash_val, Counter())[policy_id] += 1
+
+    def _unlink(self, login: str):
+        hash_val, policy_id = self._rows.pop(login, ("", ""))
+        if not policy_id:
+            return
+        self._refs[policy_id] -= 1
+        if self._refs[policy_id] <= 0:
+            del self._refs[policy_id]
+        counts = self._by_hash.get(hash_val)
+        if counts is not None:
+            counts[policy_id] -= 1
+            if counts[policy_id] <= 0:
+                del counts[policy_id]
+            if not counts:
+                del self._by_hash[hash_val]
+
+    def begin_seed(self):
+        """Call before reading the table; writes from here on win over the seed rows."""
+        with self._lock:
+            self._touched = {}
+
+    def seed(self, rows: Iterable[Tuple[str, str, str]]):
+        """Rebuild from (login, hash, policy_id) rows read after begin_seed()."""
+        with self._lock:
+            touched = self._touched or {}
+            self._touched = None
+            self._rows, self._by_hash, self._refs = {}, {}, Counter()
+            for login, hash_val, policy_id in rows:
+                if login:
+                    self._link(login, hash_val or "", policy_id or "")
+            for login, write in touched.items():
+                if write is None:
+                    self._unlink(login)
+                else:
+                    self._set(login, *write)
+            self.ready = True
+        logger.info(f"Policy index seeded: {len(self._rows)} profiles, {len(self._refs)} policies")
+
+    def abort_seed(self):
+        with self._lock:
+            self._touched = None
+
+    def _set(self, login: str, hash_val: Optional[str], policy_id: Optional[str]):
+        old_hash, old_policy = self._rows.get(login, ("", ""))
+        self._unlink(login)
+        self._link(login, old_hash if hash_val is None else hash_val, old_policy if policy_id is None else policy_id)
+
+    def set(self, login: str, hash_val: Optional[str] = None, policy_id: Optional[str] = None):
+        with self._lock:
+            self._set(login, hash_val, policy_id)
+            if self._touched is not None:
+                prev = self._touched.get(login) or (None, None)
+                self._touched[login] = (prev[0] if hash_val is None else hash_val, prev[1] if policy_id is None else policy_id)
+
+    def discard(self, login: str):
+        with self._lock:
+            self._unlink(login)
+            if self._touched is not None:
+                self._touched[login] = None
+
+    def policy_by_hash(self, hash_val: str) -> Optional[str]:
+        with self._lock:
+            counts = self._by_hash.get(str(hash_val))
+            return counts.most_common(1)[0][0] if counts else None
+
+    def policies_by_hash(self, hashes: List[str]) -> Dict[str, Optional[str]]:
+        with self._lock:
+            return {h: (self._by_hash[str(h)].most_common(1)[0][0] if str(h) in self._by_hash else None) for h in hashes}
+
+    def refcount(self, policy_id: str) -> int:
+        with self._lock:
+            return self._refs.get(str(policy_id), 0)
+
+    def refcounts(self, policy_ids: List[str]) -> Dict[str, int]:
+        with self._lock:
+            return {p: self._refs.get(str(p), 0) for p in policy_ids}
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"ready": self.ready, "profiles": len(self._rows), "policies": len(self._refs), "hashes": len(self._by_hash)}
+
+    def __len__(self):
+        return len(self._rows)
+
+
+# Process-wide index shared by routes_firewall (writer) and routes_query (reader)
+policies = PolicyIndex()
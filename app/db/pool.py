@@ -0,0 +1,189 @@
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+import mysql.connector
+from mysql.connector import pooling
+from app.config.env import st
+from app.db.query import forget
+
+logger = logging.getLogger(__name__)
+
+# mysql.connector refuses pools larger than this
+MAX_POOL_SIZE = pooling.CNX_POOL_MAXSIZE if hasattr(pooling, "CNX_POOL_MAXSIZE") else 32
+
+
+class PoolTimeout(RuntimeError):
+    pass
+
+
+class NamedPool:
+    """One named class of StarRocks connections (firewall, query, radius, ...).
+
+    The underlying MySQLConnectionPool is created on first use or by warm(),
+    never at import time. Checkouts wait up to DB_POOL_TIMEOUT for a free slot
+    instead of failing with "pool exhausted"; the pool itself pings and
+    reconnects dead connections on checkout, and connections that fail with
+    an operational error are disconnected so the next checkout reconnects.
+    """
+
+    def __init__(self, name: str, size: int, timeout: float):
+        self.name = name
+        self.size = max(1, min(size, MAX_POOL_SIZE))
+        self.timeout = timeout
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._stats = {
+            "checkouts": 0, "timeouts": 0, "errors": 0, "recycled": 0, "direct": 0,
+            "in_use": 0, "peak_in_use": 0, "wait_ms_total": 0.0, "wait_ms_max": 0.0,
+        }
+        if size > MAX_POOL_SIZE:
+            logger.warning(f"Pool {name}: size {size} capped to {MAX_POOL_SIZE}")
+
+    def _get_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = pooling.MySQLConnectionPool(
+                        pool_name=f"{self.name}_pool",
+                        pool_size=self.size,
+                        pool_reset_session=st.DB_POOL_RESET_SESSION,
+                        **getattr(st, 'starrocks_config', st.mysql_config)
+                    )
+                    logger.info(f"Connection pool {self.name} created (size={self.size})")
+        return self._pool
+
+    def warm(self):
+        try:
+            self._get_pool()
+        except Exception as e:
+            logger.error(f"Failed to create connection pool {self.name}: {e}")
+
+    def _checkout(self):
+        try:
+            return self._get_pool().get_connection()
+        except pooling.PoolError:
+            raise
+        except Exception as e:
+            # Pool could not be created (FE down at startup): fall back to a direct connection
+            if self._pool is not None:
+                raise
+            logger.warning(f"Pool {self.name} unavailable ({e}), using direct connection")
+            with self._lock:
+                self._stats["direct"] += 1
+            return mysql.connector.connect(**getattr(st, 'starrocks_config', st.mysql_config))
+
+    @contextmanager
+    def connection(self):
+        """Yield (cnx, cursor) from this pool, recording wait time and utilization"""
+        start = time.perf_counter()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock:
+                self._stats["timeouts"] += 1
+            raise PoolTimeout(f"Pool {self.name}: no free connection after {self.timeout}s")
+        wait_ms = (time.perf_counter() - start) * 1000
+        with self._lock:
+            s = self._stats
+            s["checkouts"] += 1
+            s["in_use"] += 1
+            s["peak_in_use"] = max(s["peak_in_use"], s["in_use"])
+            s["wait_ms_total"] += wait_ms
+            s["wait_ms_max"] = max(s["wait_ms_max"], wait_ms)
+        broken = False
+        try:
+            cnx = self._checkout()
+            cursor = cnx.cursor()
+            try:
+                yield cnx, cursor
+            except (mysql.connector.OperationalError, mysql.connector.InterfaceError):
+                broken = True
+                raise
+            finally:
+                try:
+                    cursor.close()
+                except Exception:
+                    pass
+                if broken:
+                    self._recycle(cnx)
+                elif st.DB_POOL_RESET_SESSION:
+                    forget(cnx)
+                try:
+                    cnx.close()
+                except Exception:
+                    pass
+        except Exception:
+            with self._lock:
+                self._stats["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                self._stats["in_use"] -= 1
+            self._slots.release()
+
+    def _recycle(self, cnx):
+        """Drop the socket of a broken connection; the pool reconnects it on next checkout"""
+        forget(cnx, close=False)
+        raw = getattr(cnx, "_cnx", None)
+        try:
+            if raw is not None:
+                raw.disconnect()
+        except Exception:
+            pass
+        with self._lock:
+            self._stats["recycled"] += 1
+        logger.warning(f"Pool {self.name}: recycled broken connection")
+
+    def health(self) -> dict:
+        start = time.perf_counter()
+        try:
+            with self.connection() as (cnx, cursor):
+                cursor.execute("SELECT 1")
+                cursor.fetchall()
+            return {"ok": True, "ms": round((time.perf_counter() - start) * 1000, 2)}
+        except Exception as e:
+            return {"ok": False, "error": str(e)}
+
+    def stats(self) -> dict:
+        with self._lock:
+            s = dict(self._stats)
+        s["size"] = self.size
+        s["created"] = self._pool is not None
+        s["utilization"] = round(s["in_use"] / self.size, 3)
+        s["wait_ms_avg"] = round(s["wait_ms_total"] / s["checkouts"], 3) if s["checkouts"] else 0.0
+        s["wait_ms_total"] = round(s["wait_ms_total"], 3)
+        s["wait_ms_max"] = round(s["wait_ms_max"], 3)
+        return s
+
+
+class PoolManager:
+    """Single owner of every StarRocks connection in a process (sizes from DB_POOL_SIZES)"""
+
+    def __init__(self):
+        self._pools: Dict[str, NamedPool] = {}
+        self._lock = threading.Lock()
+
+    def get(self, name: str) -> NamedPool:
+        pool = self._pools.get(name)
+        if pool is None:
+            with self._lock:
+                pool = self._pools.get(name)
+                if pool is None:
+                    size = st.DB_POOL_SIZES.get(name, st.DB_POOL_DEFAULT_SIZE)
+                    pool = self._pools[name] = NamedPool(name, size, st.DB_POOL_TIMEOUT)
+        return pool
+
+    def connection(self, name: str):
+        return self.get(name).connection()
+
+    def warm(self, *names: str):
+        for name in names:
+            self.get(name).warm()
+
+    def stats(self) -> dict:
+        return {name: pool.stats() for name, pool in list(self._pools.items())}
+
+
+pools = PoolManager()
@@ -0,0 +1,196 @@
+import logging
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import mysql.connector
+from mysql.connector import errorcode, pooling
+from app.config.env import st
+
+logger = logging.getLogger(__name__)
+
+# Histogram bucket upper bounds, ms (last bucket is +inf)
+BUCKETS_MS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+# Fixed hot statements. The string objects themselves matter: mysql.connector
+# re-prepares whenever a prepared cursor gets a different `operation` object.
+STATEMENTS: Dict[str, str] = {
+    "profile_rules_by_login": "SELECT tcp_rules, udp_rules, hash, policy_id FROM FW_Profiles WHERE login = %s",
+    "profile_by_id": "SELECT * FROM FW_Profiles WHERE id = %s",
+    "profile_hash_by_id": "SELECT hash FROM FW_Profiles WHERE id = %s",
+    "profile_for_delete": "SELECT login, tcp_rules, udp_rules, policy_id, hash FROM FW_Profiles WHERE id = %s",
+    "profiles_total": "SELECT COUNT(*) FROM FW_Profiles",
+    # Stop rows are tombstones of stops not flushed yet (see routes_radius.mark_stopped_streamload)
+    "session_by_login": "SELECT * FROM RADIUS_Sessions WHERE User_Name = %s AND (Acct_Status_Type IS NULL OR Acct_Status_Type != 'Stop')",
+    "policy_by_hash": "SELECT policy_id FROM FW_Profiles WHERE hash = %s AND policy_id IS NOT NULL AND policy_id != '' LIMIT 1",
+    "policy_refcount": "SELECT COUNT(*) FROM FW_Profiles WHERE policy_id = %s",
+}
+
+
+# Server errors meaning "this statement can't be prepared" (older StarRocks, unsupported syntax): only these
+# move a statement to the text protocol for good
+UNPREPARABLE = {errorcode.ER_UNSUPPORTED_PS, errorcode.ER_PARSE_ERROR, errorcode.ER_UNKNOWN_COM_ERROR,
+                errorcode.ER_NOT_SUPPORTED_YET}
+
+
+def register(name: str, sql: str):
+    """Add a hot statement (e.g. from a service module with its own column list)"""
+    STATEMENTS[name] = sql
+
+
+class StatementStats:
+    """Call count, errors and a fixed-bucket latency histogram for one statement"""
+
+    __slots__ = ("count", "errors", "prepared", "total_ms", "max_ms", "buckets")
+
+    def __init__(self):
+        self.count = self.errors = self.prepared = 0
+        self.total_ms = self.max_ms = 0.0
+        self.buckets = [0] * (len(BUCKETS_MS) + 1)
+
+    def observe(self, ms: float, ok: bool):
+        self.count += 1
+        self.errors += 0 if ok else 1
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.buckets[bisect_left(BUCKETS_MS, ms)] += 1
+
+    def _quantile(self, q: float):
+        rank, seen = q * self.count, 0
+        for i, n in enumerate(self.buckets):
+            seen += n
+            if seen >= rank:
+                return BUCKETS_MS[i] if i < len(BUCKETS_MS) else round(self.max_ms, 3)
+        return round(self.max_ms, 3)
+
+    def snapshot(self) -> dict:
+        return {
+            "count": self.count, "errors": self.errors, "prepares": self.prepared,
+            "total_ms": round(self.total_ms, 3), "max_ms": round(self.max_ms, 3),
+            "avg_ms": round(self.total_ms / self.count, 3) if self.count else 0.0,
+            "p50_ms": self._quantile(0.5) if self.count else 0.0,
+            "p95_ms": self._quantile(0.95) if self.count else 0.0,
+            "p99_ms": self._quantile(0.99) if self.count else 0.0,
+            "histogram": {(f"le_{b}" if i < len(BUCKETS_MS) else "inf"): n
+                          for i, (b, n) in enumerate(zip(BUCKETS_MS + (None,), self.buckets)) if n},
+        }
+
+
+_stats: Dict[str, StatementStats] = {}
+_stats_lock = threading.Lock()
+# Statements the server refused to prepare: sent as text from then on
+_text_only = set()
+
+
+def _observe(name: str, ms: float, ok: bool, prepared: bool = False):
+    with _stats_lock:
+        s = _stats.get(name)
+        if s is None:
+            s = _stats[name] = StatementStats()
+        s.observe(ms, ok)
+        s.prepared += 1 if prepared else 0
+
+
+@contextmanager
+def timed(label: str):
+    """Record latency of an ad-hoc (dynamic SQL) block under `label`, execute + fetch included"""
+    start = time.perf_counter()
+    ok = False
+    try:
+        yield
+        ok = True
+    finally:
+        _observe(label, (time.perf_counter() - start) * 1000, ok)
+
+
+def _raw(cnx):
+    return cnx._cnx if isinstance(cnx, pooling.PooledMySQLConnection) else cnx
+
+
+def _prepared_cursor(cnx, name: str):
+    """Cached prepared cursor for `name` on this physical connection; (cursor, newly_created)"""
+    raw = _raw(cnx)
+    cache = getattr(raw, "_mhe_statements", None)
+    # A reconnect (new connection_id) drops server-side statements: start over
+    if cache is None or cache[0] != raw.connection_id:
+        cache = (raw.connection_id, {})
+        raw._mhe_statements = cache
+    cursor = cache[1].get(name)
+    if cursor is None:
+        cursor = cache[1][name] = raw.cursor(prepared=True)
+        return cursor, True
+    return cursor, False
+
+
+def forget(cnx, close: bool = True):
+    """Drop the prepared-statement cache of a connection (about to be reset, or broken: close=False)"""
+    raw = _raw(cnx)
+    cache = getattr(raw, "_mhe_statements", None)
+    if not cache:
+        return
+    raw._mhe_statements = None
+    for cursor in cache[1].values() if close else ():
+        try:
+            cursor.close()
+        except Exception:
+            pass
+
+
+def _run(cnx, cursor, name: str, params, fetch: bool):
+    sql = STATEMENTS[name]
+    start = time.perf_counter()
+    if st.DB_PREPARED_STATEMENTS and name not in _text_only:
+        try:
+            pcursor, created = _prepared_cursor(cnx, name)
+            pcursor.execute(sql, params)
+            rows = pcursor.fetchall() if fetch else None
+            _observe(name, (time.perf_counter() - start) * 1000, True, created)
+            return pcursor, rows
+        except (mysql.connector.OperationalError, mysql.connector.InterfaceError):
+            forget(cnx, close=False)
+            _observe(name, (time.perf_counter() - start) * 1000, False)
+            raise
+        except mysql.connector.Error as e:
+            if e.errno not in UNPREPARABLE:
+                # A real error (execute, conversion, cursor setup): not the protocol's fault
+                _observe(name, (time.perf_counter() - start) * 1000, False)
+                raise
+            # Server can't prepare this one: use text protocol
+            _text_only.add(name)
+            forget(cnx)
+            logger.warning(f"Statement {name} can't be prepared ({e}), falling back to text protocol")
+            start = time.perf_counter()
+    ok = False
+    try:
+        cursor.execute(sql, params)
+        rows = cursor.fetchall() if fetch else None
+        ok = True
+        return cursor, rows
+    finally:
+        _observe(name, (time.perf_counter() - start) * 1000, ok)
+
+
+def fetchall(cnx, cursor, name: str, params=()) -> list:
+    return _run(cnx, cursor, name, params, True)[1]
+
+
+def fetchone(cnx, cursor, name: str, params=()):
+    rows = _run(cnx, cursor, name, params, True)[1]
+    return rows[0] if rows else None
+
+
+def fetchone_dict(cnx, cursor, name: str, params=()) -> Optional[dict]:
+    used, rows = _run(cnx, cursor, name, params, True)
+    if not rows:
+        return None
+    return dict(zip([col[0] for col in used.description], rows[0]))
+
+
+def stats(reset: bool = False) -> dict:
+    with _stats_lock:
+        result = {name: s.snapshot() for name, s in sorted(_stats.items(), key=lambda kv: -kv[1].total_ms)}
+        if reset:
+            _stats.clear()
+    return {"prepared_statements": st.DB_PREPARED_STATEMENTS, "text_only": sorted(_text_only), "statements": result}
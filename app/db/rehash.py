@@ -0,0 +1,128 @@
+"""One-time migration of FW_Profiles to canonical rule hashes.
+
+Profiles used to be hashed over the raw rule strings, so "80,443" and
+"443, 80" got separate FortiGate services and policies. This remaps every
+row to app.utils.ports.profile_hash and re-provisions online users whose
+hash changed (delete under the old hash, create under the new one), which
+lets AE fold them into one policy per canonical hash.
+
+    python -m app.db.rehash            # dry run: report what would change
+    python -m app.db.rehash --apply    # write hashes and send AE signals
+"""
+import argparse
+import logging
+import sys
+from collections import Counter
+
+import requests
+from app.config.env import st
+from app.db.pool import pools
+from app.db.sessions import STOPPED
+from app.utils.ports import profile_hash
+
+logger = logging.getLogger("rehash")
+
+def load():
+    with pools.connection("firewall") as (cnx, cursor):
+        cursor.execute("SELECT login, tcp_rules, udp_rules, hash, policy_id FROM FW_Profiles")
+        profiles = cursor.fetchall()
+        cursor.execute("SELECT User_Name, Framed_IP_Address, Delegated_IPv6_Prefix, NAS_IP_Address FROM RADIUS_Sessions "
+                       f"WHERE Acct_Status_Type IS NULL OR Acct_Status_Type != '{STOPPED}'")
+        online = {row[0]: row for row in cursor.fetchall()}
+    return profiles, online
+
+
+def plan(profiles):
+    """Return (changes, invalid); a change is (login, tcp, udp, old_hash, new_hash, old_policy_id)"""
+    changes, invalid = [], []
+    for login, tcp, udp, old_hash, policy_id in profiles:
+        try:
+            new_hash = profile_hash(tcp, udp)
+        except ValueError as e:
+            invalid.append((login, str(e)))
+            continue
+        if new_hash != old_hash:
+            changes.append((login, tcp, udp, old_hash, new_hash, policy_id))
+    return changes, invalid
+
+
+def write_hashes(changes):
+    """Partial upsert (login, hash, policy_id): other REPLACE_IF_NOT_NULL columns keep their values.
+    policy_id is cleared to '' so by-hash lookups never return a policy named after the old hash."""
+    with pools.connection("firewall") as (cnx, cursor):
+        for i in range(0, len(changes), 500):
+            chunk = changes[i:i + 500]
+            values = [v for login, _, _, _, new_hash, _ in chunk for v in (login, new_hash, "")]
+            cursor.execute(
+                f"INSERT INTO FW_Profiles (login, hash, policy_id) VALUES {', '.join(['(%s, %s, %s)'] * len(chunk))}",
+                values
+            )
+        cnx.commit()
+
+
+def signal(action, data, timeout):
+    """True if AE ran the signal without error"""
+    try:
+        r = requests.post(f"{st.config.ae_url}/signal", json={"action": action, "data": data}, timeout=timeout)
+        error = r.ok and (r.json().get("result") or {}).get("error")
+        if not r.ok or error:
+            logger.warning(f"Signal {action} for {data.get('user_name')} failed: {error or r.status_code}")
+        return r.ok and not error
+    except Exception as e:
+        logger.warning(f"Signal {action} for {data.get('user_name')} failed: {e}")
+        return False
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Remap FW_Profiles to canonical rule hashes")
+    parser.add_argument("--apply", action="store_true", help="write changes (default: dry run)")
+    parser.add_argument("--signal-timeout", type=float, default=30.0, help="seconds to wait for each AE signal")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    profiles, online = load()
+    changes, invalid = plan(profiles)
+    before = Counter(row[3] for row in profiles)
+    invalid_logins = {login for login, _ in invalid}
+    after = Counter(profile_hash(row[1], row[2]) for row in profiles if row[0] not in invalid_logins)
+    logger.info(f"Profiles: {len(profiles)}, to remap: {len(changes)}, invalid rules: {len(invalid)}")
+    logger.info(f"Distinct hashes: {len(before)} -> {len(after)}")
+    for login, error in invalid:
+        logger.warning(f"Skipping {login}: {error}")
+    if not args.apply or not changes:
+        return 0
+
+    offline = [change for change in changes if change[0] not in online]
+    write_hashes(offline)
+    logger.info(f"Wrote {len(offline)} canonical hashes of offline users")
+
+    # Online users one at a time: the row is remapped just before its delete signal, so rows not moved yet
+    # still reference the old policy and AE's refcount check keeps it until the last of them leaves it
+    # (then removes it with its service); then join the canonical one
+    moved, failed = 0, []
+    for change in changes:
+        login, tcp, udp, old_hash, new_hash, policy_id = change
+        session = online.get(login)
+        if not session:
+            continue
+        write_hashes([change])
+        # Same shape as the signals routes_radius sends (RADIUS attribute names)
+        user_name, ip, ipv6, nas_ip = session
+        attrs = {"User-Name": user_name, "user_name": user_name, "Framed-IP-Address": ip,
+                 "Delegated-IPv6-Prefix": ipv6, "NAS-IP-Address": nas_ip, "tcp_rules": tcp, "udp_rules": udp}
+        old = dict(attrs, hash=old_hash, policy_id=policy_id)
+        new = dict(attrs, hash=new_hash)
+        if signal("delete", old, args.signal_timeout) and signal("create", new, args.signal_timeout):
+            moved += 1
+        else:
+            failed.append(login)
+    logger.info(f"Re-provisioned {moved} online users")
+    if failed:
+        # Their rows already carry the new hash (a re-run won't pick them up): re-send their signals by hand
+        logger.error(f"Re-provisioning failed for {len(failed)} online users: {', '.join(failed)}")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Dict, List, Optional, Set, Tuple
+
+from app.config.env import st
+
+logger = logging.getLogger(__name__)
+
+# Acct_Status_Type of a RADIUS_Sessions tombstone: stopped, row DELETE not flushed yet
+STOPPED = "Stop"
+
+
+def _wake(fut: asyncio.Future, row: dict):
+    if not fut.done():
+        fut.set_result(row)
+
+
+class SessionRegistry:
+    """In-memory view of RADIUS_Sessions (User_Name -> row).
+
+    Seeded from the table at startup and fed by the RADIUS event route.
+    Events are processed in worker threads while waiters live on the event
+    loop, so waiters are woken through ``call_soon_threadsafe``.
+
+    Stop events are not deleted from the table one by one: logins queue up
+    in ``_pending`` and are removed by a periodic batched DELETE. Until that
+    flush lands they stay masked, so stale table rows are never reported.
+
+    The registry only sees events of its own process: with several mhe_db
+    workers or replicas a start/stop may land elsewhere. An entry is trusted
+    for RADIUS_REGISTRY_TTL seconds after this process learned it (event,
+    seed or table read), then `get` misses and the caller re-reads the table.
+    """
+
+    def __init__(self):
+        # login -> (row, monotonic time it was learned)
+        self._sessions: Dict[str, Tuple[dict, float]] = {}
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+        self._pending: Set[str] = set()
+        self._flushing: Set[str] = set()
+        self._lock = threading.Lock()
+        # Striped per-login locks: one login's start/stop (Stream Load + registry update) never interleave
+        self._event_locks = [threading.Lock() for _ in range(64)]
+        self.ready = False
+
+    def event_lock(self, login: str) -> threading.Lock:
+        """Held around a RADIUS event's table write and registry update: a stop and a quick restart
+        handled by two worker threads land in RADIUS_Sessions in the order they were registered"""
+        return self._event_locks[hash(login) % len(self._event_locks)]
+
+    def seed(self, rows: List[dict]):
+        now = time.monotonic()
+        with self._lock:
+            for row in rows:
+                login = row.get("User_Name")
+                if login and login not in self._sessions:
+                    self._sessions[login] = (row, now)
+            self.ready = True
+        logger.info(f"Session registry seeded with {len(self._sessions)} sessions")
+
+    def get(self, login: str) -> Optional[dict]:
+        """Session row if learned within RADIUS_REGISTRY_TTL seconds; None = ask the table"""
+        with self._lock:
+            entry = self._sessions.get(login)
+        if entry is None or time.monotonic() - entry[1] > st.RADIUS_REGISTRY_TTL:
+            return None
+        return dict(entry[0])
+
+    def confirm(self, login: str, row: Optional[dict]):
+        """Result of a table read: refresh the entry, or drop it if the session ended on another worker"""
+        with self._lock:
+            if row:
+                if login not in self._pending and login not in self._flushing:
+                    self._sessions[login] = (row, time.monotonic())
+            else:
+                self._sessions.pop(login, None)
+
+    def put(self, login: str, row: dict):
+        """Register Accounting-Start and wake everyone waiting for this login."""
+        with self._lock:
+            self._sessions[login] = (row, time.monotonic())
+            self._pending.discard(login)
+            waiters = self._waiters.pop(login, [])
+        for fut in waiters:
+            fut.get_loop().call_soon_threadsafe(_wake, fut, row)
+
+    def remove(self, login: str):
+        """Register Accounting-Stop; the table row is deleted by the next flush."""
+        with self._lock:
+            self._sessions.pop(login, None)
+            self._pending.add(login)
+
+    def is_masked(self, login: str) -> bool:
+        """True if the table row for `login` is stale (stopped, delete not yet flushed)."""
+        with self._lock:
+            return login not in self._sessions and (login in self._pending or login in self._flushing)
+
+    def pending_removals(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def begin_flush(self, limit: int) -> List[str]:
+        """Take up to `limit` pending logins for a batched DELETE."""
+        with self._lock:
+            batch = [self._pending.pop() for _ in range(min(limit, len(self._pending)))]
+            self._flushing.update(batch)
+        return batch
+
+    def end_flush(self, batch: List[str], ok: bool) -> List[dict]:
+        """Finish a flush; returns rows of logins restarted meanwhile (the DELETE may have hit them)."""
+        with self._lock:
+            self._flushing.difference_update(batch)
+            if not ok:
+                self._pending.update(login for login in batch if login not in self._sessions)
+                return []
+            return [dict(self._sessions[login][0]) for login in batch if login in self._sessions]
+
+    async def wait_for(self, login: str, timeout: float) -> Optional[dict]:
+        """Return the session row for `login`, waiting up to `timeout` seconds for it to land."""
+        fut = asyncio.get_running_loop().create_future()
+        with self._lock:
+            entry = self._sessions.get(login)
+            if entry:
+                return dict(entry[0])
+            self._waiters.setdefault(login, []).append(fut)
+        try:
+            return dict(await asyncio.wait_for(fut, timeout))
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            with self._lock:
+                waiters = self._waiters.get(login)
+                if waiters and fut in waiters:
+                    waiters.remove(fut)
+                    if not waiters:
+                        del self._waiters[login]
+
+    def __len__(self):
+        return len(self._sessions)
+
+
+# Process-wide registry shared by routes_radius (writer) and routes_firewall (reader)
+sessions = SessionRegistry()
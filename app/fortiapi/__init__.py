@@ -0,0 +1,2 @@
+# FortiAPI helpers module
+
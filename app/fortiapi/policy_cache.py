@@ -0,0 +1,106 @@
+import logging
+import time
+from typing import Dict, Iterable, List, Optional
+
+from app.config.env import st
+
+logger = logging.getLogger("mhe_fortiapi.policy_cache")
+
+# Built-in address FortiOS accepts in place of an empty srcaddr
+NONE_ADDRESS = "none"
+
+
+class CachedPolicy:
+    """srcaddr/srcaddr6 of one policy (or the members of an address group, in srcaddr) as last read or
+    written by fortiapi, with the config revision then"""
+
+    __slots__ = ("srcaddr", "srcaddr6", "revision", "loaded_at")
+
+    def __init__(self, srcaddr: List[str], srcaddr6: List[str], revision: Optional[str]):
+        self.srcaddr = srcaddr
+        self.srcaddr6 = srcaddr6
+        self.revision = revision
+        self.loaded_at = time.monotonic()
+
+    @property
+    def members(self) -> List[str]:
+        return [n for n in self.srcaddr if n != NONE_ADDRESS]
+
+
+class PolicyCache:
+    """Per-FortiGate policy membership by policy id (and address group members by table and name).
+
+    Filled from policy reads, snapshots and fortiapi's own writes, and updated in
+    place from write responses, so a membership change needs no read of the
+    policy. Entries expire after FG_POLICY_CACHE_TTL seconds (changes made on the
+    FortiGate by others); a failed write drops the entry. `revisions` keeps the
+    last CMDB config revision each FortiGate reported: an entry from an older
+    revision may be stale and is read again before it decides a skipped write
+    or a whole-list PUT.
+    """
+
+    def __init__(self):
+        self._fgs: Dict[str, Dict[str, CachedPolicy]] = {}
+        self.revisions: Dict[str, str] = {}
+        self.stats = {"hits": 0, "misses": 0, "invalidations": 0, "rereads": 0}
+
+    def observe(self, fg: str, resp) -> Optional[str]:
+        revision = resp.get("revision") if isinstance(resp, dict) else None
+        if revision:
+            self.revisions[fg] = revision
+        return revision
+
+    def current(self, fg: str, entry: CachedPolicy) -> bool:
+        """No config change reported by the FortiGate since the entry was read or written"""
+        return entry.revision == self.revisions.get(fg)
+
+    def get(self, fg: str, policy_id: str) -> Optional[CachedPolicy]:
+        entry = self._fgs.get(fg, {}).get(str(policy_id))
+        if entry is not None and time.monotonic() - entry.loaded_at > st.FG_POLICY_CACHE_TTL:
+            self._fgs[fg].pop(str(policy_id), None)
+            entry = None
+        self.stats["hits" if entry is not None else "misses"] += 1
+        return entry
+
+    def put(self, fg: str, policy_id: str, srcaddr: Iterable[str], srcaddr6: Iterable[str],
+            revision: Optional[str] = None) -> CachedPolicy:
+        entry = CachedPolicy(list(srcaddr), list(srcaddr6), revision or self.revisions.get(fg))
+        if st.FG_POLICY_CACHE_TTL > 0:
+            self._fgs.setdefault(fg, {})[str(policy_id)] = entry
+        return entry
+
+    def invalidate(self, fg: str, policy_id: Optional[str] = None):
+        if policy_id is None:
+            dropped = len(self._fgs.pop(fg, {}))
+        else:
+            dropped = int(self._fgs.get(fg, {}).pop(str(policy_id), None) is not None)
+        self.stats["invalidations"] += dropped
+
+    # Address groups share the per-FortiGate map under "table/name" keys
+    def get_group(self, fg: str, table: str, name: str) -> Optional[CachedPolicy]:
+        return self.get(fg, f"{table}/{name}")
+
+    def put_group(self, fg: str, table: str, name: str, members: Iterable[str], revision: Optional[str] = None) -> CachedPolicy:
+        return self.put(fg, f"{table}/{name}", members, (), revision)
+
+    def invalidate_group(self, fg: str, table: str, name: str):
+        self.invalidate(fg, f"{table}/{name}")
+
+    def load(self, fg: str, tables: Dict[str, List[dict]]):
+        """Snapshot read of a FortiGate: replaces everything cached for it"""
+        self._fgs.pop(fg, None)
+        for p in tables.get("policy") or []:
+            if p.get("policyid") is not None:
+                self.put(fg, p["policyid"], [a.get("name") for a in p.get("srcaddr") or []],
+                         [a.get("name") for a in p.get("srcaddr6") or []])
+        for table in ("addrgrp", "addrgrp6"):
+            for g in tables.get(table) or []:
+                if g.get("name"):
+                    self.put_group(fg, table, g["name"], [m.get("name") for m in g.get("member") or []])
+
+    def snapshot(self) -> dict:
+        return {**self.stats, "policies": {fg: len(p) for fg, p in self._fgs.items()}, "revisions": dict(self.revisions)}
+
+
+# Process-wide cache of this fortiapi instance
+policy_cache = PolicyCache()
@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import time
+from bisect import bisect_left
+from typing import Dict, Iterable
+
+import httpx
+
+from app.config.env import st
+
+logger = logging.getLogger("mhe_fortiapi.sessions")
+
+try:
+    import h2  # noqa: F401  (httpx speaks HTTP/2 only with it installed)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Request latency histogram bucket upper bounds, ms (last bucket is +inf)
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+# Cheap authenticated GET used for warm-up and keep-alive
+STATUS_PATH = "/api/v2/monitor/system/status"
+
+
+def _parse_tokens(raw: str) -> Dict[str, str]:
+    """Parse "10.0.0.1=token1,10.0.0.2=token2" into {"10.0.0.1": "token1", ...}"""
+    tokens = {}
+    for pair in (raw or "").split(","):
+        fg, _, token = pair.partition("=")
+        if fg.strip() and token.strip():
+            tokens[fg.strip()] = token.strip()
+    return tokens
+
+
+class FGSession:
+    """HTTP client of one FortiGate: own connection pool and limits, auth headers built once,
+    HTTP/2 when both sides speak it, latency and connection reuse counters."""
+
+    def __init__(self, fg: str, token: str):
+        self.fg = fg
+        self.client = httpx.AsyncClient(
+            base_url=f"{st.FG_SCHEME}://{fg}", verify=False, timeout=st.FG_TIMEOUT,
+            http2=st.FG_HTTP2 and HTTP2_AVAILABLE,
+            limits=httpx.Limits(max_connections=st.FG_MAX_CONNECTIONS, max_keepalive_connections=st.FG_MAX_CONNECTIONS,
+                                keepalive_expiry=st.FG_KEEPALIVE_EXPIRY),
+            headers={"Authorization": f"Bearer {token}", "Content-Type": "application/json"},
+        )
+        self.last_used = 0.0
+        self.stats = {"requests": 0, "errors": 0, "connections": 0, "tls_handshakes": 0, "keepalives": 0,
+                      "ms_total": 0.0, "ms_max": 0.0, "histogram": [0] * (len(LATENCY_BUCKETS_MS) + 1), "http_versions": {}}
+
+    async def _trace(self, event: str, info: dict):
+        # httpcore connection events: a request that opens no connection reused a pooled one
+        if event == "connection.connect_tcp.complete":
+            self.stats["connections"] += 1
+        elif event == "connection.start_tls.complete":
+            self.stats["tls_handshakes"] += 1
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        start = time.perf_counter()
+        self.last_used = time.monotonic()
+        try:
+            resp = await self.client.request(method, url, extensions={"trace": self._trace}, **kwargs)
+        except Exception:
+            self.stats["errors"] += 1
+            raise
+        finally:
+            ms = (time.perf_counter() - start) * 1000
+            self.stats["requests"] += 1
+            self.stats["ms_total"] += ms
+            self.stats["ms_max"] = max(self.stats["ms_max"], ms)
+            self.stats["histogram"][bisect_left(LATENCY_BUCKETS_MS, ms)] += 1
+        versions = self.stats["http_versions"]
+        versions[resp.http_version] = versions.get(resp.http_version, 0) + 1
+        return resp
+
+    async def ping(self) -> bool:
+        try:
+            return (await self.request("GET", STATUS_PATH)).is_success
+        except Exception as e:
+            logger.warning(f"[FG] {self.fg} keep-alive failed: {e}")
+            return False
+
+    async def warm(self, connections: int):
+        """Open `connections` pooled connections (TCP + TLS) ahead of the first real call"""
+        results = await asyncio.gather(*(self.ping() for _ in range(connections)))
+        logger.info(f"[FG] {self.fg} warmed up: {sum(results)}/{connections} connections")
+
+    def snapshot(self) -> dict:
+        s = self.stats
+        return {
+            "requests": s["requests"], "errors": s["errors"], "connections_opened": s["connections"],
+            "tls_handshakes": s["tls_handshakes"], "keepalives": s["keepalives"],
+            "reuse_ratio": round(1 - s["connections"] / s["requests"], 3) if s["requests"] else None,
+            "ms_avg": round(s["ms_total"] / s["requests"], 2) if s["requests"] else 0.0, "ms_max": round(s["ms_max"], 2),
+            "latency_histogram": {(f"le_{b}" if i < len(LATENCY_BUCKETS_MS) else "inf"): n
+                                  for i, (b, n) in enumerate(zip(LATENCY_BUCKETS_MS + (None,), s["histogram"])) if n},
+            "http_versions": dict(s["http_versions"]),
+            "idle_s": round(time.monotonic() - self.last_used, 1) if self.last_used else None,
+        }
+
+
+class SessionManager:
+    """One FGSession per FortiGate address, created on first use.
+
+    Tokens come from FG_API_TOKENS ("fg=token,...") with API_TOKEN for the rest.
+    `warm()` opens connections at startup; `keepalive_loop()` pings sessions idle
+    for FG_KEEPALIVE_INTERVAL seconds so their pooled connections (kept up to
+    FG_KEEPALIVE_EXPIRY) don't have to be re-established by the next real call.
+    """
+
+    def __init__(self):
+        self._sessions: Dict[str, FGSession] = {}
+
+    def get(self, fg: str) -> FGSession:
+        session = self._sessions.get(fg)
+        if session is None:
+            token = _parse_tokens(st.FG_API_TOKENS).get(fg) or st.API_TOKEN
+            session = self._sessions[fg] = FGSession(fg, token)
+            logger.info(f"[FG] Session for {fg} created (http2={st.FG_HTTP2 and HTTP2_AVAILABLE}, "
+                        f"max_connections={st.FG_MAX_CONNECTIONS})")
+        return session
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        """`url` is absolute (scheme://fg_addr/...): the session is picked by its host"""
+        return await self.get(url.split("/", 3)[2]).request(method, url, **kwargs)
+
+    async def warm(self, fgs: Iterable[str]):
+        if st.FG_WARM_CONNECTIONS > 0:
+            await asyncio.gather(*(self.get(fg).warm(st.FG_WARM_CONNECTIONS) for fg in fgs))
+
+    async def keepalive_loop(self):
+        """Background task: keep idle sessions' connections open"""
+        while True:
+            await asyncio.sleep(st.FG_KEEPALIVE_INTERVAL)
+            idle = [s for s in list(self._sessions.values())
+                    if time.monotonic() - s.last_used >= st.FG_KEEPALIVE_INTERVAL]
+            for session in idle:
+                session.stats["keepalives"] += 1
+            await asyncio.gather(*(s.ping() for s in idle))
+
+    async def aclose(self):
+        await asyncio.gather(*(s.client.aclose() for s in self._sessions.values()), return_exceptions=True)
+        self._sessions.clear()
+
+    def snapshot(self) -> dict:
+        return {fg: s.snapshot() for fg, s in list(self._sessions.items())}
+
+
+# Process-wide FortiGate sessions of this fortiapi instance
+sessions = SessionManager()
@@ -0,0 +1,92 @@
+import inspect
+import logging
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Callable, List, Optional
+
+logger = logging.getLogger("mhe_fortiapi.workflow")
+
+# Why FortiGate calls failed: "device" (transport error, timeout, 5xx/429 without a FortiOS error code:
+# the FortiGate is unhealthy) or "refused" (FortiOS answered with an error: the request is at fault).
+# fortiapi's _req reports into the list of the running scope; AE's breaker only counts "device".
+DEVICE, REFUSED = "device", "refused"
+_faults: ContextVar[Optional[list]] = ContextVar("fg_faults", default=None)
+
+
+def report_fault(kind: str):
+    faults = _faults.get()
+    if faults is not None:
+        faults.append(kind)
+
+
+@contextmanager
+def fault_scope():
+    """Collect the failure kinds of FortiGate calls made inside (tasks spawned inside share the list)"""
+    faults = []
+    token = _faults.set(faults)
+    try:
+        yield faults
+    finally:
+        _faults.reset(token)
+
+
+def fault_of(faults: List[str]) -> str:
+    return DEVICE if DEVICE in faults else REFUSED
+
+
+def _succeeded(result) -> bool:
+    return result is not None
+
+
+class Workflow:
+    """Ordered FortiGate steps of one composite call (provision / migrate / deprovision).
+
+    Each step is awaited in order and recorded with its outcome and latency.
+    After the first failed required step the workflow is failed and later
+    steps are skipped, so the caller can move on to the next FortiGate.
+    """
+
+    def __init__(self, name: str, fg_addr: str):
+        self.name = name
+        self.fg_addr = fg_addr
+        self.ok = True
+        self.failed_step: Optional[str] = None
+        self.fault: Optional[str] = None
+        self.steps: List[dict] = []
+        self._started = time.perf_counter()
+
+    async def step(self, name: str, awaitable, required: bool = True,
+                   check: Callable[[Any], bool] = _succeeded) -> Any:
+        if not self.ok:
+            if inspect.iscoroutine(awaitable):
+                awaitable.close()
+            return None
+        start = time.perf_counter()
+        with fault_scope() as faults:
+            try:
+                result = await awaitable
+            except Exception as e:
+                logger.error(f"[{self.name}] step {name} on {self.fg_addr} raised: {e}")
+                result = None
+        ok = check(result)
+        record = {"step": name, "ok": ok, "ms": round((time.perf_counter() - start) * 1000, 2)}
+        if not ok:
+            record["fault"] = fault_of(faults)
+        self.steps.append(record)
+        if not ok and required:
+            self.ok = False
+            self.failed_step = name
+            self.fault = record["fault"]
+        return result
+
+    def result(self, **extra) -> dict:
+        r = {
+            "ok": self.ok, "workflow": self.name, "fg_addr": self.fg_addr,
+            "ms": round((time.perf_counter() - self._started) * 1000, 2), "steps": self.steps,
+        }
+        if self.failed_step:
+            r["failed_step"] = self.failed_step
+            r["fault"] = self.fault
+        r.update(extra)
+        return r
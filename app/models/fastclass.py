@@ -7,6 +7,11 @@ class PrettyJSONResponse(JSONResponse):
     def render(self, content: Any) -> bytes:
         return orjson.dumps(content, option=orjson.OPT_INDENT_2)
 
+class FastJSONResponse(JSONResponse):
+    """orjson straight to bytes, no response_model validation; DB types orjson can't encode go through str()"""
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content, default=str)
+
 class CreateProfileRequest(BaseModel):
     name: str
     login: str
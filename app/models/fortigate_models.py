@@ -1,3 +1,4 @@
+from typing import List, Literal, Optional
 from pydantic import BaseModel
 
 class CreateIPRequest(BaseModel):
@@ -41,4 +42,84 @@ class EditPolicyRequest(BaseModel):
     fg_addr: str
     action: str
     policy_id: str
-    extra: dict = {} 
\ No newline at end of file
+    extra: dict = {}
+
+class ProvisionUserRequest(BaseModel):
+    fg_addr: str
+    user: str
+    ip: Optional[str] = None
+    ipv6: Optional[str] = None
+    hash: str
+    tcp: str = ""
+    udp: str = ""
+    # Policy already serving this hash: the user joins it instead of a new service+policy
+    policy_id: Optional[str] = None
+    # False: the caller adds the user to `policy_id` itself (batched membership update)
+    membership: bool = True
+
+class MigrateUserRequest(BaseModel):
+    fg_addr: str
+    # rename: rename the user's own policy/service to the new hash
+    # join: drop the old (now unused) policy, join `policy_id`
+    # split: leave the shared old policy, get a new service+policy
+    # move: leave the shared old policy, join `policy_id`
+    mode: Literal["rename", "join", "split", "move"]
+    user: str
+    ip: Optional[str] = None
+    ipv6: Optional[str] = None
+    hash: str
+    old_hash: Optional[str] = None
+    tcp: str = ""
+    udp: str = ""
+    old_policy_id: Optional[str] = None
+    policy_id: Optional[str] = None
+
+class DeprovisionUserRequest(BaseModel):
+    fg_addr: str
+    user: str
+    ip: Optional[str] = None
+    ipv6: Optional[str] = None
+    hash: Optional[str] = None
+    policy_id: Optional[str] = None
+    # True when no other profile references the policy: delete it and its service too
+    delete_policy: bool = False
+    # False: the caller already took the user out of `policy_id` (batched membership update)
+    membership: bool = True
+
+class ProbeRequest(BaseModel):
+    fg_addr: str
+
+class SnapshotRequest(BaseModel):
+    fg_addr: str
+    # Subset of address / address6 / addrgrp / addrgrp6 / service / policy; empty = all
+    tables: List[str] = []
+
+class UpdateIPRequest(BaseModel):
+    fg_addr: str
+    name: str
+    ip: str
+
+class PolicyMembersRequest(BaseModel):
+    fg_addr: str
+    policy_id: str
+    srcaddr: List[str]
+    srcaddr6: List[str] = []
+
+class PolicyMembersPatchRequest(BaseModel):
+    fg_addr: str
+    policy_id: str
+    add: List[str] = []
+    add6: List[str] = []
+    remove: List[str] = []
+    remove6: List[str] = []
+
+class GroupMembersRequest(BaseModel):
+    fg_addr: str
+    table: Literal["addrgrp", "addrgrp6"]
+    name: str
+    members: List[str]
+
+class DeleteGroupRequest(BaseModel):
+    fg_addr: str
+    table: Literal["addrgrp", "addrgrp6"]
+    name: str
@@ -26,6 +26,7 @@ class ListResponse(BaseModel):
     total: int = 0
     page: int = 1
     page_size: int = 25
+    next_cursor: Optional[str] = None
     error: Optional[str] = None
     comment: Optional[str] = None
 
@@ -1,37 +1,23 @@
-from fastapi import APIRouter, Query, Body
-from typing import Optional
+from fastapi import APIRouter, Query, Body, Request
+from fastapi.responses import StreamingResponse
+from typing import Optional, List
 from app.models.models import FirewallProfileIn, ListResponse, ItemResponse, SimpleResponse
-import mysql.connector, requests, hashlib, time, logging, asyncio
-from mysql.connector import pooling
+from app.db.sessions import sessions, STOPPED
+from app.db.policies import policies
+from app.db.aio import run_db, run_blocking, spawn_blocking
+import requests, time, logging, asyncio, base64, json, orjson
 from app.config.env import st
-from contextlib import contextmanager
+from app.db.pool import pools
+from app.db import query as q
+from app.utils.ports import profile_hash
+from app.models.fastclass import FastJSONResponse
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
-# Connection Pool for better performance
-try:
-    db_pool = pooling.MySQLConnectionPool(
-        pool_name="firewall_pool",
-        pool_size=30,
-        pool_reset_session=True,
-        **getattr(st, 'starrocks_config', st.mysql_config)
-    )
-    logger.info("Firewall connection pool created (size=30)")
-except Exception as e:
-    logger.error(f"Failed to create firewall connection pool: {e}")
-    db_pool = None
-
-@contextmanager
 def db():
-    """Context manager for DB connections (uses connection pool if available)"""
-    cnx = db_pool.get_connection() if db_pool else mysql.connector.connect(**getattr(st, 'starrocks_config', st.mysql_config))
-    cursor = cnx.cursor()
-    try:
-        yield cnx, cursor
-    finally:
-        cursor.close()
-        cnx.close()
+    """Context manager for DB connections from the shared "firewall" pool"""
+    return pools.connection("firewall")
 
 def resp(success=True, data=None, error=None, comment=None, **kwargs):
     r = {"success": success}
@@ -41,98 +27,327 @@ def resp(success=True, data=None, error=None, comment=None, **kwargs):
     r.update(kwargs)
     return r
 
-# URLs for inner service calls
-MHE_AE_URL = f"http://{st.MHE_AE_HOST}:{st.MHE_AE_PORT}/signal"
-MHE_APP_URL = f"http://{st.MHE_APP_HOST}:{st.MHE_APP_PORT}/keepalive"
-
 def send_signal(action, data):
+    if isinstance(data, dict):
+        # Someone is waiting on this profile change: AE schedules it ahead of RADIUS storms
+        data = {**data, "source": "profile"}
     try:
-        requests.post(MHE_AE_URL, json={"action": action, "data": data}, timeout=2)
+        requests.post(f"{st.config.ae_url}/signal", json={"action": action, "data": data}, timeout=2)
     except Exception as e:
         logger.warning(f"Failed to send signal to MHE_AE: {e}")
 
 def get_columns(cursor):
     return [col[0] for col in cursor.description] if cursor.description else []
 
-async def check_radius_with_keepalive(login: str, max_attempts: int = 3, delay: float = 0.5):
+def fetch_radius_session(login: str):
+    if sessions.is_masked(login):
+        return None
+    with db() as (cnx, cursor):
+        row = q.fetchone_dict(cnx, cursor, "session_by_login", (login,))
+    sessions.confirm(login, row)
+    return row
+
+def fetch_radius_sessions(logins: List[str]) -> dict:
+    """Sessions of many logins: registry first, one SELECT for the misses"""
+    found, missing = {}, []
+    for login in logins:
+        row = sessions.get(login)
+        if row:
+            found[login] = row
+        elif not sessions.is_masked(login):
+            missing.append(login)
+    if missing:
+        with db() as (cnx, cursor):
+            cursor.execute(f"SELECT * FROM RADIUS_Sessions WHERE User_Name IN ({', '.join(['%s'] * len(missing))}) "
+                           f"AND (Acct_Status_Type IS NULL OR Acct_Status_Type != '{STOPPED}')", missing)
+            columns = get_columns(cursor)
+            rows = {r["User_Name"]: r for r in (dict(zip(columns, row)) for row in cursor.fetchall())}
+        for login in missing:
+            sessions.confirm(login, rows.get(login))
+            if login in rows:
+                found[login] = rows[login]
+    return found
+
+def send_keepalive(login: str):
+    try:
+        requests.post(f"{st.config.app_url}/keepalive", json={"login": login}, timeout=1)
+    except Exception:
+        pass
+
+async def check_radius_with_keepalive(login: str, timeout: float = 1.5):
     """
-    Проверка сообщения в RADIUS, с periodic keepalive и паузой (async, non-blocking).
+    Проверка сессии RADIUS: реестр в памяти, затем таблица, затем keepalive и ожидание Accounting-Start.
+    SQL нужен, если сессия пришла на другой воркер, реестр не загружен или запись старше RADIUS_REGISTRY_TTL.
     """
-    for attempt in range(max_attempts):
-        with db() as (cnx, cursor):
-            cursor.execute("SELECT * FROM RADIUS_Sessions WHERE User_Name = %s", (login,))
-            row = cursor.fetchone()
-            if row:
-                columns = get_columns(cursor)
-                return True, dict(zip(columns, row))
-        if attempt < max_attempts - 1:
-            try:
-                requests.post(MHE_APP_URL, json={"login": login}, timeout=1)
-            except Exception:
-                pass
-            await asyncio.sleep(delay)  # Non-blocking sleep
-    return False, None
-
-@router.get("/firewall_profiles", response_model=ListResponse)
-def list_firewall_profiles(page: int = 1, page_size: int = 25, login: Optional[str] = None):
+    row = sessions.get(login)
+    if row:
+        return True, row
+    row = await run_blocking(fetch_radius_session, login)
+    if row:
+        return True, row
+    spawn_blocking(send_keepalive, login)
+    row = await sessions.wait_for(login, timeout)
+    if row:
+        return True, row
+    row = await run_blocking(fetch_radius_session, login)
+    return (True, row) if row else (False, None)
+
+# Cached total of FW_Profiles (invalidated on writes, refreshed at most every PROFILE_TOTAL_TTL seconds)
+_total_cache = {"value": None, "ts": 0.0}
+
+def invalidate_total():
+    _total_cache["value"] = None
+
+def cached_total(cnx, cursor):
+    if _total_cache["value"] is None or time.monotonic() - _total_cache["ts"] > st.PROFILE_TOTAL_TTL:
+        _total_cache.update(value=q.fetchone(cnx, cursor, "profiles_total")[0], ts=time.monotonic())
+    return _total_cache["value"]
+
+def encode_cursor(login: str) -> str:
+    """Opaque continuation token (keyset position on login)"""
+    return base64.urlsafe_b64encode(json.dumps({"login": login}).encode()).decode()
+
+def decode_cursor(token: str) -> str:
     try:
-        with db() as (cnx, cursor):
-            offset = (page - 1) * page_size
-            args = [login, page_size, offset] if login else [page_size, offset]
-            if login:
-                cursor.execute(
-                    "SELECT * FROM FW_Profiles WHERE login = %s LIMIT %s OFFSET %s",
-                    args
-                )
+        return json.loads(base64.urlsafe_b64decode(token.encode()))["login"]
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+@router.get("/firewall_profiles", response_model=ListResponse, response_class=FastJSONResponse)
+def list_firewall_profiles(page: int = 1, page_size: int = 25, login: Optional[str] = None,
+                           logins: Optional[str] = None, cursor_token: Optional[str] = Query(None, alias="cursor"),
+                           shape: str = Query("rows", pattern="^(rows|columns)$")):
+    """
+    Список профилей. Keyset-пагинация по login: передайте `cursor` из `next_cursor` предыдущего ответа.
+    `page` > 1 без cursor — старый режим LIMIT/OFFSET. `logins` — фильтр по списку логинов через запятую.
+    `shape=columns` — компактный формат для массовых выгрузок: `data = {"columns": [...], "rows": [[...], ...]}`.
+    Ответ сериализуется orjson напрямую из строк курсора, без валидации ListResponse.
+    """
+    try:
+        login_list = [login] if login else [l.strip() for l in (logins or "").split(",") if l.strip()]
+        filters, args = [], []
+        if login_list:
+            filters.append(f"login IN ({', '.join(['%s'] * len(login_list))})")
+            args.extend(login_list)
+        filter_args = list(args)
+        if cursor_token:
+            filters.append("login > %s")
+            args.append(decode_cursor(cursor_token))
+        where = f" WHERE {' AND '.join(filters)}" if filters else ""
+        with db() as (cnx, cursor), q.timed("profiles_list"):
+            if cursor_token or page <= 1:
+                cursor.execute(f"SELECT * FROM FW_Profiles{where} ORDER BY login LIMIT %s", args + [page_size])
             else:
-                cursor.execute(
-                    "SELECT * FROM FW_Profiles LIMIT %s OFFSET %s",
-                    args
-                )
+                cursor.execute(f"SELECT * FROM FW_Profiles{where} ORDER BY login LIMIT %s OFFSET %s", args + [page_size, (page - 1) * page_size])
             columns = get_columns(cursor)
             rows = cursor.fetchall()
-            data = [dict(zip(columns, row)) for row in rows] if columns and rows else []
-            if login:
-                cursor.execute("SELECT COUNT(*) FROM FW_Profiles WHERE login = %s", (login,))
+            next_cursor = encode_cursor(rows[-1][columns.index("login")]) if rows and len(rows) == page_size else None
+            if not login_list:
+                total = cached_total(cnx, cursor)
+            elif not cursor_token and page <= 1 and len(rows) < page_size:
+                total = len(rows)
             else:
-                cursor.execute("SELECT COUNT(*) FROM FW_Profiles")
-            total = cursor.fetchone()[0]
-        return resp(data=data, total=total, page=page, page_size=page_size)
+                cursor.execute(f"SELECT COUNT(*) FROM FW_Profiles WHERE login IN ({', '.join(['%s'] * len(login_list))})", filter_args)
+                total = cursor.fetchone()[0]
+        data = {"columns": columns, "rows": rows} if shape == "columns" else [dict(zip(columns, row)) for row in rows]
+        return FastJSONResponse(resp(data=data, total=total, page=page, page_size=page_size, next_cursor=next_cursor))
     except Exception as e:
         logger.error(f"Failed to list firewall profiles: {e}")
         return resp(False, error=str(e), data=[], total=0, page=page, page_size=page_size)
 
+PROFILE_COLUMNS = ["id", "profile_type", "can_delete", "profile_name", "created_at", "updated_at", "name", "login",
+                   "ip_pool", "ip_v6_pool", "region_id", "tcp_rules", "udp_rules", "firewall_profile", "hash"]
+
+def import_profiles_batch(profiles: List[FirewallProfileIn]) -> List[dict]:
+    """Upsert a batch of profiles with one multi-row INSERT; returns AE signals for online users"""
+    by_login = {p.login: p for p in profiles}
+    logins = list(by_login)
+    hashes = {login: profile_hash(p.tcp_rules, p.udp_rules) for login, p in by_login.items()}
+    with db() as (cnx, cursor), q.timed("profiles_import_batch"):
+        cursor.execute(f"SELECT login, hash, policy_id FROM FW_Profiles WHERE login IN ({', '.join(['%s'] * len(logins))})", logins)
+        existing = {row[0]: (row[1], row[2]) for row in cursor.fetchall()}
+        values = []
+        for login, p in by_login.items():
+            values.extend((p.id, p.profile_type, p.can_delete, p.profile_name, p.created_at, p.updated_at, p.name, p.login,
+                           p.ip_pool, p.ip_v6_pool, p.region_id, p.tcp_rules, p.udp_rules, p.firewall_profile, hashes[login]))
+        placeholders = f"({', '.join(['%s'] * len(PROFILE_COLUMNS))})"
+        cursor.execute(
+            f"INSERT INTO FW_Profiles ({', '.join(PROFILE_COLUMNS)}) VALUES {', '.join([placeholders] * len(by_login))}",
+            values
+        )
+        cnx.commit()
+    invalidate_total()
+    for login, hash_val in hashes.items():
+        policies.set(login, hash_val)
+
+    # Only online users need FortiGate work now; the rest are provisioned on Accounting-Start
+    signals = []
+    online = fetch_radius_sessions(logins)
+    for login, p in by_login.items():
+        radius_data = online.get(login)
+        old_hash, policy_id = existing.get(login, (None, None))
+        if not radius_data or old_hash == hashes[login]:
+            continue
+        joined = radius_data.copy()
+        joined.update({'tcp_rules': p.tcp_rules, 'udp_rules': p.udp_rules, 'hash': hashes[login]})
+        if login in existing:
+            joined.update({'old_hash': old_hash, 'policy_id': policy_id})
+            signals.append({"action": "edit", "data": joined})
+        else:
+            signals.append({"action": "create", "data": joined})
+    return signals
+
+@router.post("/firewall_profiles/import", response_model=SimpleResponse)
+async def import_firewall_profiles(request: Request):
+    """
+    Потоковый импорт профилей из NDJSON (один JSON-объект на строку).
+    Строки валидируются по одной, пишутся пачками по PROFILE_IMPORT_BATCH,
+    сигналы в AE уходят одним пакетом в конце.
+    """
+    batch, signals, errors = [], [], []
+    stats = {"imported": 0, "rejected": 0}
+
+    def parse(line: bytes, line_no: int):
+        if not line.strip():
+            return
+        try:
+            profile = FirewallProfileIn.model_validate(orjson.loads(line))
+            profile_hash(profile.tcp_rules, profile.udp_rules)  # rejects malformed port lists
+            batch.append(profile)
+        except Exception as e:
+            stats["rejected"] += 1
+            if len(errors) < 100:
+                errors.append({"line": line_no, "error": str(e)[:200]})
+
+    async def flush():
+        rows = batch.copy()
+        batch.clear()
+        try:
+            signals.extend(await run_blocking(import_profiles_batch, rows, timeout=60))
+            stats["imported"] += len(rows)
+        except Exception as e:
+            logger.error(f"Failed to import batch of {len(rows)} profiles: {e}")
+            stats["rejected"] += len(rows)
+            if len(errors) < 100:
+                errors.append({"batch": [rows[0].login, rows[-1].login], "error": str(e)[:200]})
+
+    try:
+        buf, line_no = b"", 0
+        async for chunk in request.stream():
+            buf += chunk
+            *lines, buf = buf.split(b"\n")
+            for line in lines:
+                line_no += 1
+                parse(line, line_no)
+                if len(batch) >= st.PROFILE_IMPORT_BATCH:
+                    await flush()
+        parse(buf, line_no + 1)
+        if batch:
+            await flush()
+        if signals:
+            await run_blocking(send_signal, "batch", signals)
+        logger.info(f"Firewall profiles imported: {stats}, signals={len(signals)}")
+        return resp(data={**stats, "signals": len(signals), "errors": errors})
+    except Exception as e:
+        logger.error(f"Failed to import firewall profiles: {e}")
+        return resp(False, error=str(e), data={**stats, "signals": len(signals), "errors": errors})
+
+@router.get("/firewall_profiles/export")
+def export_firewall_profiles():
+    """Потоковый экспорт всех профилей в NDJSON (небуферизованный курсор, память не растёт с числом строк)"""
+    def stream():
+        with db() as (cnx, cursor):
+            done = False
+            try:
+                cursor.execute("SELECT * FROM FW_Profiles")
+                columns = get_columns(cursor)
+                while True:
+                    rows = cursor.fetchmany(1000)
+                    if not rows:
+                        break
+                    yield b"".join(orjson.dumps(dict(zip(columns, row)), default=str) + b"\n" for row in rows)
+                done = True
+            finally:
+                if not done:
+                    # Client went away mid-stream: drain the result so the pooled connection stays usable
+                    try:
+                        cnx.consume_results()
+                    except Exception:
+                        pass
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+def assign_policy(cnx, cursor, login: str, policy_id: str) -> bool:
+    """Partial upsert of policy_id; INSERT ... SELECT so an unknown login never creates a stub row"""
+    with q.timed("profile_assign_policy"):
+        cursor.execute("INSERT INTO FW_Profiles (login, policy_id) SELECT login, %s FROM FW_Profiles WHERE login = %s", (policy_id, login))
+        cnx.commit()
+    return cursor.rowcount > 0
+
+@router.post("/firewall_profiles/update_policy_id", response_model=SimpleResponse)
+async def update_policy_id(payload: dict = Body(...)):
+    """AE: профиль `login` обслуживается политикой `policy_id` ('' — политика снята)"""
+    login, policy_id = payload.get("login"), payload.get("policy_id")
+    if not login or policy_id is None:
+        return resp(False, error="login и policy_id обязательны")
+    try:
+        if not await run_db(db, assign_policy, login, str(policy_id)):
+            return resp(False, error="Профиль не найден")
+        policies.set(login, policy_id=str(policy_id))
+        return resp()
+    except Exception as e:
+        logger.error(f"Failed to update policy_id for {login}: {e}")
+        return resp(False, error=str(e))
+
 @router.get("/firewall_profiles/{id}", response_model=ItemResponse)
 def get_firewall_profile(id: int):
     try:
         with db() as (cnx, cursor):
-            cursor.execute("SELECT * FROM FW_Profiles WHERE id = %s", (id,))
-            row = cursor.fetchone()
-            if not row:
-                return resp(False, error="Not found")
-            columns = get_columns(cursor)
-        return resp(data=dict(zip(columns, row)))
+            row = q.fetchone_dict(cnx, cursor, "profile_by_id", (id,))
+        if not row:
+            return resp(False, error="Not found")
+        return resp(data=row)
     except Exception as e:
         logger.error(f"Failed to get firewall profile {id}: {e}")
         return resp(False, error=str(e))
 
+def insert_profile(cnx, cursor, profile: FirewallProfileIn, hash_val: str):
+    cursor.execute(
+        "INSERT INTO FW_Profiles (profile_type, can_delete, profile_name, created_at, updated_at, name, login, ip_pool, ip_v6_pool, region_id, tcp_rules, udp_rules, firewall_profile, hash) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
+        (profile.profile_type, profile.can_delete, profile.profile_name, profile.created_at, profile.updated_at, profile.name, profile.login, profile.ip_pool, profile.ip_v6_pool, profile.region_id, profile.tcp_rules, profile.udp_rules, profile.firewall_profile, hash_val)
+    )
+    cnx.commit()
+    return cursor.lastrowid
+
+def replace_profile(cnx, cursor, id: int, profile: FirewallProfileIn, hash_val: str):
+    """Upsert profile `id`; returns its previous hash"""
+    old_hash_row = q.fetchone(cnx, cursor, "profile_hash_by_id", (id,))
+    cursor.execute(
+        """INSERT INTO FW_Profiles (id, profile_type, can_delete, profile_name, created_at, updated_at, name, login, ip_pool, ip_v6_pool, region_id, tcp_rules, udp_rules, firewall_profile, hash) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+        (id, profile.profile_type, profile.can_delete, profile.profile_name, profile.created_at, profile.updated_at, profile.name, profile.login, profile.ip_pool, profile.ip_v6_pool, profile.region_id, profile.tcp_rules, profile.udp_rules, profile.firewall_profile, hash_val)
+    )
+    cnx.commit()
+    return old_hash_row[0] if old_hash_row else None
+
+def select_profile_for_delete(cnx, cursor, id: int):
+    return q.fetchone(cnx, cursor, "profile_for_delete", (id,))
+
+def delete_profile(cnx, cursor, id: int):
+    cursor.execute("DELETE FROM FW_Profiles WHERE id = %s", (id,))
+    cnx.commit()
+
 @router.post("/firewall_profiles", response_model=ItemResponse)
 async def create_firewall_profile(profile: FirewallProfileIn = Body(...)):
     try:
         found, radius_data = await check_radius_with_keepalive(profile.login)
         if not found:
-            return resp(False, error="RADIUS Accounting-Start не найден после 3 попыток", comment="Ожидание RADIUS Accounting-Start...")
-        hash_val = hashlib.md5(f"{profile.tcp_rules}|{profile.udp_rules}".encode()).hexdigest()
-        with db() as (cnx, cursor):
-            cursor.execute(
-                "INSERT INTO FW_Profiles (profile_type, can_delete, profile_name, created_at, updated_at, name, login, ip_pool, ip_v6_pool, region_id, tcp_rules, udp_rules, firewall_profile, hash) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)",
-                (profile.profile_type, profile.can_delete, profile.profile_name, profile.created_at, profile.updated_at, profile.name, profile.login, profile.ip_pool, profile.ip_v6_pool, profile.region_id, profile.tcp_rules, profile.udp_rules, profile.firewall_profile, hash_val)
-            )
-            cnx.commit()
-            new_id = cursor.lastrowid
-            joined = radius_data.copy()
-            joined.update({'tcp_rules': profile.tcp_rules, 'udp_rules': profile.udp_rules, 'hash': hash_val})
-            send_signal("create", joined)
+            return resp(False, error="RADIUS Accounting-Start не найден", comment="Ожидание RADIUS Accounting-Start...")
+        hash_val = profile_hash(profile.tcp_rules, profile.udp_rules)
+        new_id = await run_db(db, insert_profile, profile, hash_val)
+        invalidate_total()
+        policies.set(profile.login, hash_val)
+        joined = radius_data.copy()
+        joined.update({'tcp_rules': profile.tcp_rules, 'udp_rules': profile.udp_rules, 'hash': hash_val})
+        await run_blocking(send_signal, "create", joined)
         logger.info(f"Firewall profile created: id={new_id}, login={profile.login}, hash={hash_val}")
         return resp(data={"id": new_id})
     except Exception as e:
@@ -144,22 +359,15 @@ async def update_firewall_profile(id: int, profile: FirewallProfileIn = Body(...
     try:
         found, radius_data = await check_radius_with_keepalive(profile.login)
         if not found:
-            return resp(False, error="RADIUS Accounting-Start не найден после 3 попыток", comment="Ожидание RADIUS Accounting-Start...")
-
-        with db() as (cnx, cursor):
-            cursor.execute("SELECT hash FROM FW_Profiles WHERE id = %s", (id,))
-            old_hash_row = cursor.fetchone()
-            old_hash = old_hash_row[0] if old_hash_row else None
+            return resp(False, error="RADIUS Accounting-Start не найден", comment="Ожидание RADIUS Accounting-Start...")
 
-            hash_val = hashlib.md5(f"{profile.tcp_rules}|{profile.udp_rules}".encode()).hexdigest()
-            cursor.execute(
-                """INSERT INTO FW_Profiles (id, profile_type, can_delete, profile_name, created_at, updated_at, name, login, ip_pool, ip_v6_pool, region_id, tcp_rules, udp_rules, firewall_profile, hash) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)""",
-                (id, profile.profile_type, profile.can_delete, profile.profile_name, profile.created_at, profile.updated_at, profile.name, profile.login, profile.ip_pool, profile.ip_v6_pool, profile.region_id, profile.tcp_rules, profile.udp_rules, profile.firewall_profile, hash_val)
-            )
-            cnx.commit()
-            joined = radius_data.copy()
-            joined.update({'tcp_rules': profile.tcp_rules, 'udp_rules': profile.udp_rules, 'hash': hash_val, 'old_hash': old_hash})
-            send_signal("edit", joined)
+        hash_val = profile_hash(profile.tcp_rules, profile.udp_rules)
+        old_hash = await run_db(db, replace_profile, id, profile, hash_val)
+        invalidate_total()
+        policies.set(profile.login, hash_val)
+        joined = radius_data.copy()
+        joined.update({'tcp_rules': profile.tcp_rules, 'udp_rules': profile.udp_rules, 'hash': hash_val, 'old_hash': old_hash})
+        await run_blocking(send_signal, "edit", joined)
         logger.info(f"Firewall profile updated: id={id}, login={profile.login}, hash={hash_val}")
         return resp(data={"id": id})
     except Exception as e:
@@ -169,48 +377,66 @@ async def update_firewall_profile(id: int, profile: FirewallProfileIn = Body(...
 @router.delete("/firewall_profiles/{id}", response_model=SimpleResponse)
 async def delete_firewall_profile(id: int):
     try:
-        with db() as (cnx, cursor):
-            cursor.execute("SELECT login, tcp_rules, udp_rules, policy_id, hash FROM FW_Profiles WHERE id = %s", (id,))
-            row = cursor.fetchone()
-            if not row or not row[0]:
-                return resp(False, error="Профиль не найден")
-            login, tcp_rules, udp_rules, policy_id, hash_val = row
+        row = await run_db(db, select_profile_for_delete, id)
+        if not row or not row[0]:
+            return resp(False, error="Профиль не найден")
+        login, tcp_rules, udp_rules, policy_id, hash_val = row
 
         found, radius_data = await check_radius_with_keepalive(login)
         if not found:
-            return resp(False, error="RADIUS Accounting-Start не найден после 3 попыток", comment="Ожидание RADIUS Accounting-Start...")
+            return resp(False, error="RADIUS Accounting-Start не найден", comment="Ожидание RADIUS Accounting-Start...")
 
-        with db() as (cnx, cursor):
-            cursor.execute("DELETE FROM FW_Profiles WHERE id = %s", (id,))
-            cnx.commit()
-            joined = radius_data.copy()
-            joined.update({'tcp_rules': tcp_rules, 'udp_rules': udp_rules, 'policy_id': policy_id, 'hash': hash_val})
-            send_signal("delete", joined)
+        await run_db(db, delete_profile, id)
+        invalidate_total()
+        policies.discard(login)
+        joined = radius_data.copy()
+        joined.update({'tcp_rules': tcp_rules, 'udp_rules': udp_rules, 'policy_id': policy_id, 'hash': hash_val})
+        await run_blocking(send_signal, "delete", joined)
         logger.info(f"Firewall profile deleted: id={id}, login={login}, hash={hash_val}")
         return resp()
     except Exception as e:
         logger.error(f"Failed to delete firewall profile {id}: {e}")
         return resp(False, error=str(e))
 
+DESIRED_STATE_COLUMNS = ["login", "hash", "policy_id", "tcp_rules", "udp_rules", "ip", "ipv6", "nas_ip"]
+
+@router.get("/desired_state", response_class=FastJSONResponse)
+def desired_state():
+    """
+    Все профили с текущей сессией (ip/ipv6/nas_ip = null — пользователь не в сети), колоночный формат.
+    Источник истины для сверки объектов на FortiGate (AE reconciler).
+    """
+    try:
+        with db() as (cnx, cursor), q.timed("desired_state"):
+            cursor.execute(
+                "SELECT p.login, p.hash, p.policy_id, p.tcp_rules, p.udp_rules, "
+                "s.Framed_IP_Address, s.Delegated_IPv6_Prefix, s.NAS_IP_Address "
+                "FROM FW_Profiles p LEFT JOIN RADIUS_Sessions s ON s.User_Name = p.login "
+                f"AND (s.Acct_Status_Type IS NULL OR s.Acct_Status_Type != '{STOPPED}')"
+            )
+            rows = cursor.fetchall()
+        # Stopped sessions whose DELETE is not flushed yet are offline already
+        rows = [row[:5] + (None, None, None) if row[5] is not None and sessions.is_masked(row[0]) else row for row in rows]
+        return FastJSONResponse(resp(data={"columns": DESIRED_STATE_COLUMNS, "rows": rows}, total=len(rows)))
+    except Exception as e:
+        logger.error(f"Failed to build desired state: {e}")
+        return resp(False, error=str(e))
+
 @router.get("/radius_check")
 def check_radius_message(login: str = Query(...)):
     """
     Проверить наличие RADIUS для логина.
     """
     try:
-        with db() as (cnx, cursor):
-            cursor.execute("SELECT * FROM RADIUS_Sessions WHERE User_Name = %s", (login,))
-            row = cursor.fetchone()
-            if row:
-                columns = get_columns(cursor)
-                data = dict(zip(columns, row))
-                return {"found": True, "message": "RADIUS сообщение найдено", "comment": None, "data": data}
-            else:
-                return {"found": False, "message": "RADIUS сообщение не найдено", "comment": "Ожидание RADIUS Accounting-Start..."}
+        data = sessions.get(login) or fetch_radius_session(login)
+        if data:
+            return {"found": True, "message": "RADIUS сообщение найдено", "comment": None, "data": data}
+        else:
+            return {"found": False, "message": "RADIUS сообщение не найдено", "comment": "Ожидание RADIUS Accounting-Start..."}
     except Exception as e:
         logger.error(f"Failed to check RADIUS message for {login}: {e}")
         return {"found": False, "message": f"Ошибка проверки: {str(e)}", "comment": None}
 
 @router.get("/health")
 def health_check():
-    return {"status": "healthy", "service": "mhe_db"}
\ No newline at end of file
+    return {"status": "healthy", "service": "mhe_db", "sessions": len(sessions), "sessions_seeded": sessions.ready}
\ No newline at end of file
@@ -1,38 +1,31 @@
+import asyncio
 import logging
 from fastapi import APIRouter, Body
 from app.models.models import ItemResponse
-import mysql.connector
-from mysql.connector import pooling
 from app.config.env import st
+from app.db.aio import run_db, run_blocking
+from app.db.pool import pools
+from app.db import query as q
+from app.db.policies import policies
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
-# Connection Pool for better performance
-try:
-    db_pool = pooling.MySQLConnectionPool(
-        pool_name="query_pool",
-        pool_size=20,
-        pool_reset_session=True,
-        **getattr(st, 'starrocks_config', st.mysql_config)
-    )
-    logger.info("Query connection pool created (size=20)")
-except Exception as e:
-    logger.error(f"Failed to create query connection pool: {e}")
-    db_pool = None
-
-def query_db(query, params):
-    """Execute DB query (uses connection pool if available)"""
+def db():
+    """Context manager for DB connections from the shared "query" pool"""
+    return pools.connection("query")
+
+def _fetchall(cnx, cursor, query, params):
+    if query in q.STATEMENTS:
+        return q.fetchall(cnx, cursor, query, params)
+    with q.timed("query_adhoc"):
+        cursor.execute(query, params)
+        return cursor.fetchall()
+
+async def query_db(query, params):
+    """Execute DB query (or named hot statement from app.db.query) on the shared DB executor"""
     try:
-        cnx = db_pool.get_connection() if db_pool else mysql.connector.connect(**getattr(st, 'starrocks_config', st.mysql_config))
-        cursor = cnx.cursor()
-        try:
-            cursor.execute(query, params)
-            result = cursor.fetchall()
-            return result
-        finally:
-            cursor.close()
-            cnx.close()
+        return await run_db(db, _fetchall, query, params)
     except Exception as e:
         raise RuntimeError(str(e))
 
@@ -42,37 +35,116 @@ def resp(success=True, data=None, error=None):
     if error: r["error"] = error
     return r
 
+def load_policies_sync():
+    """(Re)seed the policy index from FW_Profiles"""
+    policies.begin_seed()
+    try:
+        with db() as (cnx, cursor), q.timed("policy_index_seed"):
+            cursor.execute("SELECT login, hash, policy_id FROM FW_Profiles")
+            rows = cursor.fetchall()
+    except Exception:
+        policies.abort_seed()
+        raise
+    policies.seed(rows)
+
+async def policy_index_refresher():
+    """Background task: seed the index at startup, then reseed every POLICY_INDEX_REFRESH seconds"""
+    while True:
+        try:
+            await run_blocking(load_policies_sync, timeout=60)
+        except Exception as e:
+            logger.error(f"Failed to seed policy index: {e}")
+        if st.POLICY_INDEX_REFRESH <= 0 and policies.ready:
+            return
+        await asyncio.sleep(st.POLICY_INDEX_REFRESH if policies.ready else 5)
+
+# The index is per process: another mhe_db worker's writes reach it only with the next reseed. Its answers
+# are trusted when positive; a miss (no policy / no references) is confirmed against FW_Profiles.
+
+async def policy_by_hash(hash_val):
+    policy_id = policies.policy_by_hash(hash_val) if policies.ready else None
+    if policy_id:
+        return policy_id
+    # Rows without a policy (or cleared by the rehash migration) never answer a by-hash lookup
+    rows = await query_db("policy_by_hash", (hash_val,))
+    return rows[0][0] if rows else None
+
+async def policy_refcount(policy_id):
+    count = policies.refcount(policy_id) if policies.ready else 0
+    if count:
+        return count
+    rows = await query_db("policy_refcount", (str(policy_id),))
+    return rows[0][0] if rows else 0
+
 @router.post("/policy_id/by_hash", response_model=ItemResponse)
-def get_policy_id_by_hash(payload: dict = Body(...)):
+async def get_policy_id_by_hash(payload: dict = Body(...)):
     hash_val = payload.get("hash")
     try:
-        rows = query_db("SELECT policy_id FROM FW_Profiles WHERE hash = %s LIMIT 1", (hash_val,))
-        return resp(data={"policy_id": rows[0][0]} if rows else None)
+        policy_id = await policy_by_hash(hash_val)
+        return resp(data={"policy_id": policy_id} if policy_id else None)
     except Exception as e:
         logger.error(f"Failed to get policy_id by hash: {e}")
         return resp(False, error=str(e))
 
 @router.put("/policy_id/check", response_model=ItemResponse)
-def check_policy_id_and_hash(payload: dict = Body(...)):
+async def check_policy_id_and_hash(payload: dict = Body(...)):
     policy_id = payload.get("policy_id")
     hash_val = payload.get("hash")
     try:
-        count_rows = query_db("SELECT COUNT(*) FROM FW_Profiles WHERE policy_id = %s", (policy_id,))
-        exists = count_rows[0][0] > 0 if count_rows else False
-        rows = query_db("SELECT policy_id FROM FW_Profiles WHERE hash = %s LIMIT 1", (hash_val,))
-        hash_policy_id = rows[0][0] if rows else None
+        exists = await policy_refcount(policy_id) > 0
+        hash_policy_id = await policy_by_hash(hash_val)
         return resp(data={"policy_id_exists": exists, "policy_id_by_hash": hash_policy_id})
     except Exception as e:
         logger.error(f"Failed to check policy_id and hash: {e}")
         return resp(False, error=str(e))
 
 @router.delete("/policy_id/check", response_model=ItemResponse)
-def check_policy_id_exists(payload: dict = Body(...)):
+async def check_policy_id_exists(payload: dict = Body(...)):
     policy_id = payload.get("policy_id")
     try:
-        count_rows = query_db("SELECT COUNT(*) FROM FW_Profiles WHERE policy_id = %s", (policy_id,))
-        exists = count_rows[0][0] > 0 if count_rows else False
+        exists = await policy_refcount(policy_id) > 0
         return resp(data={"policy_id_exists": exists})
     except Exception as e:
         logger.error(f"Failed to check policy_id exists: {e}")
-        return resp(False, error=str(e))
\ No newline at end of file
+        return resp(False, error=str(e))
+
+@router.post("/policy_id/by_hash/batch", response_model=ItemResponse)
+async def get_policy_ids_by_hash(payload: dict = Body(...)):
+    """{"hashes": [...]} → {"policy_ids": {hash: policy_id | null}}"""
+    hashes = [h for h in payload.get("hashes") or [] if h]
+    try:
+        result = policies.policies_by_hash(hashes) if policies.ready else dict.fromkeys(hashes)
+        missing = [h for h, policy_id in result.items() if not policy_id]
+        if missing:
+            rows = await query_db(
+                f"SELECT hash, policy_id FROM FW_Profiles WHERE hash IN ({', '.join(['%s'] * len(missing))}) AND policy_id IS NOT NULL AND policy_id != ''",
+                missing
+            )
+            for hash_val, policy_id in rows:
+                result[hash_val] = result[hash_val] or policy_id
+        return resp(data={"policy_ids": result})
+    except Exception as e:
+        logger.error(f"Failed to get policy_ids by hash: {e}")
+        return resp(False, error=str(e))
+
+@router.post("/policy_id/check/batch", response_model=ItemResponse)
+async def check_policy_ids(payload: dict = Body(...)):
+    """{"policy_ids": [...]} → {"refcounts": {policy_id: profiles using it}}"""
+    policy_ids = [str(p) for p in payload.get("policy_ids") or [] if p]
+    try:
+        result = policies.refcounts(policy_ids) if policies.ready else dict.fromkeys(policy_ids, 0)
+        missing = [p for p, count in result.items() if not count]
+        if missing:
+            rows = await query_db(
+                f"SELECT policy_id, COUNT(*) FROM FW_Profiles WHERE policy_id IN ({', '.join(['%s'] * len(missing))}) GROUP BY policy_id",
+                missing
+            )
+            result.update({policy_id: count for policy_id, count in rows})
+        return resp(data={"refcounts": result})
+    except Exception as e:
+        logger.error(f"Failed to check policy_ids: {e}")
+        return resp(False, error=str(e))
+
+@router.get("/policy_index")
+def policy_index_stats():
+    return policies.stats()
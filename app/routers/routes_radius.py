@@ -1,33 +1,21 @@
 from fastapi import APIRouter
 from app.models.models import RadiusEvent, SimpleResponse
-import mysql.connector
-from mysql.connector import pooling
+from app.db.sessions import sessions, STOPPED
 from app.config.env import st
+from app.db.pool import pools
+from app.db import query as q
 from datetime import datetime
 import requests
 import logging
 import asyncio
-from concurrent.futures import ThreadPoolExecutor
+from app.db.aio import run_blocking
 
 logger = logging.getLogger(__name__)
 router = APIRouter()
 
-# Connection Pool for parallel RADIUS event processing
-try:
-    db_pool = pooling.MySQLConnectionPool(
-        pool_name="radius_pool",
-        pool_size=50,  # Handle up to 50 concurrent RADIUS events
-        pool_reset_session=True,
-        **getattr(st, 'starrocks_config', st.mysql_config)
-    )
-    logger.info("RADIUS connection pool created (size=50)")
-except Exception as e:
-    logger.error(f"Failed to create RADIUS connection pool: {e}")
-    db_pool = None
-
-# Thread pool for blocking I/O (DB queries, HTTP requests)
-executor = ThreadPoolExecutor(max_workers=100, thread_name_prefix="radius_worker")
-logger.info("RADIUS thread pool executor created (max_workers=100)")
+def db():
+    """Context manager for DB connections from the shared "radius" pool"""
+    return pools.connection("radius")
 
 # StarRocks Stream Load settings
 STARROCKS_HOST = st.starrocks_config.get('host', '127.0.0.1')
@@ -40,8 +28,19 @@ RADIUS_COLUMNS = ["User_Name", "Timestamp", "Acct_Status_Type", "Framed_IP_Addre
 
 def insert_radius_streamload(user_name: str, timestamp: str, acct_status_type: str, framed_ip: str, ipv6_prefix: str, nas_ip: str) -> bool:
     """Fast INSERT via Stream Load for RADIUS_Sessions"""
+    return _radius_streamload(RADIUS_COLUMNS, [user_name, timestamp, acct_status_type, framed_ip, ipv6_prefix, nas_ip])
+
+def mark_stopped_streamload(user_name: str, timestamp: str) -> bool:
+    """Persist an Accounting-Stop before its batched DELETE: Acct_Status_Type = Stop (a tombstone).
+
+    Readers skip tombstones and seed_sessions re-queues them for deletion, so a
+    stop survives a crash or restart before the flush. Only a stop whose
+    tombstone load failed lives in memory alone until the next flush.
+    """
+    return _radius_streamload(RADIUS_COLUMNS[:3], [user_name, timestamp, STOPPED])
+
+def _radius_streamload(columns, values) -> bool:
     try:
-        values = [user_name, timestamp, acct_status_type, framed_ip, ipv6_prefix, nas_ip]
         csv_line = ",".join([f'"{v}"' for v in values])
         
         url = f"http://{STARROCKS_HOST}:{STARROCKS_PORT}/api/{STARROCKS_DB}/RADIUS_Sessions/_stream_load"
@@ -49,15 +48,17 @@ def insert_radius_streamload(user_name: str, timestamp: str, acct_status_type: s
             "label": f"radius_{datetime.now().timestamp()}",
             "column_separator": ",",
             "format": "csv",
+            "columns": ",".join(columns),
         }
         
-        response = requests.put(
-            url,
-            auth=(STARROCKS_USER, STARROCKS_PASSWORD),
-            headers=headers,
-            data=csv_line.encode('utf-8'),
-            timeout=5
-        )
+        with q.timed("radius_stream_load"):
+            response = requests.put(
+                url,
+                auth=(STARROCKS_USER, STARROCKS_PASSWORD),
+                headers=headers,
+                data=csv_line.encode('utf-8'),
+                timeout=5
+            )
         
         if response.status_code == 200:
             result = response.json()
@@ -76,11 +77,9 @@ def resp(success=True, data=None, error=None, **kwargs):
     r.update(kwargs)
     return r
 
-MHE_AE_URL = f"http://{st.MHE_AE_HOST}:{st.MHE_AE_PORT}/signal"
-
 def send_signal(action, data):
     try:
-        requests.post(MHE_AE_URL, json={"action": action, "data": data}, timeout=2)
+        requests.post(f"{st.config.ae_url}/signal", json={"action": action, "data": data}, timeout=2)
     except Exception as e:
         logger.warning(f"Failed to send signal to MHE_AE: {e}")
 
@@ -99,7 +98,7 @@ def process_radius_event_sync(attrs: dict):
         # Process RADIUS event
         if acct_status == 'start':
             # Fast INSERT via Stream Load
-            insert_ok = insert_radius_streamload(
+            session_values = (
                 user_name,
                 str(datetime.now()),
                 attrs.get('Acct-Status-Type', ''),
@@ -107,42 +106,36 @@ def process_radius_event_sync(attrs: dict):
                 attrs.get('Delegated-IPv6-Prefix', ''),
                 attrs.get('NAS-IP-Address', '')
             )
+            with sessions.event_lock(user_name):
+                insert_ok = insert_radius_streamload(*session_values)
+                if not insert_ok:
+                    logger.warning(f"Stream Load failed for RADIUS start: user={user_name}")
+                sessions.put(user_name, dict(zip(RADIUS_COLUMNS, session_values)))
             
-            if not insert_ok:
-                logger.warning(f"Stream Load failed for RADIUS start: user={user_name}")
-            
-            # Check if firewall profile exists (use connection pool)
-            cnx = db_pool.get_connection() if db_pool else mysql.connector.connect(**getattr(st, 'starrocks_config', st.mysql_config))
-            cursor = cnx.cursor()
-            try:
-                cursor.execute("SELECT tcp_rules, udp_rules FROM FW_Profiles WHERE login = %s", (user_name,))
-                profile = cursor.fetchone()
-                if profile:
-                    joined = dict(attrs)
-                    joined['tcp_rules'], joined['udp_rules'] = profile
-                    send_signal("create", joined)
-            finally:
-                cursor.close()
-                cnx.close()
+            # Check if firewall profile exists
+            with db() as (cnx, cursor):
+                profile = q.fetchone(cnx, cursor, "profile_rules_by_login", (user_name,))
+            if profile:
+                joined = dict(attrs)
+                joined['tcp_rules'], joined['udp_rules'], joined['hash'], joined['policy_id'] = profile
+                send_signal("create", joined)
             
             logger.info(f"RADIUS start event processed: user={user_name}")
 
         elif acct_status == 'stop':
-            # DELETE and SELECT via SQL (use connection pool)
-            cnx = db_pool.get_connection() if db_pool else mysql.connector.connect(**getattr(st, 'starrocks_config', st.mysql_config))
-            cursor = cnx.cursor()
-            try:
-                cursor.execute("DELETE FROM RADIUS_Sessions WHERE User_Name = %s", (user_name,))
-                cursor.execute("SELECT tcp_rules, udp_rules FROM FW_Profiles WHERE login = %s", (user_name,))
-                profile = cursor.fetchone()
-                if profile:
-                    joined = dict(attrs)
-                    joined['tcp_rules'], joined['udp_rules'] = profile
-                    send_signal("delete", joined)
-                cnx.commit()
-            finally:
-                cursor.close()
-                cnx.close()
+            # Session row is removed by the batched flusher (see flush_session_removals); the tombstone keeps
+            # the stop across a restart until then. Under the login's event lock: a restart's load can't
+            # land before the tombstone and be overwritten by it
+            with sessions.event_lock(user_name):
+                sessions.remove(user_name)
+                if not mark_stopped_streamload(user_name, str(datetime.now())):
+                    logger.warning(f"Stream Load failed for RADIUS stop tombstone: user={user_name} (stop kept in memory only)")
+            with db() as (cnx, cursor):
+                profile = q.fetchone(cnx, cursor, "profile_rules_by_login", (user_name,))
+            if profile:
+                joined = dict(attrs)
+                joined['tcp_rules'], joined['udp_rules'], joined['hash'], joined['policy_id'] = profile
+                send_signal("delete", joined)
             
             logger.info(f"RADIUS stop event processed: user={user_name}")
 
@@ -151,13 +144,90 @@ def process_radius_event_sync(attrs: dict):
         logger.error(f"Failed to process RADIUS event: {e}")
         return {"success": False, "error": str(e)}
 
+def load_sessions_sync():
+    """Seed the in-memory session registry from RADIUS_Sessions; stop tombstones go back to the flush queue"""
+    with db() as (cnx, cursor):
+        cursor.execute("SELECT * FROM RADIUS_Sessions")
+        columns = [col[0] for col in cursor.description] if cursor.description else []
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    stopped = [row for row in rows if row.get("Acct_Status_Type") == STOPPED]
+    sessions.seed([row for row in rows if row.get("Acct_Status_Type") != STOPPED])
+    for row in stopped:
+        sessions.remove(row["User_Name"])
+    if stopped:
+        logger.info(f"{len(stopped)} RADIUS stops left unflushed by the last shutdown re-queued for removal")
+
+async def seed_sessions():
+    """Startup hook: load active sessions into the registry (misses fall back to SQL)"""
+    try:
+        await run_blocking(load_sessions_sync, timeout=60)
+    except Exception as e:
+        logger.error(f"Failed to seed RADIUS session registry: {e}")
+
+def flush_session_removals() -> int:
+    """Apply pending Accounting-Stop removals as one multi-key DELETE per chunk.
+
+    DELETE on the aggregate-key table creates a new version per statement,
+    so stop storms are collapsed into a handful of statements per interval.
+    """
+    batch = sessions.begin_flush(st.RADIUS_STOP_FLUSH_BATCH)
+    if not batch:
+        return 0
+    ok = False
+    try:
+        with db() as (cnx, cursor), q.timed("sessions_delete_batch"):
+            for i in range(0, len(batch), 500):
+                chunk = batch[i:i + 500]
+                cursor.execute(
+                    f"DELETE FROM RADIUS_Sessions WHERE User_Name IN ({', '.join(['%s'] * len(chunk))})",
+                    chunk
+                )
+            cnx.commit()
+        ok = True
+    except Exception as e:
+        logger.error(f"Failed to flush {len(batch)} RADIUS session removals: {e}")
+    finally:
+        restarted = sessions.end_flush(batch, ok)
+    # Sessions restarted during the flush may have been hit by the DELETE: write them back
+    for row in restarted:
+        with sessions.event_lock(row["User_Name"]):
+            # Stopped again meanwhile: its tombstone is the newer row
+            if not sessions.is_masked(row["User_Name"]):
+                insert_radius_streamload(*[str(row.get(col) or '') for col in RADIUS_COLUMNS])
+    if ok:
+        logger.info(f"Flushed {len(batch)} RADIUS session removals")
+    return len(batch) if ok else 0
+
+async def session_removal_flusher():
+    """Background task: flush stop removals every RADIUS_STOP_FLUSH_INTERVAL seconds"""
+    try:
+        while True:
+            await asyncio.sleep(st.RADIUS_STOP_FLUSH_INTERVAL)
+            while sessions.pending_removals():
+                try:
+                    if not await run_blocking(flush_session_removals, timeout=0):
+                        break
+                except Exception as e:
+                    logger.error(f"Session removal flush failed: {e}")
+                    break
+    except asyncio.CancelledError:
+        # Shutdown: flush everything left (one call takes at most RADIUS_STOP_FLUSH_BATCH logins);
+        # what a failed flush leaves behind is still in RADIUS_Sessions as tombstones
+        while sessions.pending_removals():
+            try:
+                if not await run_blocking(flush_session_removals, timeout=0):
+                    break
+            except Exception as e:
+                logger.error(f"Session removal flush on shutdown failed: {e}")
+                break
+        raise
+
 @router.post("/event", response_model=SimpleResponse)
 async def receive_radius_event(event: RadiusEvent):
     """Receive RADIUS event and process it asynchronously (non-blocking)"""
     try:
-        # Process in thread pool (non-blocking for other requests)
-        loop = asyncio.get_event_loop()
-        result = await loop.run_in_executor(executor, process_radius_event_sync, event.attrs)
+        # Process on the shared DB executor (non-blocking for other requests)
+        result = await run_blocking(process_radius_event_sync, event.attrs, timeout=0)
         return resp(**result)
     except Exception as e:
         logger.error(f"Failed to queue RADIUS event: {e}")
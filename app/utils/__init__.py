@@ -0,0 +1,2 @@
+# Shared helpers module
+
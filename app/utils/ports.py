@@ -0,0 +1,79 @@
+import hashlib
+from typing import List, Tuple
+
+# Port rules are comma separated tokens: single ports ("443") or ranges ("1024-65535")
+Interval = Tuple[int, int]
+MIN_PORT, MAX_PORT = 1, 65535
+
+
+def merge_intervals(intervals: List[Interval]) -> List[Interval]:
+    """Sort and merge overlapping or adjacent intervals"""
+    merged: List[Interval] = []
+    for lo, hi in sorted(intervals):
+        if merged and lo <= merged[-1][1] + 1:
+            if hi > merged[-1][1]:
+                merged[-1] = (merged[-1][0], hi)
+        else:
+            merged.append((lo, hi))
+    return merged
+
+
+def parse_ports(rules) -> List[Interval]:
+    """Parse "443, 80,1024-65535" into sorted, merged intervals (ValueError on bad tokens)"""
+    intervals: List[Interval] = []
+    for tok in str(rules or "").split(","):
+        tok = tok.strip()
+        if not tok:
+            continue
+        lo, sep, hi = tok.partition("-")
+        try:
+            lo_port = int(lo)
+            hi_port = int(hi) if sep else lo_port
+        except ValueError:
+            raise ValueError(f"Invalid port token: {tok!r}")
+        if not MIN_PORT <= lo_port <= hi_port <= MAX_PORT:
+            raise ValueError(f"Port token out of range: {tok!r}")
+        intervals.append((lo_port, hi_port))
+    return merge_intervals(intervals)
+
+
+def union(*sets: List[Interval]) -> List[Interval]:
+    return merge_intervals([iv for s in sets for iv in s])
+
+
+def difference(a: List[Interval], b: List[Interval]) -> List[Interval]:
+    """Ports of `a` not in `b`; both sorted and merged (parse_ports output)"""
+    result: List[Interval] = []
+    j = 0
+    for lo, hi in a:
+        # Skip cuts entirely left of this interval; b is sorted, so they can't matter later either
+        while j < len(b) and b[j][1] < lo:
+            j += 1
+        k = j
+        while k < len(b) and b[k][0] <= hi:
+            if b[k][0] > lo:
+                result.append((lo, b[k][0] - 1))
+            lo = max(lo, b[k][1] + 1)
+            k += 1
+        if lo <= hi:
+            result.append((lo, hi))
+    return result
+
+
+def complement(a: List[Interval], universe: List[Interval] = ((MIN_PORT, MAX_PORT),)) -> List[Interval]:
+    return difference(list(universe), a)
+
+
+def format_ports(intervals: List[Interval]) -> str:
+    return ",".join(str(lo) if lo == hi else f"{lo}-{hi}" for lo, hi in intervals)
+
+
+def canonical_rules(tcp_rules, udp_rules) -> Tuple[str, str]:
+    """Canonical form of a rule pair: "443, 80" and "80,443" both become "80,443" """
+    return format_ports(parse_ports(tcp_rules)), format_ports(parse_ports(udp_rules))
+
+
+def profile_hash(tcp_rules, udp_rules) -> str:
+    """Profile hash over the canonical rules: equivalent profiles share one FortiGate policy"""
+    tcp, udp = canonical_rules(tcp_rules, udp_rules)
+    return hashlib.md5(f"{tcp}|{udp}".encode()).hexdigest()
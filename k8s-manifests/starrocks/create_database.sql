@@ -114,6 +114,49 @@ PROPERTIES (
     "compression" = "LZ4"
 );
 
+-- =================================================================
+-- PolicyLogs: журнал операций mhe_ae (append-only, Stream Load батчами)
+-- Одна операция (create/edit/delete пользователя) = op_id:
+-- begin → attempt/step на каждый FortiGate → end
+-- Retention: 90 дней
+-- =================================================================
+CREATE TABLE IF NOT EXISTS PolicyLogs (
+    event_time DATETIME NOT NULL COMMENT 'Record time on the AE replica',
+    op_id VARCHAR(32) NOT NULL COMMENT 'AE operation id',
+    seq BIGINT NULL COMMENT 'Record order within the replica journal',
+    replica VARCHAR(64) NULL COMMENT 'AE replica host:port',
+    kind VARCHAR(10) NOT NULL COMMENT 'begin, attempt, step, end',
+    action VARCHAR(10) NULL COMMENT 'create, edit, delete',
+    login VARCHAR(100) NULL COMMENT 'RADIUS username',
+    fg VARCHAR(64) NULL COMMENT 'FortiGate management address',
+    workflow VARCHAR(40) NULL COMMENT 'provision, migrate:<mode>, deprovision',
+    step VARCHAR(40) NULL COMMENT 'FortiGate step (kind = step)',
+    ok TINYINT NULL,
+    ms DOUBLE NULL COMMENT 'Duration, ms',
+    policy_id VARCHAR(50) NULL,
+    hash VARCHAR(64) NULL COMMENT 'Profile hash',
+    detail STRING NULL COMMENT 'Failed step / error; signal data for begin',
+
+    INDEX idx_login (login),
+    INDEX idx_kind (kind)
+)
+DUPLICATE KEY(event_time, op_id)
+PARTITION BY RANGE(event_time) ()
+DISTRIBUTED BY HASH(op_id) BUCKETS 4
+PROPERTIES (
+    "replication_num" = "3",
+    "compression" = "LZ4",
+
+    "dynamic_partition.enable" = "true",
+    "dynamic_partition.time_unit" = "DAY",
+    "dynamic_partition.start" = "-90",
+    "dynamic_partition.end" = "3",
+    "dynamic_partition.prefix" = "p",
+    "dynamic_partition.buckets" = "4",
+    "dynamic_partition.create_history_partition" = "true"
+)
+COMMENT 'mhe_ae operation journal (90 days retention)';
+
 -- =================================================================
 -- Materialized Views (обновлены под новую схему)
 -- =================================================================
@@ -0,0 +1,56 @@
+import pytest
+
+from app.utils.ports import (MAX_PORT, MIN_PORT, canonical_rules, complement, difference, format_ports,
+                             merge_intervals, parse_ports, profile_hash, union)
+
+
+def test_merge_overlapping_and_adjacent():
+    assert merge_intervals([(10, 20), (15, 30), (31, 40), (50, 50)]) == [(10, 40), (50, 50)]
+    assert merge_intervals([(5, 5), (1, 3), (4, 4)]) == [(1, 5)]
+    assert merge_intervals([(1, 100), (20, 30)]) == [(1, 100)]
+
+
+def test_parse_ports():
+    assert parse_ports("443, 80,1024-65535") == [(80, 80), (443, 443), (1024, 65535)]
+    assert parse_ports("79-80,81") == [(79, 81)]
+    assert parse_ports(" , ") == []
+    assert parse_ports(None) == []
+
+
+def test_parse_bounds():
+    assert parse_ports(f"{MIN_PORT}-{MAX_PORT}") == [(1, 65535)]
+    assert parse_ports("65535") == [(65535, 65535)]
+    for rules in ("0", "0-80", "65536", "1-65536"):
+        with pytest.raises(ValueError):
+            parse_ports(rules)
+
+
+@pytest.mark.parametrize("rules", ["abc", "80-", "-80", "1-2-3", "90-80", "8o"])
+def test_parse_invalid_tokens(rules):
+    with pytest.raises(ValueError):
+        parse_ports(rules)
+
+
+def test_union_and_difference():
+    assert union(parse_ports("1-10"), parse_ports("11-20,30")) == [(1, 20), (30, 30)]
+    assert difference([(1, 100)], [(10, 20), (50, 60)]) == [(1, 9), (21, 49), (61, 100)]
+    assert difference([(1, 10)], [(1, 10)]) == []
+    assert difference([(1, 10), (20, 30)], [(5, 25)]) == [(1, 4), (26, 30)]
+
+
+def test_complement_bounds_and_round_trip():
+    assert complement([]) == [(MIN_PORT, MAX_PORT)]
+    assert complement([(MIN_PORT, MAX_PORT)]) == []
+    assert complement([(1, 1), (65535, 65535)]) == [(2, 65534)]
+    for rules in ("80,443", "1-79,81-65535", "1", "65535", "22,1000-2000,65000-65535"):
+        ports = parse_ports(rules)
+        assert complement(complement(ports)) == ports
+        assert union(ports, complement(ports)) == [(MIN_PORT, MAX_PORT)]
+
+
+def test_canonical_rules_and_hash():
+    assert canonical_rules("443, 80", "53") == ("80,443", "53")
+    assert format_ports(parse_ports("81,80,79")) == "79-81"
+    assert profile_hash("80,443", "53") == profile_hash(" 443 ,80,", "53-53")
+    assert profile_hash("80-90", "") == profile_hash("80-85,86-90", None)
+    assert profile_hash("80,443", "53") != profile_hash("53", "80,443")